@@ -1,27 +1,76 @@
 import os
+import gc
+import importlib
 import random
 import smtplib
 import re
+import threading
+import queue
+import uuid
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta, datetime
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
+from flask import Flask, Request, Response, render_template, request, jsonify, session, redirect, url_for, send_file, g, has_request_context
 from flask_cors import CORS
-import firebase_admin
 from email.mime.text import MIMEText
-from firebase_admin import credentials, db, auth
 import io
 import json
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
-import certifi
+import hashlib
+import hmac
+import zipfile
+from collections import deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 
-# Imports for PDF Generation
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_RIGHT, TA_CENTER, TA_LEFT
-from reportlab.lib.units import inch
-from reportlab.lib import colors
+from datastore import (
+    FirebaseDatabase, InMemoryDatabase, MemoryReference, MemoryQuery,
+    UserRepository, CartRepository, OrderRepository, StockRepository, CareersRepository, IdRegistry,
+    DirectUploadRepository, VersionTakenError
+)
+
+# --- Lazily Imported Subsystems ---
+class LazyImport:
+    """A module that is imported the first time one of its attributes is used.
+
+    firebase_admin, boto3 and ReportLab together take most of a worker's boot time, and
+    many workers never touch some of them. The first use imports the module under a lock,
+    so concurrent first requests import it once; after that, attribute access goes
+    straight to the module.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._lock = threading.Lock()
+        self._module = None
+
+    def load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+firebase_admin = LazyImport('firebase_admin')
+credentials = LazyImport('firebase_admin.credentials')
+db = LazyImport('firebase_admin.db')
+auth = LazyImport('firebase_admin.auth')
+firebase_exceptions = LazyImport('firebase_admin.exceptions')
+requests_adapters = LazyImport('requests.adapters')
+boto3 = LazyImport('boto3')
+certifi = LazyImport('certifi')
+s3_transfer = LazyImport('boto3.s3.transfer')
+botocore_config = LazyImport('botocore.config')
+botocore_exceptions = LazyImport('botocore.exceptions')
+# Invoice PDF generation (ReportLab) lives in its own module so it can also run in worker processes
+invoice_pdf = LazyImport('invoice_pdf')
 
 # Load environment variables from .env file for local development
 load_dotenv()
@@ -37,10 +86,110 @@ R2_ACCESS_KEY_ID = os.environ.get('R2_ACCESS_KEY_ID')
 R2_SECRET_ACCESS_KEY = os.environ.get('R2_SECRET_ACCESS_KEY')
 R2_BUCKET_NAME = os.environ.get('R2_BUCKET_NAME')
 R2_PUBLIC_URL_BASE = os.environ.get('R2_PUBLIC_URL_BASE')
+# Overrides the account endpoint, e.g. to point at a local S3-compatible server.
+R2_ENDPOINT_URL = os.environ.get('R2_ENDPOINT_URL')
 
 GMAIL_SENDER_EMAIL = os.environ.get('GMAIL_SENDER_EMAIL')
 GMAIL_SENDER_PASSWORD = os.environ.get('GMAIL_SENDER_PASSWORD')
 
+# How long (in seconds) a worker may serve the cached product catalog before re-reading Firebase.
+CATALOG_CACHE_TTL_SECONDS = float(os.environ.get('CATALOG_CACHE_TTL_SECONDS', '5'))
+# Careers listings change rarely, so they can be cached for longer.
+CAREERS_CACHE_TTL_SECONDS = float(os.environ.get('CAREERS_CACHE_TTL_SECONDS', '60'))
+# Number of catalog versions kept in 'stock_changelog' for /get_current_stocks?since=<version>.
+CATALOG_CHANGELOG_RETENTION = int(os.environ.get('CATALOG_CHANGELOG_RETENTION', '1000'))
+# Attempts at claiming the next catalog version when concurrent writers keep taking it first.
+CATALOG_VERSION_MAX_ATTEMPTS = int(os.environ.get('CATALOG_VERSION_MAX_ATTEMPTS', '25'))
+CATALOG_VERSION_BACKOFF_SECONDS = float(os.environ.get('CATALOG_VERSION_BACKOFF_SECONDS', '0.02'))
+# Retry budget for stock reservations that keep losing their transaction to concurrent checkouts.
+STOCK_RESERVATION_MAX_ATTEMPTS = int(os.environ.get('STOCK_RESERVATION_MAX_ATTEMPTS', '4'))
+STOCK_RESERVATION_BACKOFF_SECONDS = float(os.environ.get('STOCK_RESERVATION_BACKOFF_SECONDS', '0.05'))
+# How many order/invoice/return/job IDs a worker reserves per Firebase transaction.
+ID_BLOCK_SIZE = int(os.environ.get('ID_BLOCK_SIZE', '100'))
+# Outgoing mail is delivered by background workers; failed sends are retried with exponential backoff.
+EMAIL_WORKER_COUNT = int(os.environ.get('EMAIL_WORKER_COUNT', '2'))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '5'))
+EMAIL_RETRY_BACKOFF_SECONDS = float(os.environ.get('EMAIL_RETRY_BACKOFF_SECONDS', '30'))
+# Pending outbox entries not updated for this long are picked up again (e.g. after a worker restart).
+EMAIL_OUTBOX_LEASE_SECONDS = float(os.environ.get('EMAIL_OUTBOX_LEASE_SECONDS', '600'))
+# Authenticated SMTP sessions kept open and shared by all senders (one per outbox worker by default).
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', str(EMAIL_WORKER_COUNT)))
+# Sessions idle longer than this are probed with NOOP before reuse; after SMTP_MAX_IDLE_SECONDS they are closed.
+SMTP_NOOP_AFTER_SECONDS = float(os.environ.get('SMTP_NOOP_AFTER_SECONDS', '10'))
+SMTP_MAX_IDLE_SECONDS = float(os.environ.get('SMTP_MAX_IDLE_SECONDS', '240'))
+# Mail relay; set SMTP_USE_SSL=0 for a plain-SMTP server such as the local sink in benchmarks/local_smtp.py.
+SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '465'))
+SMTP_USE_SSL = os.environ.get('SMTP_USE_SSL', '1').lower() in ('1', 'true', 'yes')
+# Rendered invoice PDFs are cached by content hash: in memory (LRU, bounded in bytes) and optionally on disk or in R2.
+INVOICE_CACHE_MAX_BYTES = int(os.environ.get('INVOICE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+INVOICE_CACHE_DIR = os.environ.get('INVOICE_CACHE_DIR')
+INVOICE_CACHE_R2_PREFIX = os.environ.get('INVOICE_CACHE_R2_PREFIX')
+# Invoices are rendered in a pool of warm worker processes so ReportLab does not hold the request worker's GIL.
+# Set INVOICE_RENDER_PROCESSES=0 to render inline (not under gevent: it stalls every greenlet in the worker).
+INVOICE_RENDER_PROCESSES = int(os.environ.get('INVOICE_RENDER_PROCESSES', '2'))
+INVOICE_RENDER_TIMEOUT_SECONDS = float(os.environ.get('INVOICE_RENDER_TIMEOUT_SECONDS', '20'))
+# Bulk invoice export (/export_invoices) for accounting. Requests must send this token in X-Admin-Token.
+ADMIN_EXPORT_TOKEN = os.environ.get('ADMIN_EXPORT_TOKEN')
+INVOICE_EXPORT_CONCURRENCY = int(os.environ.get('INVOICE_EXPORT_CONCURRENCY', '4'))
+# Upper bound on rendered PDFs held in memory while waiting to be written to the ZIP stream.
+INVOICE_EXPORT_MAX_BUFFER_BYTES = int(os.environ.get('INVOICE_EXPORT_MAX_BUFFER_BYTES', str(16 * 1024 * 1024)))
+# Optionally render each Tax Invoice in the background right after checkout and keep it in R2,
+# so download_invoice can hand out the stored copy instead of rendering on demand.
+INVOICE_PRERENDER_ENABLED = os.environ.get('INVOICE_PRERENDER_ENABLED', '').lower() in ('1', 'true', 'yes')
+INVOICE_PRERENDER_WORKERS = int(os.environ.get('INVOICE_PRERENDER_WORKERS', '1'))
+# 'redirect' sends the browser to a short-lived presigned R2 URL; 'stream' proxies the stored PDF.
+INVOICE_STORED_DELIVERY = os.environ.get('INVOICE_STORED_DELIVERY', 'redirect')
+INVOICE_DOWNLOAD_URL_EXPIRY_SECONDS = int(os.environ.get('INVOICE_DOWNLOAD_URL_EXPIRY_SECONDS', '300'))
+# Multipart settings for video and resume uploads to R2: objects above the threshold are split into
+# parts of R2_MULTIPART_CHUNK_MB that are sent R2_UPLOAD_CONCURRENCY at a time.
+R2_MULTIPART_THRESHOLD_MB = float(os.environ.get('R2_MULTIPART_THRESHOLD_MB', '8'))
+R2_MULTIPART_CHUNK_MB = float(os.environ.get('R2_MULTIPART_CHUNK_MB', '8'))
+R2_UPLOAD_CONCURRENCY = int(os.environ.get('R2_UPLOAD_CONCURRENCY', '8'))
+# Browsers upload return videos and resumes straight to R2 with presigned PUT URLs valid for this long.
+R2_DIRECT_UPLOAD_EXPIRY_SECONDS = int(os.environ.get('R2_DIRECT_UPLOAD_EXPIRY_SECONDS', '900'))
+R2_MAX_VIDEO_BYTES = int(os.environ.get('R2_MAX_VIDEO_BYTES', str(200 * 1024 * 1024)))
+R2_MAX_RESUME_BYTES = int(os.environ.get('R2_MAX_RESUME_BYTES', str(10 * 1024 * 1024)))
+# Stream return videos and resumes sent through the form endpoints into R2 while the request body is
+# being read, instead of spooling them to a temp file first. Staged objects live under the prefix below.
+R2_STREAMING_UPLOADS_ENABLED = os.environ.get('R2_STREAMING_UPLOADS_ENABLED', '').lower() in ('1', 'true', 'yes')
+R2_STREAMING_STAGING_PREFIX = os.environ.get('R2_STREAMING_STAGING_PREFIX', 'incoming')
+# R2 objects to delete are queued under 'r2_deletions/pending' and removed in batches by a background
+# worker; failed keys are retried with exponential backoff before being parked under 'r2_deletions/failed'.
+R2_DELETION_BATCH_SIZE = min(int(os.environ.get('R2_DELETION_BATCH_SIZE', '1000')), 1000)
+R2_DELETION_INTERVAL_SECONDS = float(os.environ.get('R2_DELETION_INTERVAL_SECONDS', '30'))
+R2_DELETION_MAX_ATTEMPTS = int(os.environ.get('R2_DELETION_MAX_ATTEMPTS', '8'))
+R2_DELETION_BACKOFF_SECONDS = float(os.environ.get('R2_DELETION_BACKOFF_SECONDS', '60'))
+# Resumes and staged uploads with no matching application are swept up this often, once older than the grace period.
+R2_ORPHAN_SCAN_INTERVAL_SECONDS = float(os.environ.get('R2_ORPHAN_SCAN_INTERVAL_SECONDS', str(6 * 3600)))
+R2_ORPHAN_GRACE_SECONDS = float(os.environ.get('R2_ORPHAN_GRACE_SECONDS', str(24 * 3600)))
+# Requests a worker serves at once: greenlets under the gevent worker, threads otherwise. gunicorn.conf.py
+# reads the same variables, so the HTTP connection pools below follow the worker configuration.
+GUNICORN_WORKER_CLASS = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', '1'))
+GUNICORN_WORKER_CONNECTIONS = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '2000'))
+WORKER_CONCURRENCY = GUNICORN_WORKER_CONNECTIONS if GUNICORN_WORKER_CLASS == 'gevent' else GUNICORN_THREADS
+# Connections kept open to Firebase; past this, concurrent calls open a connection and throw it away after use.
+FIREBASE_HTTP_POOL_SIZE = int(os.environ.get('FIREBASE_HTTP_POOL_SIZE', str(max(10, WORKER_CONCURRENCY))))
+# R2 client tuning. The connection pool must cover every concurrent request plus one multipart upload's parts in flight.
+R2_MAX_POOL_CONNECTIONS = int(os.environ.get('R2_MAX_POOL_CONNECTIONS', str(max(10, WORKER_CONCURRENCY + R2_UPLOAD_CONCURRENCY))))
+R2_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('R2_CONNECT_TIMEOUT_SECONDS', '3'))
+R2_READ_TIMEOUT_SECONDS = float(os.environ.get('R2_READ_TIMEOUT_SECONDS', '30'))
+R2_MAX_RETRY_ATTEMPTS = int(os.environ.get('R2_MAX_RETRY_ATTEMPTS', '5'))
+# /metrics serves Prometheus text to scrapers that send METRICS_TOKEN as a bearer token; it is disabled while unset.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# 'firebase' (default) or 'memory': an in-process RTDB stand-in for local benchmarks and load tests,
+# optionally seeded from a JSON export and slowed by a per-round-trip latency.
+DATASTORE_BACKEND = os.environ.get('DATASTORE_BACKEND', 'firebase')
+MEMORY_DATASTORE_SEED_FILE = os.environ.get('MEMORY_DATASTORE_SEED_FILE')
+MEMORY_DATASTORE_LATENCY_MS = float(os.environ.get('MEMORY_DATASTORE_LATENCY_MS', '0'))
+MEMORY_DATASTORE_JITTER_MS = float(os.environ.get('MEMORY_DATASTORE_JITTER_MS', '0'))
+# Set EAGER_WARMUP=1 to import and initialize Firebase, the R2 client and ReportLab at startup
+# instead of on the first request that needs each of them.
+EAGER_WARMUP = os.environ.get('EAGER_WARMUP', '').lower() in ('1', 'true', 'yes')
+# Idle /stream/stocks connections receive a comment line this often so proxies keep them open.
+STOCK_STREAM_KEEPALIVE_SECONDS = float(os.environ.get('STOCK_STREAM_KEEPALIVE_SECONDS', '15'))
+
 # --- Flask App Setup ---
 app = Flask(__name__)
 CORS(app, resources={
@@ -49,45 +198,770 @@ CORS(app, resources={
 app.secret_key = FLASK_SECRET_KEY
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 
+# --- Metrics ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+def _prometheus_labels(labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+class MetricsRegistry:
+    """Per-process request and external call metrics, rendered in the Prometheus text format.
+
+    Requests are histogrammed by route (the Flask endpoint), method and status. Calls to
+    Firebase, R2 and SMTP are histogrammed by service, operation and target, and also
+    attributed to the route of the request that made them, so a route's time can be
+    broken down by what it waited on. Calls made outside a request count as 'background'.
+    Each gunicorn worker reports its own numbers.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Starts from zero, e.g. in a forked worker that must not report its master's counts."""
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._calls = {}
+        self._call_errors = {}
+        self._route_calls = {}
+
+    def observe_request(self, route, method, status, seconds, calls):
+        with self._lock:
+            self._requests.setdefault((route, method, status), Histogram()).observe(seconds)
+            for (service, operation, target), (count, call_seconds) in calls.items():
+                totals = self._route_calls.setdefault((route, service, operation, target), [0, 0.0])
+                totals[0] += count
+                totals[1] += call_seconds
+
+    def observe_call(self, service, operation, target, seconds, succeeded):
+        key = (service, operation, target)
+        with self._lock:
+            self._calls.setdefault(key, Histogram()).observe(seconds)
+            if not succeeded:
+                self._call_errors[key] = self._call_errors.get(key, 0) + 1
+            if not has_request_context():
+                totals = self._route_calls.setdefault(('background',) + key, [0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+
+    def call_snapshot(self):
+        """Returns {(service, operation, target): {'calls', 'errors', 'seconds'}}."""
+        with self._lock:
+            return {
+                key: {'calls': histogram.count, 'errors': self._call_errors.get(key, 0), 'seconds': histogram.sum}
+                for key, histogram in self._calls.items()
+            }
+
+    def _render_histogram(self, lines, name, help_text, series, label_names):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, histogram in sorted(series.items()):
+            labels = dict(zip(label_names, key))
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                lines.append(f'{name}_bucket{_prometheus_labels(dict(labels, le=bound))} {count}')
+            lines.append(f'{name}_bucket{_prometheus_labels(dict(labels, le="+Inf"))} {histogram.count}')
+            lines.append(f'{name}_sum{_prometheus_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{_prometheus_labels(labels)} {histogram.count}')
+
+    def render(self):
+        lines = []
+        with self._lock:
+            self._render_histogram(lines, 'nila_http_request_duration_seconds', 'Time spent handling requests.',
+                                   self._requests, ('route', 'method', 'status'))
+            self._render_histogram(lines, 'nila_external_call_duration_seconds', 'Time spent in Firebase, R2 and SMTP calls.',
+                                   self._calls, ('service', 'operation', 'target'))
+            label_names = ('service', 'operation', 'target')
+            lines.append('# HELP nila_external_call_errors_total External calls that failed.')
+            lines.append('# TYPE nila_external_call_errors_total counter')
+            for key, errors in sorted(self._call_errors.items()):
+                lines.append(f'nila_external_call_errors_total{_prometheus_labels(dict(zip(label_names, key)))} {errors}')
+            label_names = ('route', 'service', 'operation', 'target')
+            route_calls = sorted(self._route_calls.items())
+            lines.append('# HELP nila_route_external_calls_total External calls made while handling each route.')
+            lines.append('# TYPE nila_route_external_calls_total counter')
+            for key, (count, _) in route_calls:
+                lines.append(f'nila_route_external_calls_total{_prometheus_labels(dict(zip(label_names, key)))} {count}')
+            lines.append('# HELP nila_route_external_call_seconds_total Time each route spent waiting on external calls.')
+            lines.append('# TYPE nila_route_external_call_seconds_total counter')
+            for key, (_, seconds) in route_calls:
+                lines.append(f'nila_route_external_call_seconds_total{_prometheus_labels(dict(zip(label_names, key)))} {seconds}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+os.register_at_fork(after_in_child=metrics.reset)
+_call_depth = threading.local()
+
+def record_external_call(service, operation, target, seconds, succeeded=True):
+    """Records one external call, attributing it to the current request if there is one."""
+    metrics.observe_call(service, operation, target, seconds, succeeded)
+    if has_request_context():
+        calls = g.setdefault('external_calls', {})
+        totals = calls.setdefault((service, operation, target), [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+@contextmanager
+def timed_call(service, operation, target='', error_types=(Exception,)):
+    """Times the enclosed external call. Calls nested inside another timed call are not counted again."""
+    depth = getattr(_call_depth, 'value', 0)
+    _call_depth.value = depth + 1
+    started_at = time.perf_counter()
+    succeeded = True
+    try:
+        yield
+    except error_types:
+        succeeded = False
+        raise
+    finally:
+        _call_depth.value = depth
+        if depth == 0:
+            record_external_call(service, operation, target, time.perf_counter() - started_at, succeeded)
+
+def _instrument_firebase_method(cls, name):
+    method = getattr(cls, name)
+    def instrumented(self, *args, **kwargs):
+        # Label by top-level node only ('users', 'id_blocks', ...) to keep the series count bounded.
+        target = self._pathurl.strip('/').split('/')[0].removesuffix('.json') or '/'
+        with timed_call('firebase', name, target, error_types=(firebase_exceptions.FirebaseError,)):
+            return method(self, *args, **kwargs)
+    instrumented.__wrapped__ = method
+    setattr(cls, name, instrumented)
+
+def _instrument_reference_classes(reference_class, query_class):
+    for method_name in ('get', 'set', 'set_if_unchanged', 'push', 'update', 'delete', 'transaction'):
+        _instrument_firebase_method(reference_class, method_name)
+    _instrument_firebase_method(query_class, 'get')
+
+# firebase_admin.db's classes are instrumented by init_firebase, when that module is first imported.
+_instrument_reference_classes(MemoryReference, MemoryQuery)
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+@app.after_request
+def record_request_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request_metrics(exc):
+    started_at = g.get('request_started_at')
+    if started_at is None:
+        return
+    metrics.observe_request(
+        request.endpoint or 'unmatched', request.method, str(g.get('response_status', 500)),
+        time.perf_counter() - started_at, g.get('external_calls', {})
+    )
+
 # --- Firebase Initialization (Secure Method) ---
-try:
-    if FIREBASE_CREDS_JSON and FIREBASE_DATABASE_URL:
-        firebase_creds_dict = json.loads(FIREBASE_CREDS_JSON)
-        cred = credentials.Certificate(firebase_creds_dict)
-        firebase_admin.initialize_app(cred, {'databaseURL': FIREBASE_DATABASE_URL})
-        print("✅ Firebase initialized successfully.")
-    else:
-        print("❌ ERROR: FIREBASE_CREDS_JSON or FIREBASE_DATABASE_URL environment variable not set.")
-except (json.JSONDecodeError, TypeError) as e:
-    print(f"❌ ERROR: Failed to parse Firebase credentials. Error: {e}")
-except Exception as e:
-    print(f"❌ ERROR: Failed to initialize Firebase. Error: {e}")
+_firebase_init_lock = threading.Lock()
+_firebase_initialized = False
+
+def init_firebase():
+    """Imports firebase_admin and initializes the default app, once, on first use.
+
+    A failed initialization is reported once and not retried; Firebase calls then fail
+    as they would with no app configured.
+    """
+    global _firebase_initialized
+    if _firebase_initialized:
+        return
+    with _firebase_init_lock:
+        if _firebase_initialized:
+            return
+        _instrument_reference_classes(db.Reference, db.Query)
+        _instrument_firebase_method(db.Reference, 'get_if_changed')
+        try:
+            if FIREBASE_CREDS_JSON and FIREBASE_DATABASE_URL:
+                firebase_creds_dict = json.loads(FIREBASE_CREDS_JSON)
+                cred = credentials.Certificate(firebase_creds_dict)
+                firebase_admin.initialize_app(cred, {'databaseURL': FIREBASE_DATABASE_URL})
+                size_firebase_http_pool()
+                print("✅ Firebase initialized successfully.")
+            else:
+                print("❌ ERROR: FIREBASE_CREDS_JSON or FIREBASE_DATABASE_URL environment variable not set.")
+        except (json.JSONDecodeError, TypeError) as e:
+            print(f"❌ ERROR: Failed to parse Firebase credentials. Error: {e}")
+        except Exception as e:
+            print(f"❌ ERROR: Failed to initialize Firebase. Error: {e}")
+        finally:
+            _firebase_initialized = True
+
+def reset_firebase_connections():
+    """Replaces the default Firebase app with one that has fresh HTTP sessions.
+
+    Used after a fork so a worker never shares its master's pooled connections. The
+    parsed credential is reused, so FIREBASE_CREDENTIALS_JSON is not parsed again.
+    """
+    if not _firebase_initialized or DATASTORE_BACKEND == 'memory':
+        return
+    try:
+        inherited = firebase_admin.get_app()
+    except ValueError:
+        return
+    credential = inherited.credential
+    # Closing the inherited sessions only closes this process's copies of the sockets.
+    firebase_admin.delete_app(inherited)
+    firebase_admin.initialize_app(credential, {'databaseURL': FIREBASE_DATABASE_URL})
+    size_firebase_http_pool()
+
+def size_firebase_http_pool():
+    """Remounts the database client's HTTP adapters with room for FIREBASE_HTTP_POOL_SIZE connections.
+
+    firebase_admin mounts requests' default adapters, which keep 10 connections per host;
+    with hundreds of greenlets per worker most calls would pay for a new TLS handshake.
+    The adapters' retry settings are kept.
+    """
+    session = db.reference()._client.session
+    for prefix, adapter in list(session.adapters.items()):
+        session.mount(prefix, requests_adapters.HTTPAdapter(pool_maxsize=FIREBASE_HTTP_POOL_SIZE, max_retries=adapter.max_retries))
+
+if DATASTORE_BACKEND == 'memory':
+    print("⚠️ Using the in-memory datastore; Firebase is not initialized.")
+
+# --- Data Access ---
+def create_datastore():
+    if DATASTORE_BACKEND != 'memory':
+        return FirebaseDatabase(connect=init_firebase)
+    seed = None
+    if MEMORY_DATASTORE_SEED_FILE:
+        with open(MEMORY_DATASTORE_SEED_FILE, encoding='utf-8') as seed_file:
+            seed = json.load(seed_file)
+    return InMemoryDatabase(seed, latency=MEMORY_DATASTORE_LATENCY_MS / 1000, jitter=MEMORY_DATASTORE_JITTER_MS / 1000)
+
+datastore = create_datastore()
+user_store = UserRepository(datastore)
+cart_store = CartRepository(datastore)
+order_store = OrderRepository(datastore)
+stock_store = StockRepository(datastore)
+careers_store = CareersRepository(datastore)
+id_registry = IdRegistry(datastore)
+direct_upload_store = DirectUploadRepository(datastore)
 
 # --- Cloudflare R2 Client Initialization ---
-try:
-    if all([R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY]):
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=f'https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com',
-            aws_access_key_id=R2_ACCESS_KEY_ID,
-            aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-            region_name='auto',
-            verify=certifi.where()
-        )
-        print("✅ S3 client initialized successfully.")
-    else:
-        s3_client = None
-        print("⚠️ Warning: S3 client not initialized. R2 credentials missing from environment.")
-except Exception as e:
+def _start_r2_call(model, context, **kwargs):
+    context['r2_call'] = (model.name, time.perf_counter())
+
+def _finish_r2_call(context, http_response=None, exception=None, **kwargs):
+    operation, started_at = context.pop('r2_call', (None, None))
+    if operation is None:
+        return
+    # Includes botocore's retries. Client errors such as a 404 on HEAD are answers, not failures.
+    succeeded = exception is None and http_response is not None and http_response.status_code < 500
+    record_external_call('r2', operation, R2_BUCKET_NAME or '', time.perf_counter() - started_at, succeeded)
+
+def create_r2_client():
+    """Builds an S3 client for R2 with a sized connection pool, keep-alive, adaptive retries and timeouts."""
+    config = botocore_config.Config(
+        max_pool_connections=R2_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=R2_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=R2_READ_TIMEOUT_SECONDS,
+        retries={'mode': 'adaptive', 'max_attempts': R2_MAX_RETRY_ATTEMPTS},
+        s3={'addressing_style': 'path'} if R2_ENDPOINT_URL else None
+    )
+    # A session per client: the default boto3 session is not safe to share while threads create clients.
+    client = boto3.session.Session().client(
+        's3',
+        endpoint_url=R2_ENDPOINT_URL or f'https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com',
+        aws_access_key_id=R2_ACCESS_KEY_ID,
+        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+        region_name='auto',
+        verify=certifi.where(),
+        config=config
+    )
+    client.meta.events.register('before-call.s3', _start_r2_call)
+    client.meta.events.register('after-call.s3', _finish_r2_call)
+    client.meta.events.register('after-call-error.s3', _finish_r2_call)
+    return client
+
+class R2Client:
+    """Process-local handle to the R2 client.
+
+    Attribute access is forwarded to a client built by create_r2_client the first time
+    it is used in each process, so forked gunicorn workers never share the parent's
+    pooled sockets.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self._factory()
+                    self._pid = os.getpid()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+# boto3 is imported and the client built on first use (or by warm_up); see R2Client.
+if all([R2_ACCOUNT_ID or R2_ENDPOINT_URL, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY]):
+    s3_client = R2Client(create_r2_client)
+    print("✅ S3 client configured.")
+else:
     s3_client = None
-    print(f"❌ ERROR: Failed to initialize S3 client. Error: {e}")
+    print("⚠️ Warning: S3 client not initialized. R2 credentials missing from environment.")
+
+# --- Catalog Cache (per worker) ---
+class ReferenceCache:
+    """Caches the value at a Firebase RTDB path for a limited time.
+
+    Concurrent misses are coalesced so that only one thread reads Firebase while
+    the others wait for its result. The cached value is shared between requests
+    and must be treated as read-only by callers.
+
+    Every distinct value read from Firebase gets a new version number, and values
+    derived from it (serialized responses, ETags) are memoized per version.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._data = None
+        self._loaded = False
+        self._fetched_at = 0.0
+        self._read_started_at = 0.0
+        self._generation = 0
+        self._version = 0
+        self._derived = {}
+
+    def _is_fresh(self):
+        return self._loaded and (time.monotonic() - self._fetched_at) < self.ttl_seconds
+
+    def _snapshot(self):
+        """Returns (data, version); version is None if the data was not cached."""
+        with self._lock:
+            if self._is_fresh():
+                return self._data, self._version
+        with self._refresh_lock:
+            # Another thread may have refreshed the value while we were waiting.
+            with self._lock:
+                if self._is_fresh():
+                    return self._data, self._version
+                generation = self._generation
+            read_started_at = time.monotonic()
+            data = datastore.reference(self.path).get()
+            with self._lock:
+                # Only keep the result if nobody invalidated the cache mid-read.
+                if generation != self._generation:
+                    return data, None
+                if data != self._data:
+                    self._data = data
+                    self._version += 1
+                    self._derived = {}
+                self._loaded = True
+                self._read_started_at = read_started_at
+                self._fetched_at = time.monotonic()
+                return self._data, self._version
+
+    def get(self, read_after=None):
+        """Returns the cached value; with read_after (a time.monotonic() value), only one read from Firebase after it."""
+        if read_after is not None:
+            with self._lock:
+                if self._loaded and self._read_started_at < read_after:
+                    self._generation += 1
+                    self._loaded = False
+        return self._snapshot()[0]
+
+    def derive(self, key, build):
+        """Returns build(data), computed at most once per version of the cached data."""
+        data, version = self._snapshot()
+        with self._lock:
+            cached = self._derived.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        value = build(data)
+        with self._lock:
+            if version is not None and version == self._version:
+                self._derived[key] = (version, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded = False
+
+catalog_cache = ReferenceCache('stockitems', CATALOG_CACHE_TTL_SECONDS)
+jobs_cache = ReferenceCache('careers/jobs', CAREERS_CACHE_TTL_SECONDS)
+locations_cache = ReferenceCache('careers/offices', CAREERS_CACHE_TTL_SECONDS)
+
+def cached_json_response(cache, key, build_payload):
+    """Serves build_payload(data) as JSON with an ETag, answering 304 when the client copy is current.
+
+    The body and its hash are computed once per cache version instead of once per request.
+    """
+    def encode(data):
+        body = app.json.dumps(build_payload(data)).encode('utf-8')
+        return body, hashlib.sha256(body).hexdigest()
+    body, etag = cache.derive(key, encode)
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+# --- Catalog Versioning ---
+class StockChangelog:
+    """This worker's copy of the recent stock changelog, for /get_current_stocks?since=<version>.
+
+    Polls are answered from memory. Once the copy is older than ttl_seconds, one thread
+    reads the entries logged after the newest it holds (usually none) while the others
+    keep answering from the copy they have, so Firebase reads stay flat as pollers grow.
+    """
+
+    def __init__(self, stock_repository, ttl_seconds, retention):
+        self.stock_repository = stock_repository
+        self.ttl_seconds = ttl_seconds
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._entries = {}  # version -> {productId: availableStock}
+        self._version = 0
+        self._oldest = 1
+        self._unlogged_through = -1
+        self._loaded = False
+        self._fetched_at = 0.0
+
+    def _is_fresh(self):
+        return self._loaded and (time.monotonic() - self._fetched_at) < self.ttl_seconds
+
+    def _refresh(self):
+        with self._lock:
+            if self._is_fresh():
+                return
+        with self._refresh_lock:
+            with self._lock:
+                if self._is_fresh():
+                    return
+                after = self._version
+            entries = self.stock_repository.changes_after(after)
+            with self._lock:
+                for version, stock_levels in entries.items():
+                    self._entries[version] = stock_levels or {}
+                if entries:
+                    if not self._loaded:
+                        self._oldest = min(entries)
+                    self._version = max(self._version, max(entries))
+                self._discard_expired()
+                self._loaded = True
+                self._fetched_at = time.monotonic()
+
+    def _discard_expired(self):
+        while self._oldest <= self._version - self.retention:
+            self._entries.pop(self._oldest, None)
+            self._oldest += 1
+
+    def head(self):
+        """Returns (version, loaded_at): the newest version held and the time.monotonic() it was known by."""
+        self._refresh()
+        with self._lock:
+            return self._version, self._fetched_at
+
+    def changes_since(self, since):
+        """Returns (changes, version), or None when `since` is not covered by the entries held here."""
+        self._refresh()
+        with self._lock:
+            if since <= self._unlogged_through:
+                return None
+            if since == self._version:
+                return {}, since
+            if since > self._version or since < self._oldest - 1:
+                return None
+            changes = {}
+            for version in range(since + 1, self._version + 1):
+                # Versions logged before they were claimed atomically may be missing; there is nothing to add for them.
+                changes.update(self._entries.get(version, {}))
+            return changes, self._version
+
+    def add(self, version, stock_levels):
+        """Records a version this worker just logged, so its own pollers see it without a read."""
+        with self._lock:
+            if self._loaded and version == self._version + 1:
+                self._entries[version] = stock_levels
+                self._version = version
+                self._discard_expired()
+            else:
+                self._fetched_at = 0.0
+
+    def invalidate(self):
+        """Makes the next poll read the entries logged since the newest one held here."""
+        with self._lock:
+            self._fetched_at = 0.0
+
+    def mark_unlogged(self, known_version=0):
+        """Records that a stock change could not be logged after version known_version.
+
+        Pollers that last saw that version or an earlier one get a full snapshot, not a
+        delta that would leave out the change, until a newer version is logged.
+        """
+        with self._lock:
+            self._unlogged_through = max(self._unlogged_through, self._version, known_version)
+            self._fetched_at = 0.0
+
+stock_changelog = StockChangelog(stock_store, CATALOG_CACHE_TTL_SECONDS, CATALOG_CHANGELOG_RETENTION)
+
+def record_stock_changes(product_ids):
+    """Logs the current availableStock of the given products as the next catalog version.
+
+    Must be called after every write to availableStock (orders, rollbacks, restocks) so
+    that /get_current_stocks?since=<version> can return deltas. The version and its
+    changelog entry are written by one transaction; see StockRepository.claim_version.
+
+    Stock is read after the version to claim is chosen, and again on every retry. Whoever
+    claims a version therefore read the stock after the version below it was logged, so
+    a later version never carries an older level than an earlier one, however concurrent
+    checkouts interleave. Returns the new version, or None if nothing could be logged; in
+    that case this worker answers pollers with full snapshots until the next version.
+    """
+    version = None
+    try:
+        for _ in range(CATALOG_VERSION_MAX_ATTEMPTS):
+            version = stock_store.latest_version() + 1
+            stock_levels = stock_store.stock_levels(product_ids)
+            if not stock_levels:
+                return None
+            try:
+                stock_store.claim_version(version, stock_levels)
+                break
+            except VersionTakenError:
+                time.sleep(CATALOG_VERSION_BACKOFF_SECONDS * random.uniform(0, 1))
+        else:
+            raise VersionTakenError(version)
+    except Exception as e:
+        print(f"Error recording stock changes for {', '.join(sorted(product_ids))}: {e}")
+        stock_changelog.mark_unlogged(version - 1 if version else 0)
+        catalog_cache.invalidate()
+        return None
+    stock_changelog.add(version, stock_levels)
+    if version % 100 == 0 and version > CATALOG_CHANGELOG_RETENTION:
+        try:
+            pruned = stock_store.prune_changes(version - CATALOG_CHANGELOG_RETENTION)
+            if pruned:
+                print(f"Pruned {pruned} stock changelog entries.")
+        except Exception as e:
+            print(f"Error pruning stock changelog: {e}")
+    return version
+
+def get_stock_changes_since(since):
+    """Returns (changes, version, is_full) for a client that last saw catalog version `since`.
+
+    Served from this worker's StockChangelog. When it does not cover `since`, the full
+    stock map is returned instead, from catalog_cache but read no earlier than the
+    reported version was known, so the client never skips a change.
+    """
+    found = stock_changelog.changes_since(since)
+    if found is None and since > stock_changelog.head()[0]:
+        # The client saw a newer version through another worker.
+        stock_changelog.invalidate()
+        found = stock_changelog.changes_since(since)
+    if found is not None:
+        changes, version = found
+        return changes, version, False
+    version, known_at = stock_changelog.head()
+    products = catalog_cache.get(read_after=known_at) or {}
+    stocks = {pid: pdata.get('availableStock') for pid, pdata in products.items()}
+    return stocks, version, True
+
+# --- Stock Reservation ---
+class StockUnavailableError(Exception):
+    """Raised when a product no longer exists or cannot cover the requested quantity."""
+
+    def __init__(self, product_id, available_stock):
+        super().__init__(f"Product {product_id} has {available_stock} units available.")
+        self.product_id = product_id
+        self.available_stock = available_stock
+
+def _run_stock_transaction(product_id, update):
+    """Runs a transaction on one product node, retrying aborted transactions with backoff."""
+    for attempt in range(1, STOCK_RESERVATION_MAX_ATTEMPTS + 1):
+        try:
+            return stock_store.transaction(product_id, update)
+        except db.TransactionAbortedError:
+            if attempt == STOCK_RESERVATION_MAX_ATTEMPTS:
+                raise
+            time.sleep(STOCK_RESERVATION_BACKOFF_SECONDS * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+def reserve_product_stock(product_id, quantity):
+    """Atomically decrements availableStock of one product and returns the updated product."""
+    def decrement(product):
+        if not product:
+            raise StockUnavailableError(product_id, None)
+        available_stock = product.get('availableStock', 0)
+        if available_stock < quantity:
+            raise StockUnavailableError(product_id, available_stock)
+        return dict(product, availableStock=available_stock - quantity)
+    return _run_stock_transaction(product_id, decrement)
+
+def release_product_stock(product_id, quantity):
+    """Gives back units taken by reserve_product_stock. Raises StockUnavailableError if the product is gone."""
+    def increment(product):
+        if not product:
+            # There is nothing to give the units back to, and a transaction cannot write None.
+            raise StockUnavailableError(product_id, None)
+        return dict(product, availableStock=product.get('availableStock', 0) + quantity)
+    return _run_stock_transaction(product_id, increment)
+
+def reserve_stock(quantities):
+    """Reserves {product_id: quantity} all-or-nothing, touching only those product nodes.
+
+    Returns (reserved, shortages): the updated products keyed by ID, and for every product
+    that could not be reserved its available stock (None if it no longer exists). When there
+    are shortages nothing stays reserved.
+    """
+    reserved, shortages = {}, {}
+    for product_id, quantity in quantities.items():
+        try:
+            reserved[product_id] = reserve_product_stock(product_id, quantity)
+        except StockUnavailableError as e:
+            shortages[product_id] = e.available_stock
+        except Exception:
+            release_stock(reserved, quantities)
+            raise
+    if shortages:
+        release_stock(reserved, quantities)
+        reserved = {}
+    return reserved, shortages
+
+def release_stock(reserved, quantities):
+    """Best-effort rollback of the reservations returned by reserve_stock.
+
+    The reserved levels may already have been logged by a concurrent checkout, so the
+    released ones are logged again.
+    """
+    released = []
+    for product_id in reserved:
+        try:
+            release_product_stock(product_id, quantities[product_id])
+            released.append(product_id)
+        except Exception as e:
+            print(f"❌ ERROR: Failed to release {quantities[product_id]} units of {product_id}: {e}")
+    if released:
+        record_stock_changes(released)
+
+# --- Live Stock Stream (per worker) ---
+class StockSubscription:
+    """Pending stock changes for one connected client, coalesced per product."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._ready = threading.Event()
+
+    def push(self, changes):
+        with self._lock:
+            self._pending.update(changes)
+            self._ready.set()
+
+    def wait(self, timeout):
+        """Returns the changes accumulated since the last call, or {} on timeout."""
+        if not self._ready.wait(timeout):
+            return {}
+        with self._lock:
+            changes, self._pending = self._pending, {}
+            self._ready.clear()
+        return changes
+
+class StockBroadcaster:
+    """Mirrors the stock tree through one database listener and fans out stock deltas."""
+
+    def __init__(self, stock_repository):
+        self.stock_repository = stock_repository
+        self.reset()
+
+    def reset(self):
+        """Forgets the listener and subscribers, e.g. in a forked child, where the listener thread does not exist."""
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._mirror = {}
+        self._stocks = {}
+        self._listener = None
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = self.stock_repository.listen(self._on_event)
+            print(f"Started shared stock listener on '{self.stock_repository.path}'.")
+
+    def subscribe(self):
+        self._ensure_listener()
+        subscription = StockSubscription()
+        with self._lock:
+            self._subscribers.add(subscription)
+            snapshot = dict(self._stocks)
+        return subscription, snapshot
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _apply(self, path, data):
+        keys = [k for k in path.split('/') if k]
+        if not keys:
+            self._mirror = data if isinstance(data, dict) else {}
+            return
+        node = self._mirror
+        for key in keys[:-1]:
+            child = node.get(key)
+            if not isinstance(child, dict):
+                child = node[key] = {}
+            node = child
+        if data is None:
+            node.pop(keys[-1], None)
+        else:
+            node[keys[-1]] = data
+
+    def _on_event(self, event):
+        with self._lock:
+            if event.event_type == 'put':
+                self._apply(event.path, event.data)
+            elif event.event_type == 'patch':
+                for sub_path, value in (event.data or {}).items():
+                    self._apply(f"{event.path}/{sub_path}", value)
+            else:
+                return
+            stocks = {pid: pdata.get('availableStock') for pid, pdata in self._mirror.items() if isinstance(pdata, dict)}
+            changes = {pid: stock for pid, stock in stocks.items() if self._stocks.get(pid) != stock}
+            changes.update({pid: None for pid in self._stocks if pid not in stocks})
+            self._stocks = stocks
+            subscribers = list(self._subscribers)
+        if not changes:
+            return
+        catalog_cache.invalidate()
+        stock_changelog.invalidate()
+        for subscription in subscribers:
+            subscription.push(changes)
+
+stock_broadcaster = StockBroadcaster(stock_store)
+os.register_at_fork(after_in_child=stock_broadcaster.reset)
 
 
 # --- Database Setup (Injects Sample Products) ---
 def setup_database():
     """Checks for stock items and injects sample data if none exist."""
-    stock_ref = db.reference('stockitems')
-    if stock_ref.get() is None:
+    if stock_store.all() is None:
         print("No stock items found. Injecting sample data...")
         sample_products = {
             "item001": {'name': 'Ethereal Silk Saree', 'price': 4999, 'availableStock': 10, 'image': 'https://images.unsplash.com/photo-1620799140408-edc6d633?w=500&q=80', 'description': 'Graceful sarees woven with pure silk threads.'},
@@ -99,14 +973,13 @@ def setup_database():
             "item007": {'name': 'Designer Georgette Gown', 'price': 8999, 'availableStock': 12, 'image': 'https://images.unsplash.com/photo-1594650537308-391307047f9e?w=500&q=80', 'description': 'Flowy and elegant for evening parties.'},
             "item008": {'name': 'Handloom Cotton Towels', 'price': 999, 'availableStock': 0, 'image': 'https://images.unsplash.com/photo-1611099149791-33299a9a5f7e?w=500&q=80', 'description': 'Set of 2 soft, absorbent handloom towels.'},
         }
-        stock_ref.set(sample_products)
+        stock_store.replace_all(sample_products)
         print("Sample product data injected successfully.")
 
 # --- Database Setup for Careers Page ---
 def setup_careers_database():
     """Checks for careers data and injects it if none exists."""
-    careers_ref = db.reference('careers')
-    if careers_ref.get() is None:
+    if careers_store.all() is None:
         print("No careers data found. Injecting sample data...")
         sample_careers_data = {
             "jobs": {
@@ -128,28 +1001,130 @@ def setup_careers_database():
                 "loc06": { "city": 'London, UK', "type": 'European Showroom', "address": 'Regent Street, London W1B 5AP, United Kingdom' }
             }
         }
-        careers_ref.set(sample_careers_data)
+        careers_store.replace_all(sample_careers_data)
         print("Sample careers data injected successfully.")
 
 
+# --- R2 Multipart Transfers ---
+def make_r2_transfer_config(chunk_mb=None, concurrency=None, threshold_mb=None):
+    """TransferConfig for R2 uploads; arguments override the R2_* environment settings."""
+    chunk_mb = chunk_mb or R2_MULTIPART_CHUNK_MB
+    concurrency = concurrency or R2_UPLOAD_CONCURRENCY
+    threshold_mb = threshold_mb or R2_MULTIPART_THRESHOLD_MB
+    return s3_transfer.TransferConfig(
+        multipart_threshold=int(threshold_mb * 1024 * 1024),
+        multipart_chunksize=int(chunk_mb * 1024 * 1024),
+        max_concurrency=concurrency,
+        use_threads=concurrency > 1
+    )
+
+class UploadStats:
+    """Process-wide counters for R2 uploads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def record(self, sent_bytes, seconds, succeeded):
+        with self._lock:
+            if succeeded:
+                self.uploads += 1
+            else:
+                self.failures += 1
+            self.bytes += sent_bytes
+            self.seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {'uploads': self.uploads, 'failures': self.failures, 'bytes': self.bytes, 'seconds': self.seconds}
+
+r2_upload_stats = UploadStats()
+
+class UploadProgress:
+    """boto3 transfer callback that tracks one upload and logs each 25% of progress."""
+
+    def __init__(self, object_key, total_bytes):
+        self.object_key = object_key
+        self.total_bytes = total_bytes
+        self.sent_bytes = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._next_report = 25
+
+    def __call__(self, bytes_amount):
+        # Called from the transfer threads, once per chunk sent.
+        with self._lock:
+            self.sent_bytes += bytes_amount
+            if not self.total_bytes:
+                return
+            percent = self.sent_bytes * 100 // self.total_bytes
+            if percent < self._next_report or percent >= 100:
+                return
+            self._next_report = (percent // 25 + 1) * 25
+        print(f"Uploading {self.object_key}: {percent}% of {self.total_bytes} bytes.")
+
+    def finish(self, succeeded):
+        elapsed = time.monotonic() - self.started_at
+        r2_upload_stats.record(self.sent_bytes, elapsed, succeeded)
+        if succeeded:
+            rate = self.sent_bytes / elapsed / (1024 * 1024) if elapsed else 0.0
+            print(f"Uploaded {self.sent_bytes} bytes to {self.object_key} in {elapsed:.2f}s ({rate:.1f} MiB/s).")
+
+def _stream_size(fileobj):
+    try:
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(position)
+        return size - position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def upload_fileobj_to_r2(fileobj, object_key, content_type, transfer_config=None):
+    """Uploads a file object to R2 with multipart transfer settings and progress tracking. Raises on failure."""
+    if isinstance(getattr(fileobj, 'stream', None), R2StreamingUpload):
+        # Already sent to R2 while the request was parsed; only the final key remains.
+        fileobj.stream.finish(object_key)
+        return
+    progress = UploadProgress(object_key, _stream_size(fileobj))
+    try:
+        s3_client.upload_fileobj(
+            fileobj,
+            R2_BUCKET_NAME,
+            object_key,
+            ExtraArgs={'ContentType': content_type},
+            Config=transfer_config or make_r2_transfer_config(),
+            Callback=progress
+        )
+    except Exception:
+        progress.finish(succeeded=False)
+        raise
+    progress.finish(succeeded=True)
+
+def video_object_key(user_name, return_id):
+    user_name_safe = re.sub(r'[^a-zA-Z0-9_-]', '_', user_name)
+    return f"{user_name_safe}/{return_id}/{return_id}_verification.mp4"
+
+def resume_object_key(application_id):
+    return f"job_applications/{application_id}/{application_id}_resume.pdf"
+
 # --- R2 Upload Helper ---
 def upload_video_to_r2(video_file, user_name, return_id):
     if not video_file:
         return None, "No video file provided."
     if not s3_client:
         return None, "S3 client is not configured."
-    user_name_safe = re.sub(r'[^a-zA-Z0-9_-]', '_', user_name)
-    object_key = f"{user_name_safe}/{return_id}/{return_id}_verification.mp4"
+    object_key = video_object_key(user_name, return_id)
     try:
-        s3_client.upload_fileobj(
-            video_file,
-            R2_BUCKET_NAME,
-            object_key,
-            ExtraArgs={'ContentType': 'video/mp4'}
-        )
+        upload_fileobj_to_r2(video_file, object_key, 'video/mp4')
         public_url = f"{R2_PUBLIC_URL_BASE}/{object_key}"
         print(f"Successfully uploaded {object_key} to R2 bucket {R2_BUCKET_NAME}.")
         return public_url, None
+    except UploadRejectedError as e:
+        return None, str(e)
     except Exception as e:
         error_msg = f"An unexpected error occurred during upload: {e}"
         print(f"Upload Error: {error_msg}")
@@ -161,192 +1136,1187 @@ def upload_resume_to_r2(resume_file, application_id):
         return None, "No resume file provided."
     if not s3_client:
         return None, "S3 client is not configured."
-    object_key = f"job_applications/{application_id}/{application_id}_resume.pdf"
+    object_key = resume_object_key(application_id)
     try:
-        s3_client.upload_fileobj(
-            resume_file,
-            R2_BUCKET_NAME,
-            object_key,
-            ExtraArgs={'ContentType': 'application/pdf'}
-        )
+        upload_fileobj_to_r2(resume_file, object_key, 'application/pdf')
         public_url = f"{R2_PUBLIC_URL_BASE}/{object_key}"
         print(f"Successfully uploaded {object_key} to R2 bucket {R2_BUCKET_NAME}.")
         return public_url, None
+    except UploadRejectedError as e:
+        return None, str(e)
     except Exception as e:
         error_msg = f"An unexpected error occurred during resume upload: {e}"
         print(f"Upload Error: {error_msg}")
         return None, error_msg
 
-# --- R2 Deletion Helper for Resumes ---
-def delete_resume_from_r2(application_id):
-    """Deletes a resume file from Cloudflare R2 based on the application ID."""
-    if not application_id:
-        return False, "Application ID not provided."
+# --- Direct-to-R2 Uploads ---
+# Large files skip the app server: the browser asks for a presigned PUT, uploads to R2 itself and then
+# calls the usual form endpoint with the upload ID, which checks the object with HEAD before saving.
+# Grants are kept in the datastore, tied to the requesting user, and can be claimed only once.
+DIRECT_UPLOAD_KINDS = {
+    'resume': {'content_type': 'application/pdf', 'max_bytes': R2_MAX_RESUME_BYTES},
+    'return_video': {'content_type': 'video/mp4', 'max_bytes': R2_MAX_VIDEO_BYTES},
+}
+
+def create_direct_upload(kind, upload_id, object_key, size):
+    """Presigns a PUT of `size` bytes to object_key and records the grant for the session's user. Returns (upload, error)."""
+    if not s3_client:
+        return None, "S3 client is not configured."
+    spec = DIRECT_UPLOAD_KINDS[kind]
+    if not isinstance(size, int) or size <= 0:
+        return None, "File size is required."
+    if size > spec['max_bytes']:
+        return None, f"File is too large. The limit is {spec['max_bytes'] // (1024 * 1024)} MB."
+    # Content-Type and Content-Length are part of the signature, so R2 rejects any other file.
+    upload_url = s3_client.generate_presigned_url('put_object', Params={
+        'Bucket': R2_BUCKET_NAME, 'Key': object_key,
+        'ContentType': spec['content_type'], 'ContentLength': size
+    }, ExpiresIn=R2_DIRECT_UPLOAD_EXPIRY_SECONDS)
+    direct_upload_store.grant(upload_id, {
+        'kind': kind, 'key': object_key, 'size': size, 'owner': session.get('user_email'),
+        'expires': time.time() + R2_DIRECT_UPLOAD_EXPIRY_SECONDS
+    })
+    return {
+        'uploadId': upload_id, 'uploadUrl': upload_url, 'method': 'PUT',
+        'headers': {'Content-Type': spec['content_type']}
+    }, None
+
+def finalize_direct_upload(kind, upload_id):
+    """Verifies a pending direct upload is in R2 as presigned, then claims it. Returns (public_url, error).
+
+    The object is checked before the grant is claimed, so a failed or transient check leaves
+    the grant in place and the same upload can be submitted again.
+    """
+    owner = session.get('user_email')
+    entry = direct_upload_store.get(upload_id, owner, kind)
+    if not entry or entry['expires'] <= time.time():
+        return None, "Upload not found or expired. Please upload the file again."
     if not s3_client:
-        return False, "S3 client is not configured."
-    object_key = f"job_applications/{application_id}/{application_id}_resume.pdf"
+        return None, "S3 client is not configured."
     try:
-        print(f"Attempting to delete {object_key} from R2 bucket {R2_BUCKET_NAME}...")
-        s3_client.delete_object(Bucket=R2_BUCKET_NAME, Key=object_key)
-        print(f"Successfully deleted {object_key} from R2.")
-        return True, None
-    except ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            print(f"Warning: File {object_key} not found in R2 for deletion, but proceeding.")
-            return True, "File not found."
+        head = s3_client.head_object(Bucket=R2_BUCKET_NAME, Key=entry['key'])
+    except botocore_exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None, "The uploaded file was not found. Please upload it again."
+        return None, f"Could not verify the upload: {e}"
+    # Claiming after the check still makes the grant single-use if two submits race.
+    if not direct_upload_store.claim(upload_id, owner, kind, time.time()):
+        return None, "Upload not found or expired. Please upload the file again."
+    expected_type = DIRECT_UPLOAD_KINDS[kind]['content_type']
+    if head.get('ContentLength') != entry['size'] or head.get('ContentType') != expected_type:
+        print(f"Direct upload {entry['key']} does not match its presigned size or type; deleting it.")
+        s3_client.delete_object(Bucket=R2_BUCKET_NAME, Key=entry['key'])
+        return None, "The uploaded file does not match what was requested."
+    return f"{R2_PUBLIC_URL_BASE}/{entry['key']}", None
+
+# --- Background R2 Deletion ---
+class R2DeletionQueue:
+    """Deletes R2 objects off the request path, in batches of up to R2_DELETION_BATCH_SIZE keys.
+
+    Callers add pending_entry(key) to the same MultiPathCommit that removes the record
+    owning the object, so a key is queued exactly when its owner disappears, then call
+    wake(). One worker at a time, holding the lease at 'r2_deletions/lease', drains the
+    queue with delete_objects. It also periodically reconciles the bucket against
+    Firebase, queuing resumes without an application and abandoned staged uploads, and
+    drops expired direct-upload grants along with any object uploaded but never submitted.
+    """
+
+    def __init__(self, batch_size, interval_seconds, max_attempts, backoff_seconds, orphan_scan_seconds, orphan_grace_seconds):
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.orphan_scan_seconds = orphan_scan_seconds
+        self.orphan_grace_seconds = orphan_grace_seconds
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._owner = uuid.uuid4().hex
+
+    def start(self):
+        """Starts this process's drainer thread; a no-op if it is already running."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive fork, so every worker process starts its own drainer.
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            self._owner = uuid.uuid4().hex
+            threading.Thread(target=self._run, name='r2-deletion-queue', daemon=True).start()
+
+    def pending_entry(self, object_key, reason='withdrawn'):
+        """Returns (path, value) queuing object_key for deletion, for use with MultiPathCommit.set."""
+        # Millisecond-prefixed IDs keep the queue in arrival order under order_by_key.
+        entry_id = f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+        return f'r2_deletions/pending/{entry_id}', {
+            'key': object_key, 'reason': reason, 'attempts': 0, 'notBefore': 0, 'queuedAt': {'.sv': 'timestamp'}
+        }
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def _acquire_lease(self):
+        lease_until = time.time() + max(self.interval_seconds * 4, 60)
+        def take_lease(current):
+            if current and current.get('owner') != self._owner and current.get('leaseUntil', 0) > time.time():
+                raise LookupError('r2_deletions/lease')
+            return {'owner': self._owner, 'leaseUntil': lease_until}
+        try:
+            datastore.reference('r2_deletions/lease').transaction(take_lease)
+            return True
+        except (LookupError, db.TransactionAbortedError):
+            return False
+
+    def _run(self):
+        next_orphan_scan = time.time() + self.interval_seconds
+        while True:
+            self._wakeup.wait(self.interval_seconds)
+            self._wakeup.clear()
+            try:
+                if not s3_client or not self._acquire_lease():
+                    continue
+                self.drain()
+                if time.time() >= next_orphan_scan:
+                    next_orphan_scan = time.time() + self.orphan_scan_seconds
+                    self.discard_expired_uploads()
+                    self.reconcile_orphans()
+            except Exception as e:
+                print(f"R2 deletion queue error: {e}")
+
+    def drain(self):
+        """Deletes every due pending key. Returns (deleted, failed) counts."""
+        deleted = failed = 0
+        start_key = None
+        while True:
+            query = datastore.reference('r2_deletions/pending').order_by_key()
+            if start_key:
+                query = query.start_at(start_key)
+            page = query.limit_to_first(self.batch_size + (1 if start_key else 0)).get() or {}
+            page.pop(start_key, None)
+            if not page:
+                break
+            now = time.time()
+            due = {entry_id: entry for entry_id, entry in page.items() if entry.get('notBefore', 0) <= now}
+            if due:
+                batch_deleted, batch_failed = self._delete_batch(due)
+                deleted += batch_deleted
+                failed += batch_failed
+            if len(page) < self.batch_size:
+                break
+            start_key = max(page)
+        if deleted or failed:
+            print(f"R2 deletion queue: deleted {deleted} objects, {failed} failed.")
+        return deleted, failed
+
+    def _delete_batch(self, entries):
+        entry_ids_by_key = {}
+        for entry_id, entry in entries.items():
+            entry_ids_by_key.setdefault(entry['key'], []).append(entry_id)
+        errors = {}
+        try:
+            response = s3_client.delete_objects(Bucket=R2_BUCKET_NAME, Delete={
+                'Objects': [{'Key': key} for key in entry_ids_by_key], 'Quiet': True
+            })
+            for error in response.get('Errors', []):
+                if error.get('Code') != 'NoSuchKey':
+                    errors[error['Key']] = f"{error.get('Code')}: {error.get('Message')}"
+        except Exception as e:
+            errors = dict.fromkeys(entry_ids_by_key, str(e))
+
+        commit = MultiPathCommit()
+        for key, entry_ids in entry_ids_by_key.items():
+            for entry_id in entry_ids:
+                if key not in errors:
+                    commit.delete(f'r2_deletions/pending/{entry_id}')
+                    continue
+                attempts = entries[entry_id].get('attempts', 0) + 1
+                if attempts >= self.max_attempts:
+                    print(f"❌ ERROR: Giving up on deleting {key} from R2 after {attempts} attempts: {errors[key]}")
+                    commit.delete(f'r2_deletions/pending/{entry_id}')
+                    commit.set(f'r2_deletions/failed/{entry_id}', dict(entries[entry_id], attempts=attempts, lastError=errors[key]))
+                else:
+                    delay = self.backoff_seconds * (2 ** (attempts - 1))
+                    commit.set(f'r2_deletions/pending/{entry_id}/attempts', attempts)
+                    commit.set(f'r2_deletions/pending/{entry_id}/notBefore', time.time() + delay)
+                    commit.set(f'r2_deletions/pending/{entry_id}/lastError', errors[key])
+        commit.commit()
+        failed = sum(len(entry_ids_by_key[key]) for key in errors)
+        return len(entries) - failed, failed
+
+    def discard_expired_uploads(self):
+        """Removes expired direct-upload grants and queues the objects of unclaimed ones. Returns how many were queued.
+
+        An unclaimed grant's object key was issued for it alone (a fresh return or application
+        ID), so once the grant expires nothing can reference the object and it is deleted with
+        the grant. The bucket scan in reconcile_orphans would never find return videos.
+        """
+        expired = list(direct_upload_store.expired(time.time()).items())
+        queued = 0
+        for start in range(0, len(expired), self.batch_size):
+            commit = MultiPathCommit()
+            for upload_id, grant in expired[start:start + self.batch_size]:
+                commit.delete(direct_upload_store.path(upload_id))
+                if not grant.get('claimed') and grant.get('key'):
+                    commit.set(*self.pending_entry(grant['key'], reason='expired_upload'))
+                    queued += 1
+            commit.commit()
+        if queued:
+            print(f"R2 deletion queue: queued {queued} direct uploads that were never submitted.")
+        return queued
+
+    def reconcile_orphans(self):
+        """Queues resumes with no application and stale staged uploads. Returns how many were queued."""
+        cutoff = datetime.now().astimezone() - timedelta(seconds=self.orphan_grace_seconds)
+        # Applications are the source of truth for resumes. If they cannot all be read, or none are
+        # found, every resume would look orphaned, so the scan waits for the next interval instead.
+        try:
+            application_ids = set()
+            for user_key in user_store.keys():
+                application_ids |= careers_store.application_ids(user_key)
+        except Exception as e:
+            print(f"R2 reconciliation skipped: could not read job applications: {e}")
+            return 0
+        if not application_ids:
+            print("R2 reconciliation skipped: no job applications were found.")
+            return 0
+        pending_keys = {entry.get('key') for entry in (datastore.reference('r2_deletions/pending').get() or {}).values()}
+        orphans = []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for prefix, is_orphan in (
+            ('job_applications/', lambda key: key.split('/')[1] not in application_ids),
+            (f'{R2_STREAMING_STAGING_PREFIX}/', lambda key: True),
+        ):
+            for page in paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    if obj['LastModified'] < cutoff and obj['Key'] not in pending_keys and is_orphan(obj['Key']):
+                        orphans.append(obj['Key'])
+        for start in range(0, len(orphans), self.batch_size):
+            commit = MultiPathCommit()
+            for key in orphans[start:start + self.batch_size]:
+                commit.set(*self.pending_entry(key, reason='orphaned'))
+            commit.commit()
+        if orphans:
+            print(f"R2 reconciliation queued {len(orphans)} orphaned objects for deletion.")
+            self.drain()
+        return len(orphans)
+
+r2_deletion_queue = R2DeletionQueue(
+    R2_DELETION_BATCH_SIZE, R2_DELETION_INTERVAL_SECONDS, R2_DELETION_MAX_ATTEMPTS,
+    R2_DELETION_BACKOFF_SECONDS, R2_ORPHAN_SCAN_INTERVAL_SECONDS, R2_ORPHAN_GRACE_SECONDS
+)
+
+# --- Streaming Uploads ---
+# Werkzeug writes uploaded files into whatever its stream factory returns, so on the form endpoints
+# below the factory hands out a sink that forwards the bytes to an R2 multipart upload as they arrive.
+STREAMING_UPLOAD_ENDPOINTS = {'request_return': 'return_video', 'submit_application': 'resume'}
+STREAMING_UPLOAD_SIGNATURES = {
+    'return_video': ((4, b'ftyp'), (0, b'\x1a\x45\xdf\xa3')),  # MP4/QuickTime, WebM/Matroska
+    'resume': ((0, b'%PDF-'),),
+}
+STREAMING_UPLOAD_PART_BYTES = max(int(R2_MULTIPART_CHUNK_MB * 1024 * 1024), 5 * 1024 * 1024)
+
+def _new_r2_part_executor():
+    global r2_part_executor
+    # A forked child must not inherit the parent's executor: its threads do not exist there.
+    r2_part_executor = ThreadPoolExecutor(max_workers=R2_UPLOAD_CONCURRENCY, thread_name_prefix='r2-stream')
+
+_new_r2_part_executor()
+os.register_at_fork(after_in_child=_new_r2_part_executor)
+
+class UploadRejectedError(Exception):
+    pass
+
+class R2StreamingUpload(io.RawIOBase):
+    """Write-only file that sends an uploaded file to R2 while the request body is parsed.
+
+    Data is cut into parts of STREAMING_UPLOAD_PART_BYTES and uploaded to a staging key with at
+    most one part in flight, so an upload holds at most two parts in memory whatever its size.
+    The declared and sniffed content type and the size cap are checked as data arrives; a rejected
+    upload is aborted at once and the rest of its bytes are discarded. finish() moves the object to
+    its final key and close() aborts anything left unfinished.
+    """
+
+    def __init__(self, kind, content_type):
+        super().__init__()
+        spec = DIRECT_UPLOAD_KINDS[kind]
+        self.kind = kind
+        self.content_type = spec['content_type']
+        self.max_bytes = spec['max_bytes']
+        self.staging_key = f"{R2_STREAMING_STAGING_PREFIX}/{uuid.uuid4().hex}"
+        self.size = 0
+        self.error = None
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._in_flight = None
+        self._sniffed = False
+        self._finished = False
+        self.started_at = time.monotonic()
+        declared = (content_type or '').split(';')[0].strip().lower()
+        if not (declared.startswith('video/') if kind == 'return_video' else declared == self.content_type):
+            self._reject(f"Unsupported file type: {declared or 'unknown'}.")
+
+    def writable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # The form parser rewinds every file container once it is complete.
+        return 0
+
+    def write(self, data):
+        if self.error:
+            return len(data)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self._reject(f"File is too large. The limit is {self.max_bytes // (1024 * 1024)} MB.")
+            return len(data)
+        self._buffer += data
+        if not self._sniffed and len(self._buffer) >= 16:
+            self._sniff()
+        while not self.error and len(self._buffer) >= STREAMING_UPLOAD_PART_BYTES:
+            self._send_part(bytes(self._buffer[:STREAMING_UPLOAD_PART_BYTES]))
+            del self._buffer[:STREAMING_UPLOAD_PART_BYTES]
+        return len(data)
+
+    def _sniff(self):
+        self._sniffed = True
+        head = bytes(self._buffer[:16])
+        if not any(head[offset:offset + len(magic)] == magic for offset, magic in STREAMING_UPLOAD_SIGNATURES[self.kind]):
+            self._reject("The file content does not match its type.")
+
+    def _reject(self, message):
+        self.error = message
+        self._buffer = bytearray()
+        self._abort()
+        r2_upload_stats.record(self.size, time.monotonic() - self.started_at, succeeded=False)
+
+    def _send_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = s3_client.create_multipart_upload(
+                Bucket=R2_BUCKET_NAME, Key=self.staging_key, ContentType=self.content_type
+            )['UploadId']
+        self._wait_for_part()
+        if self.error:
+            return
+        part_number = len(self._parts) + 1
+        self._in_flight = (part_number, r2_part_executor.submit(
+            s3_client.upload_part, Bucket=R2_BUCKET_NAME, Key=self.staging_key,
+            UploadId=self._upload_id, PartNumber=part_number, Body=body
+        ))
+
+    def _wait_for_part(self):
+        in_flight, self._in_flight = self._in_flight, None
+        if in_flight is None:
+            return
+        part_number, future = in_flight
+        try:
+            self._parts.append({'PartNumber': part_number, 'ETag': future.result()['ETag']})
+        except Exception as e:
+            print(f"Error streaming part {part_number} of {self.staging_key} to R2: {e}")
+            self._reject("The upload to storage failed. Please try again.")
+
+    def _abort(self):
+        in_flight, self._in_flight = self._in_flight, None
+        if in_flight is not None:
+            in_flight[1].cancel()
+        upload_id, self._upload_id = self._upload_id, None
+        if upload_id is None:
+            return
+        try:
+            s3_client.abort_multipart_upload(Bucket=R2_BUCKET_NAME, Key=self.staging_key, UploadId=upload_id)
+        except Exception as e:
+            print(f"Could not abort streamed upload {self.staging_key}: {e}")
+
+    def finish(self, object_key):
+        """Completes the upload and stores it under object_key. Raises UploadRejectedError on failure."""
+        if not self.error and not self._sniffed:
+            self._sniff()
+        if self.error:
+            raise UploadRejectedError(self.error)
+        if self._upload_id is None:
+            # Smaller than one part: a single PUT straight to the final key.
+            s3_client.put_object(Bucket=R2_BUCKET_NAME, Key=object_key, Body=bytes(self._buffer), ContentType=self.content_type)
         else:
-            error_msg = f"An S3 client error occurred during resume deletion: {e}"
-            print(f"Deletion Error: {error_msg}")
-            return False, error_msg
-    except Exception as e:
-        error_msg = f"An unexpected error occurred during resume deletion: {e}"
-        print(f"Deletion Error: {error_msg}")
-        return False, error_msg
+            if self._buffer:
+                self._send_part(bytes(self._buffer))
+            self._wait_for_part()
+            if self.error:
+                raise UploadRejectedError(self.error)
+            s3_client.complete_multipart_upload(
+                Bucket=R2_BUCKET_NAME, Key=self.staging_key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+            self._upload_id = None
+            s3_client.copy_object(
+                Bucket=R2_BUCKET_NAME, Key=object_key, ContentType=self.content_type,
+                CopySource={'Bucket': R2_BUCKET_NAME, 'Key': self.staging_key}, MetadataDirective='REPLACE'
+            )
+            s3_client.delete_object(Bucket=R2_BUCKET_NAME, Key=self.staging_key)
+        self._buffer = bytearray()
+        self._finished = True
+        r2_upload_stats.record(self.size, time.monotonic() - self.started_at, succeeded=True)
+
+    def close(self):
+        if not self._finished:
+            self._abort()
+        super().close()
+
+class StreamingUploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        kind = STREAMING_UPLOAD_ENDPOINTS.get(self.endpoint)
+        if R2_STREAMING_UPLOADS_ENABLED and kind and s3_client:
+            return R2StreamingUpload(kind, content_type)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = StreamingUploadRequest
 
 # --- Unique ID Generation Helper ---
+# Legacy IDs used a random 5-digit suffix; sequential IDs are wider so the two can never collide.
+ID_COUNTER_DIGITS = 7
+
+class IdAllocator:
+    """Hands out sequential IDs from blocks reserved with one transaction on 'id_blocks/<id_type>'.
+
+    Each worker owns the blocks it reserved, so IDs are unique across workers without a
+    lookup per ID. IDs left in a block when the worker exits are simply never used.
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._type_locks = {}
+        self._blocks = {}
+
+    def _reserve_block(self, id_type):
+        end = id_registry.reserve_block(id_type, self.block_size)
+        return [end - self.block_size + 1, end]
+
+    def next_id(self, prefix, id_type):
+        with self._lock:
+            type_lock = self._type_locks.setdefault(id_type, threading.Lock())
+        with type_lock:
+            block = self._blocks.get(id_type)
+            if block is None or block[0] > block[1]:
+                block = self._blocks[id_type] = self._reserve_block(id_type)
+            number = block[0]
+            block[0] += 1
+        return f"{prefix}{number:0{ID_COUNTER_DIGITS}d}"
+
+    def reset(self):
+        """Forgets reserved blocks, e.g. in a forked child that must not reuse its parent's IDs."""
+        self._lock = threading.Lock()
+        self._type_locks = {}
+        self._blocks = {}
+
+id_allocator = IdAllocator(ID_BLOCK_SIZE)
+os.register_at_fork(after_in_child=id_allocator.reset)
+
 def generate_unique_id(prefix, id_type):
-    id_ref = db.reference(f'existing_ids/{id_type}')
-    num_digits = 5
-    while True:
-        random_part = str(random.randint(0, 10**num_digits - 1)).zfill(num_digits)
-        new_id = f"{prefix}{random_part}"
-        if not id_ref.child(new_id).get():
-            return new_id
-
-# --- PDF Generation Logic (Unchanged) ---
-SIGNATURE_IMAGE_PATH = "seal.png"
-RUPEE_IMAGE_PATH = "rupee.png"
-
-def create_price_cell(amount_float, styles, is_bold=False):
-    font_name = 'Helvetica-Bold' if is_bold else 'Helvetica'
-    font_size = 11 if is_bold else 9
-    formatted_amount = f"{amount_float:,.2f}"
-    if not os.path.exists(RUPEE_IMAGE_PATH):
-        style = ParagraphStyle(name='fallbackPrice', fontName=font_name, fontSize=font_size, alignment=TA_RIGHT)
-        return Paragraph(f"₹ {formatted_amount}", style)
-    rupee_img = Image(RUPEE_IMAGE_PATH, width=font_size, height=font_size)
-    rupee_img.hAlign = 'LEFT'
-    text_style = ParagraphStyle(name='priceText', fontName=font_name, fontSize=font_size, alignment=TA_RIGHT)
-    amount_para = Paragraph(formatted_amount, text_style)
-    inner_table = Table(
-        [[rupee_img, amount_para]],
-        colWidths=[font_size + 2, None],
-        style=TableStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('LEFTPADDING', (0, 0), (-1, -1), 0), ('RIGHTPADDING', (0, 0), (-1, -1), 0)])
-    )
-    return inner_table
-
-def create_modern_invoice(order_data, user_data, path_or_buffer, title="Tax Invoice"):
-    doc = SimpleDocTemplate(path_or_buffer, pagesize=A4, rightMargin=0.5*inch, leftMargin=0.5*inch, topMargin=0.5*inch, bottomMargin=0.5*inch)
-    story = []
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name='MainTitle', fontName='Helvetica-Bold', fontSize=22, alignment=TA_LEFT, textColor=colors.HexColor('#005A9C')))
-    styles.add(ParagraphStyle(name='RightAlignText', fontName='Helvetica', fontSize=10, alignment=TA_RIGHT, leading=14))
-    styles.add(ParagraphStyle(name='AddressHeader', fontName='Helvetica-Bold', fontSize=10, alignment=TA_LEFT))
-    styles.add(ParagraphStyle(name='AddressBody', fontName='Helvetica', fontSize=10, alignment=TA_LEFT, leading=14))
-    styles.add(ParagraphStyle(name='TableHeader', fontName='Helvetica-Bold', fontSize=9, alignment=TA_CENTER, textColor=colors.white))
-    styles.add(ParagraphStyle(name='FooterText', fontName='Helvetica', fontSize=8, alignment=TA_CENTER, textColor=colors.grey))
-    styles.add(ParagraphStyle(name='CompanyBrand', fontName='Helvetica-Bold', fontSize=11, alignment=TA_CENTER))
-    styles.add(ParagraphStyle(name='SignatureText', fontName='Helvetica', fontSize=10, alignment=TA_CENTER))
-    id_text = f"Order ID: {order_data['orderId']}<br/>Invoice ID: {order_data['invoiceId']}"
-    if title == "Return Invoice" and 'returnInvoiceId' in order_data:
-        id_text += f"<br/>Return ID: {order_data['returnInvoiceId']}"
-    header_data = [
-        [Paragraph(title, styles['MainTitle']), Paragraph(id_text, styles['RightAlignText'])],
-        ['', Paragraph(f"Date: {datetime.now().strftime('%d-%b-%Y')}", styles['RightAlignText'])]
-    ]
-    story.append(Table(header_data, colWidths=[4*inch, 3.5*inch], style=TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP')])))
-    story.append(Spacer(1, 0.25 * inch))
-    if title == "Return Invoice" and 'returnDetails' in order_data:
-        addr = order_data['returnDetails'].get('pickupAddress', order_data['shippingAddress'])
-    else:
-        addr = order_data['shippingAddress']
-    address_content = f"{user_data.get('name', '')}<br/>{addr.get('address', '')},<br/>{addr.get('city', '')}, {addr.get('state', '')} - {addr.get('pincode', '')}<br/>{addr.get('country', '')}"
-    address_data = [[Paragraph('Sold By', styles['AddressHeader']), Paragraph('Shipping Address', styles['AddressHeader'])], [Paragraph("<b>NILA PRODUCTS</b><br/>14/1-1 Andal Avenue, Vellalore<br/>Coimbatore, Tamil Nadu, 641111<br/><b>GSTIN:</b> 33AQGPM1414L2ZZ", styles['AddressBody']), Paragraph(address_content, styles['AddressBody'])]]
-    story.append(Table(address_data, colWidths=[3.75*inch, 3.75*inch], style=TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey), ('PADDING', (0,0), (-1,-1), 10)])))
-    story.append(Spacer(1, 0.3 * inch))
-    table_header = [Paragraph(h, styles['TableHeader']) for h in ['Product', 'Description', 'Qty', 'Amount', 'CGST (2.5%)', 'SGST (2.5%)', 'Total']]
-    col_widths = [1.5*inch, 2.0*inch, 0.4*inch, 0.9*inch, 0.9*inch, 0.9*inch, 0.9*inch]
-    table_data = [table_header]
-    grand_total_amount, total_tax_amount, total_base_amount = 0.0, 0.0, 0.0
-    for item in order_data['items']:
-        base_price = item['price'] * item['quantity']
-        cgst, sgst = base_price * 0.025, base_price * 0.025
-        total_item_price = base_price + cgst + sgst
-        row = [ Paragraph(item['name'], styles['Normal']), Paragraph(item.get('description', 'N/A'), styles['Normal']), item['quantity'], create_price_cell(base_price, styles), create_price_cell(cgst, styles), create_price_cell(sgst, styles), create_price_cell(total_item_price, styles) ]
-        total_base_amount += base_price
-        total_tax_amount += (cgst + sgst)
-        grand_total_amount += total_item_price
-        table_data.append(row)
-    items_table = Table(table_data, colWidths=col_widths, style=TableStyle([('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#005A9C')), ('GRID', (0, 0), (-1, -1), 1, colors.lightgrey), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.whitesmoke, colors.white]), ('ALIGN', (2, 1), (2, -1), 'CENTER'), ('ALIGN', (3, 1), (-1, -1), 'RIGHT')]))
-    story.append(items_table)
-    story.append(Spacer(1, 0.3 * inch))
-    totals_data = [
-        [Paragraph('Subtotal:', styles['RightAlignText']), create_price_cell(total_base_amount, styles)],
-        [Paragraph('Tax (CGST+SGST):', styles['RightAlignText']), create_price_cell(total_tax_amount, styles)],
-        [Paragraph('<b>Grand Total:</b>', styles['RightAlignText']), create_price_cell(grand_total_amount, styles, is_bold=True)],
-    ]
-    totals_table = Table(totals_data, colWidths=[1.5*inch, 1.5*inch], style=TableStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('ALIGN', (0, 0), (-1, -1), 'RIGHT'), ('FONTSIZE', (0,0), (-1,-1), 10)]))
-    signature_section = ''
-    if os.path.exists(SIGNATURE_IMAGE_PATH):
-        signature_img = Image(SIGNATURE_IMAGE_PATH, width=1.2*inch, height=0.8*inch)
-        signature_section = Table([[signature_img], [Paragraph("For NILA PRODUCTS", styles['SignatureText'])], [Paragraph("<i>Authorized Seal</i>", styles['SignatureText'])]], style=TableStyle([('ALIGN', (0,0), (-1,-1), 'CENTER')]))
-    summary_table = Table([[signature_section, totals_table]], colWidths=[4.5*inch, 3*inch], style=TableStyle([('VALIGN', (0,0), (-1,-1), 'BOTTOM')]))
-    story.append(summary_table)
-    story.append(Spacer(1, 0.5 * inch))
-    story.append(Table([[Paragraph("Generated via", styles['FooterText'])], [Paragraph("NILA PRODUCTS", styles['CompanyBrand'])]], colWidths=[7.5*inch]))
-    story.append(Spacer(1, 0.1 * inch))
-    story.append(Paragraph("This is a computer-generated document.", styles['FooterText']))
-    doc.build(story)
-    print(f"Document '{title}' successfully generated in-memory.")
-    return path_or_buffer
+    return id_allocator.next_id(prefix, id_type)
 
-# --- Email and Validation functions (Modified for Security) ---
-def send_otp_email(receiver_email, otp):
-    sender_email = GMAIL_SENDER_EMAIL
-    sender_password = GMAIL_SENDER_PASSWORD
-    if not all([sender_email, sender_password]):
-        print("⚠️ Email credentials are not configured in environment.")
-        return False
-    msg = MIMEText(f"""<html><body style="font-family: Arial, sans-serif; color: #222;"><div style="max-width: 480px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; box-shadow: 0 2px 8px #e0e0e0; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">NILA Products Portal - OTP Verification</h2><p>Dear User,</p><p>We received a request to sign up or log in to your NILA Products account.</p><p style="font-size: 1.1em; margin: 24px 0;"><strong>Your One-Time Password (OTP) is:</strong><span style="display: inline-block; background: #e3f7fa; color: #00bcd4; font-size: 1.5em; letter-spacing: 4px; padding: 10px 24px; border-radius: 8px; margin-left: 10px;">{otp}</span></p><p>This OTP is valid for <strong>5 minutes</strong>. Please do not share this code with anyone.</p><p>If you did not request this, you can safely ignore this email.</p><br><p style="color: #888; font-size: 0.95em;">Thank you,<br>NILA Products Team</p></div></body></html>""", "html")
-    msg['Subject'] = 'Your NILA OTP Code'
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
+# --- Multi-Location Commit Builder ---
+class MultiPathCommit:
+    """Collects writes to several RTDB locations and applies them as one atomic update.
+
+    Either every location is written or none is, and the whole batch costs a single
+    round-trip. Paths are relative to the database root and must not overlap.
+    """
+
+    def __init__(self):
+        self.updates = {}
+
+    def set(self, path, value):
+        self.updates[path] = value
+        return self
+
+    def delete(self, path):
+        self.updates[path] = None
+        return self
+
+    def increment(self, path, delta=1):
+        self.updates[path] = {'.sv': {'increment': delta}}
+        return self
+
+    def register_id(self, id_type, new_id):
+        """Records new_id in the existing_ids registry as part of this commit."""
+        self.updates[f'existing_ids/{id_type}/{new_id}'] = True
+        return self
+
+    def commit(self):
+        if self.updates:
+            datastore.reference().update(self.updates)
+
+def build_order_commit(safe_email_key, order_data):
+    """Order record, cart clear, order counter and ID registry entries for one checkout."""
+    order_id = order_data['orderId']
+    return (MultiPathCommit()
+            .set(order_store.path(safe_email_key, order_id), order_data)
+            .set(cart_store.path(safe_email_key), [])
+            .increment(f'{user_store.path(safe_email_key)}/orders')
+            .register_id('orders', order_id)
+            .register_id('invoices', order_data['invoiceId']))
+
+# --- SMTP Connection Pool ---
+class SMTPConnectionPool:
+    """Shares a bounded set of logged-in SMTP sessions between all senders.
+
+    Sessions are reused across messages instead of paying a TLS handshake and login
+    per email. A session that sat idle is checked with NOOP before reuse, and one that
+    turns out to be dead is replaced transparently.
+    """
+
+    def __init__(self, host, port, size, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.use_ssl = use_ssl
+        self.reset()
+
+    def reset(self):
+        """Drops every pooled session, e.g. in a forked child that must not share its parent's sockets."""
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _connect(self):
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        server = smtp_class(self.host, self.port, timeout=30)
+        server.login(GMAIL_SENDER_EMAIL, GMAIL_SENDER_PASSWORD)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _checkout(self):
+        while True:
+            try:
+                server, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            idle_for = time.monotonic() - last_used
+            if idle_for > SMTP_MAX_IDLE_SECONDS:
+                self._close(server)
+                continue
+            if idle_for > SMTP_NOOP_AFTER_SECONDS:
+                try:
+                    if server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected('NOOP rejected')
+                except (smtplib.SMTPException, OSError):
+                    self._close(server)
+                    continue
+            return server
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            server = self._checkout()
+            try:
+                yield server
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, OSError):
+                self._close(server)
+                raise
+            except Exception:
+                self._idle.put((server, time.monotonic()))
+                raise
+            else:
+                self._idle.put((server, time.monotonic()))
+
+    def sendmail(self, sender, recipients, message):
+        with timed_call('smtp', 'sendmail', self.host):
+            try:
+                with self.connection() as server:
+                    return server.sendmail(sender, recipients, message)
+            except smtplib.SMTPServerDisconnected:
+                # The server may close a pooled session at any time; retry once on a fresh one.
+                with self.connection() as server:
+                    return server.sendmail(sender, recipients, message)
+
+smtp_pool = SMTPConnectionPool(SMTP_HOST, SMTP_PORT, SMTP_POOL_SIZE, use_ssl=SMTP_USE_SSL)
+os.register_at_fork(after_in_child=smtp_pool.reset)
+
+# --- Invoice Cache ---
+class InvoiceCache:
+    """Content-addressed store for rendered invoice PDFs.
+
+    Lookups go through an in-memory LRU bounded by INVOICE_CACHE_MAX_BYTES, then the
+    optional disk (INVOICE_CACHE_DIR) and R2 (INVOICE_CACHE_R2_PREFIX) tiers. Hits in a
+    lower tier are promoted to memory.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None, r2_prefix=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.r2_prefix = r2_prefix.rstrip('/') if r2_prefix else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key_for(order_data, user_data, title):
+        """Hash of everything that ends up on the rendered document."""
+        content = {'order': order_data, 'name': user_data.get('name', ''), 'title': title}
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _remember(self, key, pdf_bytes):
+        if len(pdf_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = pdf_bytes
+            self._size += len(pdf_bytes)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            pdf_bytes = self._entries.get(key)
+            if pdf_bytes is not None:
+                self._entries.move_to_end(key)
+                return pdf_bytes
+        pdf_bytes = self._get_from_disk(key) or self._get_from_r2(key)
+        if pdf_bytes is not None:
+            self._remember(key, pdf_bytes)
+        return pdf_bytes
+
+    def put(self, key, pdf_bytes):
+        self._remember(key, pdf_bytes)
+        self._put_on_disk(key, pdf_bytes)
+        self._put_in_r2(key, pdf_bytes)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pdf")
+
+    def _get_from_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            print(f"Invoice cache disk read error: {e}")
+            return None
+
+    def _put_on_disk(self, key, pdf_bytes):
+        if not self.cache_dir:
+            return
+        tmp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(pdf_bytes)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            print(f"Invoice cache disk write error: {e}")
+
+    def _get_from_r2(self, key):
+        if not self.r2_prefix or not s3_client:
+            return None
+        try:
+            return s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=f"{self.r2_prefix}/{key}.pdf")['Body'].read()
+        except botocore_exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                print(f"Invoice cache R2 read error: {e}")
+            return None
+        except Exception as e:
+            print(f"Invoice cache R2 read error: {e}")
+            return None
+
+    def _put_in_r2(self, key, pdf_bytes):
+        if not self.r2_prefix or not s3_client:
+            return
+        try:
+            s3_client.put_object(Bucket=R2_BUCKET_NAME, Key=f"{self.r2_prefix}/{key}.pdf", Body=pdf_bytes, ContentType='application/pdf')
+        except Exception as e:
+            print(f"Invoice cache R2 write error: {e}")
+
+invoice_cache = InvoiceCache(INVOICE_CACHE_MAX_BYTES, INVOICE_CACHE_DIR, INVOICE_CACHE_R2_PREFIX)
+
+# --- Invoice Rendering Pool ---
+class InvoiceRenderTimeout(Exception):
+    """Raised when the render pool has no free slot or a render overruns INVOICE_RENDER_TIMEOUT_SECONDS."""
+
+class InvoiceRenderPool:
+    """Bounded pool of worker processes that render invoices off the request worker.
+
+    Workers are spawned (not forked from a threaded worker) and import ReportLab and build
+    the invoice styles once at start-up. When the pool is disabled or broken, rendering
+    falls back to the calling thread. When it is saturated or a render is too slow,
+    InvoiceRenderTimeout is raised instead: a render already running in a worker process
+    cannot be cancelled, so it keeps its slot until it finishes, and rendering the same
+    invoice inline as well would only add to the load that made it slow.
+
+    Bulk renders (exports and pre-renders) also take one of at most half the slots, so
+    they queue among themselves and interactive downloads always find a slot.
+    """
+
+    def __init__(self, processes, timeout_seconds):
+        self.processes = processes
+        self.timeout_seconds = timeout_seconds
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(max(processes, 1) * 2)
+        self._bulk_slots = threading.BoundedSemaphore(max(processes, 1))
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=invoice_pdf.warm_up
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, slots):
+        for slot in slots:
+            slot.release()
+
+    def render(self, order_data, user_data, title, bulk=False):
+        if self.processes <= 0:
+            return invoice_pdf.render_invoice_bytes(order_data, user_data, title)
+        held = []
+        for slots in ([self._bulk_slots, self._slots] if bulk else [self._slots]):
+            if not slots.acquire(timeout=self.timeout_seconds):
+                self._release(held)
+                raise InvoiceRenderTimeout(f"no render slot free within {self.timeout_seconds}s")
+            held.append(slots)
+        executor = None
+        try:
+            executor = self._get_executor()
+            future = executor.submit(invoice_pdf.render_invoice_bytes, order_data, user_data, title)
+            try:
+                return future.result(timeout=self.timeout_seconds)
+            except FutureTimeoutError:
+                # The worker process cannot be interrupted; its slots free up when it is done.
+                future.add_done_callback(lambda _, slots=held: self._release(slots))
+                held = []
+                raise InvoiceRenderTimeout(f"render took longer than {self.timeout_seconds}s")
+        except InvoiceRenderTimeout:
+            raise
+        except BrokenProcessPool as e:
+            print(f"Invoice render pool broke ({e}); restarting it and rendering inline.")
+            self._discard(executor)
+        except Exception as e:
+            print(f"Invoice render pool unavailable ({e}); rendering inline.")
+        finally:
+            self._release(held)
+        return invoice_pdf.render_invoice_bytes(order_data, user_data, title)
+
+    def warm_up(self):
+        """Starts every worker process ahead of the first invoice request."""
+        if self.processes > 0:
+            executor = self._get_executor()
+            for future in [executor.submit(invoice_pdf.warm_up) for _ in range(self.processes)]:
+                future.result(timeout=self.timeout_seconds)
+
+invoice_render_pool = InvoiceRenderPool(INVOICE_RENDER_PROCESSES, INVOICE_RENDER_TIMEOUT_SECONDS)
+
+def render_invoice_pdf(order_data, user_data, title="Tax Invoice", remember=True):
+    """Returns the invoice PDF as bytes, rendering it only if no cache tier has it yet.
+
+    remember=False skips storing a fresh render, for bulk jobs that would otherwise
+    flush the cache with invoices nobody is about to download; such renders also count
+    against the render pool's bulk share.
+    """
+    key = InvoiceCache.key_for(order_data, user_data, title)
+    pdf_bytes = invoice_cache.get(key)
+    if pdf_bytes is not None:
+        return pdf_bytes
+    pdf_bytes = invoice_render_pool.render(order_data, user_data, title, bulk=not remember)
+    if remember:
+        invoice_cache.put(key, pdf_bytes)
+    return pdf_bytes
+
+# --- Invoice Pre-rendering ---
+class InvoicePrerenderer:
+    """Renders Tax Invoices after checkout on a background thread and stores them in R2."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='invoice-prerender')
+                self._pid = os.getpid()
+            return self._executor
+
+    def schedule(self, safe_email_key, order_id, user_name):
+        if not INVOICE_PRERENDER_ENABLED or not s3_client:
+            return
+        self._get_executor().submit(self._prerender, safe_email_key, order_id, user_name)
+
+    @staticmethod
+    def object_key(safe_email_key, order_data):
+        return f"invoices/{safe_email_key}/{order_data['orderId']}/NILA-Invoice-{order_data['invoiceId']}.pdf"
+
+    def _prerender(self, safe_email_key, order_id, user_name):
+        try:
+            # Read the order back so server-side values such as orderDate are resolved.
+            order_data = order_store.get(safe_email_key, order_id)
+            if not order_data:
+                print(f"Skipping invoice pre-render: order {order_id} not found.")
+                return
+            pdf_bytes = render_invoice_pdf(order_data, {'name': user_name}, title="Tax Invoice", remember=False)
+            object_key = self.object_key(safe_email_key, order_data)
+            s3_client.put_object(Bucket=R2_BUCKET_NAME, Key=object_key, Body=pdf_bytes, ContentType='application/pdf')
+            order_store.set_field(safe_email_key, order_id, 'invoiceObjectKey', object_key)
+            print(f"Pre-rendered invoice for order {order_id} stored at {object_key}.")
+        except Exception as e:
+            print(f"Error pre-rendering invoice for order {order_id}: {e}")
+
+invoice_prerenderer = InvoicePrerenderer(INVOICE_PRERENDER_WORKERS)
+
+def stored_invoice_response(object_key, download_name):
+    """Serves a pre-rendered invoice from R2, or returns None so the caller renders it instead."""
+    if not s3_client:
+        return None
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        print(f"OTP sent to {receiver_email}")
+        if INVOICE_STORED_DELIVERY == 'stream':
+            body = s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=object_key)['Body']
+            return send_file(io.BytesIO(body.read()), as_attachment=True, download_name=download_name, mimetype='application/pdf')
+        url = s3_client.generate_presigned_url('get_object', Params={
+            'Bucket': R2_BUCKET_NAME, 'Key': object_key,
+            'ResponseContentDisposition': f'attachment; filename="{download_name}"',
+            'ResponseContentType': 'application/pdf'
+        }, ExpiresIn=INVOICE_DOWNLOAD_URL_EXPIRY_SECONDS)
+        return redirect(url)
+    except Exception as e:
+        print(f"Could not serve stored invoice {object_key}: {e}")
+        return None
+
+# --- Bulk Invoice Export ---
+class ZipOutputStream(io.RawIOBase):
+    """Write-only sink for zipfile that hands back what was written since the last drain."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
         return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def invoices_for_export(start, end):
+    """Yields (zip_name, order_data, user_data, title) for every invoice of an order placed in [start, end).
+
+    Users are read one at a time as the caller asks for more, so only the shallow list of
+    user keys and one user's order history are held at once.
+    """
+    start_ms, end_ms = start.timestamp() * 1000, end.timestamp() * 1000
+    for safe_email_key in sorted(user_store.keys()):
+        order_history = order_store.history(safe_email_key)
+        if not order_history:
+            continue
+        user_data = {'name': user_store.get_name(safe_email_key) or ''}
+        for order_id, order_data in sorted(order_history.items()):
+            order_date = order_data.get('orderDate')
+            if not isinstance(order_date, (int, float)) or not start_ms <= order_date < end_ms:
+                continue
+            yield (f"{safe_email_key}/NILA-Invoice-{order_data.get('invoiceId', order_id)}.pdf", order_data, user_data, "Tax Invoice")
+            if 'returnInvoiceId' in order_data and order_data.get('status') in ['Return Requested', 'Returned']:
+                yield (f"{safe_email_key}/NILA-Return-Invoice-{order_data['returnInvoiceId']}.pdf", order_data, user_data, "Return Invoice")
+
+def stream_invoice_zip(export_id, start, end):
+    """Yields a ZIP of the invoices for orders placed in [start, end) chunk by chunk.
+
+    Users are walked as the archive is written, so the first invoice goes out before the
+    rest are found. At most INVOICE_EXPORT_CONCURRENCY renders are in flight, and no new
+    ones start while finished-but-unwritten PDFs exceed INVOICE_EXPORT_MAX_BUFFER_BYTES.
+    Progress is kept in 'invoice_exports/<export_id>'; 'total' counts the invoices found
+    so far and is final once 'listed' is true.
+    """
+    progress_ref = datastore.reference(f'invoice_exports/{export_id}')
+    progress = {'status': 'running', 'total': 0, 'listed': False, 'done': 0, 'failed': 0, 'bytes': 0}
+
+    def report(final=False):
+        if final or progress['done'] % 25 == 0:
+            try:
+                progress_ref.update(progress)
+            except Exception as e:
+                print(f"Could not record progress for export {export_id}: {e}")
+
+    try:
+        # startedAt is written once; report() re-sends only the counters.
+        progress_ref.set(dict(progress, startedAt={'.sv': 'timestamp'}))
     except Exception as e:
-        print(f"Email send error: {e}")
-        return False
+        print(f"Could not record progress for export {export_id}: {e}")
+    stream = ZipOutputStream()
+    failures = []
+    pending = deque()
+    remaining = invoices_for_export(start, end)
+    executor = ThreadPoolExecutor(max_workers=INVOICE_EXPORT_CONCURRENCY, thread_name_prefix=f'export-{export_id[:8]}')
+    try:
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+            while True:
+                buffered = sum(len(f.result()) for _, f in pending if f.done() and not f.exception())
+                while len(pending) < INVOICE_EXPORT_CONCURRENCY and buffered < INVOICE_EXPORT_MAX_BUFFER_BYTES:
+                    job = next(remaining, None)
+                    if job is None:
+                        progress['listed'] = True
+                        break
+                    progress['total'] += 1
+                    zip_name, order_data, user_data, title = job
+                    pending.append((zip_name, executor.submit(render_invoice_pdf, order_data, user_data, title, False)))
+                if not pending:
+                    break
+                zip_name, future = pending.popleft()
+                try:
+                    archive.writestr(zip_name, future.result())
+                except Exception as e:
+                    failures.append(f"{zip_name}: {e}")
+                    progress['failed'] += 1
+                progress['done'] += 1
+                chunk = stream.drain()
+                progress['bytes'] += len(chunk)
+                report()
+                yield chunk
+            if failures:
+                archive.writestr('export_errors.txt', "\n".join(failures))
+        chunk = stream.drain()
+        progress['bytes'] += len(chunk)
+        progress['status'] = 'completed'
+        yield chunk
+    except GeneratorExit:
+        progress['status'] = 'cancelled'
+        raise
+    except Exception as e:
+        progress['status'] = 'failed'
+        print(f"Invoice export {export_id} failed: {e}")
+        raise
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        report(final=True)
+        print(f"Invoice export {export_id} {progress['status']}: {progress['done'] - progress['failed']}/{progress['total']} invoices, {progress['bytes']} bytes.")
+
+# --- Email Outbox ---
+def deliver_email(receiver_email, message):
+    """Sends an already serialized message through the shared SMTP pool. Raises on failure."""
+    smtp_pool.sendmail(GMAIL_SENDER_EMAIL, [receiver_email], message)
+
+class EmailOutbox:
+    """Durable queue of outgoing emails, delivered off the request path by worker threads.
+
+    Entries live under 'email_outbox/pending' until delivered, then move to
+    'email_outbox/sent' or, after EMAIL_MAX_ATTEMPTS failures, 'email_outbox/failed'.
+    An entry records the template kind and its parameters, never the rendered message;
+    the message is built from EMAIL_TEMPLATES at delivery, and the sent/failed records
+    keep only the recipient, kind, subject and attempt count.
+
+    Every pending entry carries a lease; entries whose lease has expired (their worker
+    died) are claimed and delivered by whichever worker sweeps the outbox next. Delivery
+    is at-least-once: a worker that dies after SMTP accepted a message but before the
+    entry moved to 'sent' leaves it to be sent again once the lease runs out.
+
+    Non-durable entries (OTP codes) are kept in memory only and are lost with the worker.
+    """
 
-def send_account_created_email(receiver_email, name):
-    sender_email = GMAIL_SENDER_EMAIL
-    sender_password = GMAIL_SENDER_PASSWORD
-    if not all([sender_email, sender_password]):
+    def __init__(self, worker_count, max_attempts, backoff_seconds, lease_seconds):
+        self.worker_count = worker_count
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pid = None
+
+    def start(self):
+        """Starts this process's delivery and sweeper threads; a no-op if they are already running."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads do not survive fork, so every worker process starts its own pool.
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            for i in range(self.worker_count):
+                threading.Thread(target=self._work, name=f'email-outbox-{i}', daemon=True).start()
+            threading.Thread(target=self._sweep, name='email-outbox-sweeper', daemon=True).start()
+
+    def enqueue(self, receiver_email, kind, params, durable=True):
+        """Schedules a `kind` email rendered from params, recording it in the outbox first if
+        durable. Returns True once it is queued."""
+        self.start()
+        entry = {
+            'id': uuid.uuid4().hex, 'to': receiver_email, 'kind': kind, 'params': params,
+            'attempts': 0, 'status': 'pending', 'durable': durable,
+            'leaseUntil': time.time() + self.lease_seconds, 'createdAt': {'.sv': 'timestamp'}
+        }
+        if durable:
+            try:
+                datastore.reference(f"email_outbox/pending/{entry['id']}").set(entry)
+            except Exception as e:
+                # Delivery can still proceed from memory; only crash recovery is lost.
+                print(f"⚠️ Could not record {kind} email for {receiver_email} in outbox: {e}")
+        self._queue.put(entry)
+        return True
+
+    def _work(self):
+        while True:
+            entry = self._queue.get()
+            try:
+                self._deliver(entry)
+            except Exception as e:
+                print(f"Email outbox worker error: {e}")
+
+    def _deliver(self, entry):
+        entry_id = entry['id']
+        entry['attempts'] += 1
+        try:
+            msg = build_email(entry['to'], entry['kind'], entry['params'])
+            entry['subject'] = msg['Subject']
+            deliver_email(entry['to'], msg.as_string())
+        except Exception as e:
+            if entry['attempts'] >= self.max_attempts:
+                print(f"❌ ERROR: Giving up on {entry['kind']} email to {entry['to']} after {entry['attempts']} attempts: {e}")
+                self._finish(entry, 'failed', {'lastError': str(e)})
+                return
+            delay = self.backoff_seconds * (2 ** (entry['attempts'] - 1))
+            print(f"{entry['kind']} email to {entry['to']} failed (attempt {entry['attempts']}), retrying in {delay:.0f}s: {e}")
+            entry['status'] = 'retrying'
+            entry['leaseUntil'] = time.time() + delay + self.lease_seconds
+            if entry.get('durable', True):
+                try:
+                    datastore.reference(f'email_outbox/pending/{entry_id}').update({
+                        'attempts': entry['attempts'], 'status': 'retrying',
+                        'lastError': str(e), 'leaseUntil': entry['leaseUntil']
+                    })
+                except Exception as db_error:
+                    print(f"⚠️ Could not update outbox entry {entry_id}: {db_error}")
+            timer = threading.Timer(delay, self._queue.put, args=(entry,))
+            timer.daemon = True
+            timer.start()
+            return
+        print(f"{entry['kind']} email sent to {entry['to']}")
+        self._finish(entry, 'sent', {'sentAt': {'.sv': 'timestamp'}})
+
+    def _finish(self, entry, status, extra):
+        if not entry.get('durable', True):
+            return
+        record = {'to': entry['to'], 'kind': entry['kind'], 'subject': entry.get('subject'), 'attempts': entry['attempts'], 'status': status}
+        record.update(extra)
+        try:
+            (MultiPathCommit()
+                .delete(f"email_outbox/pending/{entry['id']}")
+                .set(f"email_outbox/{status}/{entry['id']}", record)
+                .commit())
+        except Exception as e:
+            print(f"⚠️ Could not record {status} status for outbox entry {entry['id']}: {e}")
+
+    def _claim(self, entry_id):
+        """Takes over an abandoned pending entry; returns it, or None if another worker holds it."""
+        lease_until = time.time() + self.lease_seconds
+        def take_lease(current):
+            if not current or current.get('leaseUntil', 0) > time.time():
+                raise LookupError(entry_id)
+            return dict(current, leaseUntil=lease_until)
+        try:
+            return datastore.reference(f'email_outbox/pending/{entry_id}').transaction(take_lease)
+        except (LookupError, db.TransactionAbortedError):
+            return None
+
+    def recover(self):
+        """Re-queues pending entries whose lease has expired. Returns how many were claimed."""
+        pending = datastore.reference('email_outbox/pending').get() or {}
+        claimed = 0
+        for entry_id, entry in pending.items():
+            if entry.get('leaseUntil', 0) > time.time():
+                continue
+            entry = self._claim(entry_id)
+            if entry:
+                self._queue.put(dict(entry, id=entry_id))
+                claimed += 1
+        if claimed:
+            print(f"Recovered {claimed} undelivered emails from the outbox.")
+        return claimed
+
+    def _sweep(self):
+        while True:
+            try:
+                self.recover()
+            except Exception as e:
+                print(f"Email outbox sweep error: {e}")
+            time.sleep(self.lease_seconds / 2)
+
+email_outbox = EmailOutbox(EMAIL_WORKER_COUNT, EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_BACKOFF_SECONDS, EMAIL_OUTBOX_LEASE_SECONDS)
+
+# --- Email and Validation functions (Modified for Security) ---
+# Each template turns the parameters recorded in the outbox into (subject, HTML body), so only
+# the parameters are stored and the message is built when it is delivered.
+EMAIL_TEMPLATES = {}
+
+def email_template(kind):
+    def register(render):
+        EMAIL_TEMPLATES[kind] = render
+        return render
+    return register
+
+def build_email(receiver_email, kind, params):
+    """Renders an outbox entry into its message."""
+    subject, body = EMAIL_TEMPLATES[kind](**params)
+    msg = MIMEText(body, "html")
+    msg['Subject'] = subject
+    msg['From'] = GMAIL_SENDER_EMAIL
+    msg['To'] = receiver_email
+    return msg
+
+def email_configured():
+    if not all([GMAIL_SENDER_EMAIL, GMAIL_SENDER_PASSWORD]):
         print("⚠️ Email credentials are not configured in environment.")
         return False
-    msg = MIMEText(f"""<html><body style="font-family: Arial, sans-serif; color: #222;"><div style="max-width: 480px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; box-shadow: 0 2px 8px #e0e0e0; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">🎉 Welcome to NILA Products!</h2><p>Dear <strong>{name}</strong>,</p><p>We are thrilled to let you know that your <b>NILA Products</b> account has been <span style="color:#00bcd4;font-weight:bold;">successfully created</span>!</p><ul style="margin: 18px 0 18px 1.2em; color: #444;"><li>Your <b>email</b> is your username for secure access.</li><li>Your <b>phone number</b> is linked for account recovery and notifications.</li><li>Enjoy seamless access to our textile commerce platform.</li></ul><p style="margin: 18px 0; color: #388e3c;"><b>✨ Explore, connect, and grow with NILA Products!</b></p><div style="margin: 24px 0; padding: 16px; background: #e3f7fa; border-radius: 8px; color: #00bcd4;"><b>Security Tip:</b> Never share your password or OTP with anyone.<br>For help, contact us at <a href="mailto:support@nilaproducts.com">support@nilaproducts.com</a>.</div><p style="color: #888; font-size: 0.95em;">Thank you for joining us,<br><strong>NILA Products Team</strong></p><div style="margin-top:18px;text-align:center;"><img src="https://img.icons8.com/color/96/000000/checked-2--v2.png" alt="Success" width="48" height="48"/></div></div></body></html>""", "html")
-    msg['Subject'] = '🎉 Your NILA Products Account is Ready!'
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        print(f"Account creation email sent to {receiver_email}")
-        return True
-    except Exception as e:
-        print(f"Account creation email send error: {e}")
+    return True
+
+@email_template('otp')
+def otp_email(otp):
+    return 'Your NILA OTP Code', f"""<html><body style="font-family: Arial, sans-serif; color: #222;"><div style="max-width: 480px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; box-shadow: 0 2px 8px #e0e0e0; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">NILA Products Portal - OTP Verification</h2><p>Dear User,</p><p>We received a request to sign up or log in to your NILA Products account.</p><p style="font-size: 1.1em; margin: 24px 0;"><strong>Your One-Time Password (OTP) is:</strong><span style="display: inline-block; background: #e3f7fa; color: #00bcd4; font-size: 1.5em; letter-spacing: 4px; padding: 10px 24px; border-radius: 8px; margin-left: 10px;">{otp}</span></p><p>This OTP is valid for <strong>5 minutes</strong>. Please do not share this code with anyone.</p><p>If you did not request this, you can safely ignore this email.</p><br><p style="color: #888; font-size: 0.95em;">Thank you,<br>NILA Products Team</p></div></body></html>"""
+
+def send_otp_email(receiver_email, otp):
+    if not email_configured():
         return False
+    # An OTP expires long before an outbox lease would let another worker retry it, so it is kept in memory only.
+    return email_outbox.enqueue(receiver_email, 'otp', {'otp': otp}, durable=False)
 
-def send_order_confirmation_email(receiver_email, name, order_data):
-    sender_email = GMAIL_SENDER_EMAIL
-    sender_password = GMAIL_SENDER_PASSWORD
-    if not all([sender_email, sender_password]):
-        print("⚠️ Email credentials are not configured in environment.")
+@email_template('account_created')
+def account_created_email(name):
+    return '🎉 Your NILA Products Account is Ready!', f"""<html><body style="font-family: Arial, sans-serif; color: #222;"><div style="max-width: 480px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; box-shadow: 0 2px 8px #e0e0e0; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">🎉 Welcome to NILA Products!</h2><p>Dear <strong>{name}</strong>,</p><p>We are thrilled to let you know that your <b>NILA Products</b> account has been <span style="color:#00bcd4;font-weight:bold;">successfully created</span>!</p><ul style="margin: 18px 0 18px 1.2em; color: #444;"><li>Your <b>email</b> is your username for secure access.</li><li>Your <b>phone number</b> is linked for account recovery and notifications.</li><li>Enjoy seamless access to our textile commerce platform.</li></ul><p style="margin: 18px 0; color: #388e3c;"><b>✨ Explore, connect, and grow with NILA Products!</b></p><div style="margin: 24px 0; padding: 16px; background: #e3f7fa; border-radius: 8px; color: #00bcd4;"><b>Security Tip:</b> Never share your password or OTP with anyone.<br>For help, contact us at <a href="mailto:support@nilaproducts.com">support@nilaproducts.com</a>.</div><p style="color: #888; font-size: 0.95em;">Thank you for joining us,<br><strong>NILA Products Team</strong></p><div style="margin-top:18px;text-align:center;"><img src="https://img.icons8.com/color/96/000000/checked-2--v2.png" alt="Success" width="48" height="48"/></div></div></body></html>"""
+
+def send_account_created_email(receiver_email, name):
+    if not email_configured():
         return False
+    return email_outbox.enqueue(receiver_email, 'account_created', {'name': name})
+
+@email_template('order_confirmation')
+def order_confirmation_email(name, order_data, order_date):
     items_html = ""
     total_base_amount = 0.0
     for item in order_data['items']:
@@ -358,80 +2328,53 @@ def send_order_confirmation_email(receiver_email, name, order_data):
     addr = order_data['shippingAddress']
     address_html = f"{addr.get('address', '')},<br>{addr.get('city', '')}, {addr.get('state', '')} - {addr.get('pincode', '')}<br>{addr.get('country', '')}"
     msg_body = f"""
-    <html><body style="font-family: Arial, sans-serif; color: #333;"><div style="max-width: 600px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">✅ Your NILA Order is Confirmed!</h2><p>Dear <strong>{name}</strong>,</p><p>Thank you for your purchase! We've received your order and are getting it ready for you. Here are the details:</p><div style="margin: 24px 0; padding: 16px; background: #fff; border-radius: 8px;"><h3 style="margin-top: 0; color: #555;">Order Summary</h3><p><strong>Order ID:</strong> {order_data['orderId']}<br><strong>Invoice ID:</strong> {order_data['invoiceId']}<br><strong>Order Date:</strong> {datetime.now().strftime('%d-%b-%Y %H:%M')}</p><table style="width: 100%; border-collapse: collapse; margin-top: 16px;"><thead><tr><th style='padding: 8px; background-color: #f2f2f2; text-align: left;'>Product</th><th style='padding: 8px; background-color: #f2f2f2; text-align: center;'>Quantity</th><th style='padding: 8px; background-color: #f2f2f2; text-align: right;'>Price</th></tr></thead><tbody>{items_html}</tbody></table><hr style="border: 0; border-top: 1px solid #eee; margin: 16px 0;"><p style="text-align: right;"><strong>Subtotal:</strong> ₹{total_base_amount:,.2f}</p><p style="text-align: right;"><strong>Tax (5%):</strong> ₹{tax_amount:,.2f}</p><p style="text-align: right; font-size: 1.2em;"><strong>Grand Total:</strong> ₹{grand_total:,.2f}</p></div><div style="margin: 24px 0; padding: 16px; background: #fff; border-radius: 8px;"><h3 style="margin-top: 0; color: #555;">Shipping Address</h3><p>{address_html}</p></div><p>You can view your order details and track its status from your dashboard.</p><p style="color: #888; font-size: 0.95em;">Thank you for shopping with us,<br><strong>NILA Products Team</strong></p></div></body></html>"""
-    msg = MIMEText(msg_body, "html")
-    msg['Subject'] = f"Order Confirmed: Your NILA Products Order #{order_data['orderId']}"
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        print(f"Order confirmation email sent to {receiver_email}")
-        return True
-    except Exception as e:
-        print(f"Order confirmation email send error: {e}")
-        return False
+    <html><body style="font-family: Arial, sans-serif; color: #333;"><div style="max-width: 600px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">✅ Your NILA Order is Confirmed!</h2><p>Dear <strong>{name}</strong>,</p><p>Thank you for your purchase! We've received your order and are getting it ready for you. Here are the details:</p><div style="margin: 24px 0; padding: 16px; background: #fff; border-radius: 8px;"><h3 style="margin-top: 0; color: #555;">Order Summary</h3><p><strong>Order ID:</strong> {order_data['orderId']}<br><strong>Invoice ID:</strong> {order_data['invoiceId']}<br><strong>Order Date:</strong> {order_date}</p><table style="width: 100%; border-collapse: collapse; margin-top: 16px;"><thead><tr><th style='padding: 8px; background-color: #f2f2f2; text-align: left;'>Product</th><th style='padding: 8px; background-color: #f2f2f2; text-align: center;'>Quantity</th><th style='padding: 8px; background-color: #f2f2f2; text-align: right;'>Price</th></tr></thead><tbody>{items_html}</tbody></table><hr style="border: 0; border-top: 1px solid #eee; margin: 16px 0;"><p style="text-align: right;"><strong>Subtotal:</strong> ₹{total_base_amount:,.2f}</p><p style="text-align: right;"><strong>Tax (5%):</strong> ₹{tax_amount:,.2f}</p><p style="text-align: right; font-size: 1.2em;"><strong>Grand Total:</strong> ₹{grand_total:,.2f}</p></div><div style="margin: 24px 0; padding: 16px; background: #fff; border-radius: 8px;"><h3 style="margin-top: 0; color: #555;">Shipping Address</h3><p>{address_html}</p></div><p>You can view your order details and track its status from your dashboard.</p><p style="color: #888; font-size: 0.95em;">Thank you for shopping with us,<br><strong>NILA Products Team</strong></p></div></body></html>"""
+    return f"Order Confirmed: Your NILA Products Order #{order_data['orderId']}", msg_body
 
-def send_application_confirmation_email(receiver_email, name, application_data, job_details):
-    sender_email = GMAIL_SENDER_EMAIL
-    sender_password = GMAIL_SENDER_PASSWORD
-    if not all([sender_email, sender_password]):
-        print("⚠️ Email credentials are not configured in environment.")
+def send_order_confirmation_email(receiver_email, name, order_data):
+    if not email_configured():
         return False
-    job_title = job_details.get('title', 'N/A')
-    job_location = job_details.get('location', 'N/A')
-    application_id = application_data.get('applicationId', 'N/A')
+    summary = {
+        'orderId': order_data['orderId'], 'invoiceId': order_data['invoiceId'],
+        'items': [{'name': item['name'], 'price': item['price'], 'quantity': item['quantity']} for item in order_data['items']],
+        'shippingAddress': order_data['shippingAddress']
+    }
+    return email_outbox.enqueue(receiver_email, 'order_confirmation', {
+        'name': name, 'order_data': summary, 'order_date': datetime.now().strftime('%d-%b-%Y %H:%M')
+    })
+
+@email_template('application_confirmation')
+def application_confirmation_email(name, job_title, job_location, application_id):
     msg_body = f"""
     <html><body style="font-family: Arial, sans-serif; color: #333;"><div style="max-width: 600px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">Application Received!</h2><p>Dear <strong>{name}</strong>,</p><p>Thank you for your interest in a career at NILA Products. We have successfully received your application for the following position:</p><div style="margin: 24px 0; padding: 16px; background: #e3f7fa; border-left: 4px solid #00bcd4; border-radius: 4px;"><p style="margin: 0; font-size: 1.2em; color: #00796b;"><strong>{job_title}</strong></p><p style="margin: 4px 0 0; color: #555;">Location: {job_location}</p></div><p>Your application ID is: <strong>{application_id}</strong>. Please keep this for your records.</p><p>Our talent acquisition team will review your qualifications and experience. If your profile matches our requirements, we will contact you for the next steps in the hiring process.</p><p>We appreciate you taking the time to apply.</p><p style="color: #888; font-size: 0.95em;">Best regards,<br><strong>The NILA Products Hiring Team</strong></p></div></body></html>"""
-    msg = MIMEText(msg_body, "html")
-    msg['Subject'] = f"Your Application for {job_title} at NILA Products"
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        print(f"Job application confirmation email sent to {receiver_email}")
-        return True
-    except Exception as e:
-        print(f"Job application confirmation email send error: {e}")
-        return False
+    return f"Your Application for {job_title} at NILA Products", msg_body
 
-def send_return_request_email(receiver_email, name, order_data):
-    sender_email = GMAIL_SENDER_EMAIL
-    sender_password = GMAIL_SENDER_PASSWORD
-    if not all([sender_email, sender_password]):
-        print("⚠️ Email credentials are not configured in environment.")
+def send_application_confirmation_email(receiver_email, name, application_data, job_details):
+    if not email_configured():
         return False
-    order_id = order_data.get('orderId', 'N/A')
-    return_id = order_data.get('returnInvoiceId', 'N/A')
-    reason = order_data.get('returnDetails', {}).get('reason', 'N/A')
+    return email_outbox.enqueue(receiver_email, 'application_confirmation', {
+        'name': name, 'job_title': job_details.get('title', 'N/A'), 'job_location': job_details.get('location', 'N/A'),
+        'application_id': application_data.get('applicationId', 'N/A')
+    })
+
+@email_template('return_request')
+def return_request_email(name, order_id, return_id, reason):
     msg_body = f"""
     <html><body style="font-family: Arial, sans-serif; color: #333;"><div style="max-width: 600px; margin: auto; border: 1px solid #e0e0e0; border-radius: 10px; padding: 32px 24px; background: #f9f9f9;"><h2 style="color: #00bcd4; margin-top: 0;">Return Request Initiated</h2><p>Dear <strong>{name}</strong>,</p><p>We have received your return request for your NILA Products order. Our team will review the details and get back to you shortly regarding the next steps for pickup and refund.</p><div style="margin: 24px 0; padding: 16px; background: #fff; border-radius: 8px;"><h3 style="margin-top: 0; color: #555;">Return Details</h3><p><strong>Original Order ID:</strong> {order_id}</p><p><strong>Return ID:</strong> {return_id}</p><p><strong>Reason for Return:</strong> {reason}</p></div><p>Please ensure the product is in its original condition with all tags and packaging intact for a smooth return process. You can track the status of your return request in your user dashboard.</p><p>If you have any questions, feel free to contact our customer support.</p><p style="color: #888; font-size: 0.95em;">Thank you,<br><strong>NILA Products Team</strong></p></div></body></html>"""
-    msg = MIMEText(msg_body, "html")
-    msg['Subject'] = f"Return Initiated for NILA Order #{order_id}"
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        print(f"Return request confirmation email sent to {receiver_email}")
-        return True
-    except Exception as e:
-        print(f"Return request confirmation email send error: {e}")
-        return False
+    return f"Return Initiated for NILA Order #{order_id}", msg_body
 
-def send_stock_notification_email(receiver_email, name, restocked_products):
-    sender_email = GMAIL_SENDER_EMAIL
-    sender_password = GMAIL_SENDER_PASSWORD
-    if not all([sender_email, sender_password]):
-        print("⚠️ Email credentials are not configured in environment.")
+def send_return_request_email(receiver_email, name, order_data):
+    if not email_configured():
         return False
-    
+    return email_outbox.enqueue(receiver_email, 'return_request', {
+        'name': name, 'order_id': order_data.get('orderId', 'N/A'), 'return_id': order_data.get('returnInvoiceId', 'N/A'),
+        'reason': order_data.get('returnDetails', {}).get('reason', 'N/A')
+    })
+
+@email_template('stock_notification')
+def stock_notification_email(name, products):
     product_list_html = ""
-    for product in restocked_products:
+    for product in products:
         product_list_html += f"<li style='margin-bottom: 10px;'><strong>{product['name']}</strong> - Price: ₹{product['price']:,}</li>"
 
     msg_body = f"""
@@ -450,20 +2393,13 @@ def send_stock_notification_email(receiver_email, name, restocked_products):
     </body>
     </html>
     """
-    
-    msg = MIMEText(msg_body, "html")
-    msg['Subject'] = "An item you wanted is back in stock!"
-    msg['From'] = sender_email
-    msg['To'] = receiver_email
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        print(f"Stock notification email sent to {receiver_email} for {len(restocked_products)} items.")
-        return True
-    except Exception as e:
-        print(f"Stock notification email send error: {e}")
+    return "An item you wanted is back in stock!", msg_body
+
+def send_stock_notification_email(receiver_email, name, restocked_products):
+    if not email_configured():
         return False
+    products = [{'name': product['name'], 'price': product['price']} for product in restocked_products]
+    return email_outbox.enqueue(receiver_email, 'stock_notification', {'name': name, 'products': products})
 
 
 def validate_email(email):
@@ -477,8 +2413,7 @@ def log_user_out_and_print_message():
     if user_email:
         try:
             safe_email_key = user_email.replace('.', '_')
-            user_ref = db.reference('users').child(safe_email_key)
-            user_data = user_ref.get()
+            user_data = user_store.get(safe_email_key)
             user_name = user_data.get('name', 'Unknown User') if user_data else user_email
             print(f"--- {user_name} logged out. Session cleared. ---")
         except Exception as e:
@@ -490,15 +2425,87 @@ def update_cart_in_db(user_email, cart_data):
         print("Error: user_email is missing for database cart update.")
         return False
     safe_email_key = user_email.replace('.', '_')
-    user_cart_ref = db.reference(f'users/{safe_email_key}/cart_items')
     try:
-        user_cart_ref.set(cart_data)
+        cart_store.save(safe_email_key, cart_data)
         print(f"Cart for {user_email} updated in database.")
         return True
     except Exception as e:
         print(f"Error updating cart for {user_email} in database: {e}")
         return False
 
+# --- Warm-up ---
+def warm_up():
+    """Imports and initializes Firebase, the R2 client and ReportLab now instead of on first use.
+
+    Runs at import when EAGER_WARMUP is set, so no request pays for a cold subsystem.
+    """
+    started_at = time.perf_counter()
+    if DATASTORE_BACKEND != 'memory':
+        init_firebase()
+        auth.load()
+    if s3_client is not None:
+        try:
+            s3_client.get()
+            s3_transfer.load()
+        except Exception as e:
+            print(f"❌ ERROR: Failed to initialize S3 client. Error: {e}")
+    invoice_pdf.warm_up()
+    print(f"✅ Warm-up finished in {time.perf_counter() - started_at:.2f}s.")
+
+if EAGER_WARMUP:
+    warm_up()
+
+# --- Preloading (gunicorn --preload) ---
+def load_shared_state():
+    """Loads read-only state in the gunicorn master so forked workers share it copy-on-write.
+
+    Imports firebase_admin, boto3 and ReportLab, parses the Firebase credentials, compiles
+    every template, builds the invoice styles and reads the catalog and careers listings.
+    The master's Firebase connections are closed afterwards; see init_worker.
+    """
+    started_at = time.perf_counter()
+    if DATASTORE_BACKEND != 'memory':
+        init_firebase()
+        auth.load()
+    boto3.load()
+    s3_transfer.load()
+    botocore_exceptions.load()
+    invoice_pdf.warm_up()
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+    for cache in (catalog_cache, jobs_cache, locations_cache):
+        try:
+            cache.get()
+        except Exception as e:
+            print(f"⚠️ Could not preload '{cache.path}': {e}")
+    reset_firebase_connections()
+    # Keep the collector from writing to (and so copying) every shared page in each worker.
+    gc.freeze()
+    print(f"✅ Shared state loaded in {time.perf_counter() - started_at:.2f}s.")
+
+def start_background_workers():
+    """Starts this process's email outbox and R2 deletion threads, so mail left pending and
+    deletions queued by a dead worker are picked up at boot rather than on the next send or
+    withdrawal."""
+    email_outbox.start()
+    r2_deletion_queue.start()
+
+def init_worker():
+    """Prepares a freshly forked gunicorn worker; gunicorn.conf.py calls it from post_fork.
+
+    Thread pools, the SMTP pool, ID blocks, the stock listener and metrics are reset by
+    os.register_at_fork handlers. This gives a worker forked from a preloaded master its
+    own Firebase and R2 connections, which need the initialized Firebase app or are worth
+    building before the first request, and starts the background workers.
+    """
+    reset_firebase_connections()
+    if s3_client is not None:
+        try:
+            s3_client.get()
+        except Exception as e:
+            print(f"❌ ERROR: Failed to initialize S3 client. Error: {e}")
+    start_background_workers()
+
 # --- Routes ---
 @app.route('/')
 def cover_page():
@@ -515,8 +2522,7 @@ def careers_page():
         user_email = session.get('user_email')
         if user_email:
             safe_email_key = user_email.replace('.', '_')
-            user_ref = db.reference(f'users/{safe_email_key}')
-            user_data = user_ref.get()
+            user_data = user_store.get(safe_email_key)
             if user_data:
                 user_info = {
                     'name': user_data.get('name', 'N/A'),
@@ -534,13 +2540,7 @@ def support_page():
 def get_jobs():
     """Fetches all job listings from the Firebase RTDB."""
     try:
-        jobs_ref = db.reference('careers/jobs')
-        jobs_data = jobs_ref.get()
-        if not jobs_data:
-            return jsonify({'success': True, 'jobs': []})
-        
-        jobs_list = list(jobs_data.values())
-        return jsonify({'success': True, 'jobs': jobs_list})
+        return cached_json_response(jobs_cache, 'jobs', lambda jobs_data: {'success': True, 'jobs': list(jobs_data.values()) if jobs_data else []})
     except Exception as e:
         print(f"Error fetching jobs from DB: {e}")
         return jsonify({'success': False, 'error': 'Could not retrieve job data.'}), 500
@@ -549,17 +2549,26 @@ def get_jobs():
 def get_locations():
     """Fetches all office locations from the Firebase RTDB."""
     try:
-        locations_ref = db.reference('careers/offices')
-        locations_data = locations_ref.get()
-        if not locations_data:
-            return jsonify({'success': True, 'locations': []})
-
-        locations_list = list(locations_data.values())
-        return jsonify({'success': True, 'locations': locations_list})
+        return cached_json_response(locations_cache, 'locations', lambda locations_data: {'success': True, 'locations': list(locations_data.values()) if locations_data else []})
     except Exception as e:
         print(f"Error fetching locations from DB: {e}")
         return jsonify({'success': False, 'error': 'Could not retrieve location data.'}), 500
 
+@app.route('/submit_application/upload_url', methods=['POST'])
+def resume_upload_url():
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'Authentication required. Please log in to apply.'}), 401
+    try:
+        data = request.get_json(silent=True) or {}
+        application_id = generate_unique_id('JOB', 'job_applications')
+        upload, error = create_direct_upload('resume', application_id, resume_object_key(application_id), data.get('size'))
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        return jsonify({'success': True, **upload})
+    except Exception as e:
+        print(f"[resume_upload_url] Error: {e}")
+        return jsonify({'success': False, 'error': 'Could not prepare the resume upload.'}), 500
+
 @app.route('/submit_application', methods=['POST'])
 def submit_application():
     if not session.get('logged_in'):
@@ -570,24 +2579,31 @@ def submit_application():
         safe_email_key = user_email_from_session.replace('.', '_')
         form_data = request.form
         resume_file = request.files.get('resume')
+        resume_upload_id = form_data.get('resumeUploadId')
 
         required_fields = ['jobId', 'applicantName', 'primaryEmail', 'experience', 'workType', 'qualification', 'skills', 'coverLetter']
         for field in required_fields:
             if not form_data.get(field):
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400
         
-        if not resume_file:
+        if not resume_file and not resume_upload_id:
             return jsonify({'success': False, 'error': 'Resume file is required.'}), 400
         
         print("--- New job application received. Processing... ---")
         
-        application_id = generate_unique_id('JOB', 'job_applications')
-        print(f"Generated unique application ID: {application_id}")
+        if resume_upload_id:
+            application_id = resume_upload_id
+            resume_url, upload_error = finalize_direct_upload('resume', application_id)
+            if upload_error:
+                return jsonify({'success': False, 'error': upload_error}), 400
+        else:
+            application_id = generate_unique_id('JOB', 'job_applications')
+            print(f"Generated unique application ID: {application_id}")
 
-        print(f"Uploading resume for {application_id}...")
-        resume_url, upload_error = upload_resume_to_r2(resume_file, application_id)
-        if upload_error:
-            return jsonify({'success': False, 'error': f'File upload failed: {upload_error}'}), 500
+            print(f"Uploading resume for {application_id}...")
+            resume_url, upload_error = upload_resume_to_r2(resume_file, application_id)
+            if upload_error:
+                return jsonify({'success': False, 'error': f'File upload failed: {upload_error}'}), 500
         
         application_data = {
             'applicationId': application_id,
@@ -606,15 +2622,16 @@ def submit_application():
         }
 
         print(f"Saving application data for {application_id} to Firebase for user {user_email_from_session}...")
-        db.reference(f'users/{safe_email_key}/job_applications/{application_id}').set(application_data)
-        
-        db.reference(f'existing_ids/job_applications/{application_id}').set(True)
+        (MultiPathCommit()
+            .set(careers_store.application_path(safe_email_key, application_id), application_data)
+            .register_id('job_applications', application_id)
+            .commit())
 
         print(f"--- Application {application_id} submitted successfully for user {user_email_from_session}. ---")
 
         try:
             job_id_from_form = form_data.get('jobId')
-            all_jobs_data = db.reference('careers/jobs').get()
+            all_jobs_data = jobs_cache.get()
             job_details = None
             if all_jobs_data:
                 for job_key, job_info in all_jobs_data.items():
@@ -651,8 +2668,7 @@ def get_my_applications():
         user_email = session.get('user_email')
         safe_email_key = user_email.replace('.', '_')
         
-        user_applications_ref = db.reference(f'users/{safe_email_key}/job_applications')
-        applications_data = user_applications_ref.get()
+        applications_data = careers_store.applications(safe_email_key)
 
         if not applications_data:
             return jsonify({'success': True, 'applications': []})
@@ -678,19 +2694,18 @@ def withdraw_application():
         user_email = session.get('user_email')
         safe_email_key = user_email.replace('.', '_')
 
-        app_ref = db.reference(f'users/{safe_email_key}/job_applications/{application_id}')
-        application_data = app_ref.get()
+        application_data = careers_store.get_application(safe_email_key, application_id)
 
         if not application_data:
             return jsonify({'success': False, 'error': 'Application not found or you do not have permission to modify it.'}), 404
 
-        success, error = delete_resume_from_r2(application_id)
-        if not success:
-            print(f"Could not delete resume from R2 for {application_id}: {error}")
-
         print(f"Deleting application {application_id} from Firebase...")
-        app_ref.delete()
-        db.reference(f'existing_ids/job_applications/{application_id}').delete()
+        (MultiPathCommit()
+            .delete(careers_store.application_path(safe_email_key, application_id))
+            .delete(f'existing_ids/job_applications/{application_id}')
+            .set(*r2_deletion_queue.pending_entry(resume_object_key(application_id)))
+            .commit())
+        r2_deletion_queue.wake()
         
         print(f"--- Application {application_id} successfully withdrawn by {user_email}. ---")
         return jsonify({'success': True, 'message': 'Application withdrawn successfully.'})
@@ -710,8 +2725,7 @@ def request_otp():
     if not phone or not validate_phone(phone):
         return jsonify({'success': False, 'error': 'Invalid phone', 'field_error': 'phone'}), 400
     safe_email_key = email.replace('.', '_')
-    user_ref = db.reference('users').child(safe_email_key)
-    if user_ref.get() is not None:
+    if user_store.get(safe_email_key) is not None:
         return jsonify({'success': False, 'error': 'User Already exists'}), 400
     otp = str(random.randint(100000, 999999))
     session.permanent = True
@@ -749,7 +2763,7 @@ def save_user_data():
             return jsonify({'success': False, 'error': f'Field "{field}" is required', 'field_error': field}), 400
     try:
         safe_email_key = email.replace('.', '_')
-        if db.reference('users').child(safe_email_key).get() is not None:
+        if user_store.get(safe_email_key) is not None:
             return jsonify({'success': False, 'error': 'User already exists.'}), 400
         user_data = {
             'email': email, 'phone': phone, 'name': data['name'], 'organization': data['organization'],
@@ -757,7 +2771,7 @@ def save_user_data():
             'address': data['address'], 'pincode': data['pincode'],
             'orders': 0, 'cart_items': [], 'created_at': {'.sv': 'timestamp'}
         }
-        db.reference('users').child(safe_email_key).set(user_data)
+        user_store.create(safe_email_key, user_data)
         send_account_created_email(email, data['name'])
         return jsonify({'success': True, 'message': 'Profile completed successfully'})
     except Exception as e:
@@ -773,7 +2787,7 @@ def login_check():
     if not phone or not validate_phone(phone):
         return jsonify({'success': False, 'error': "Invalid phone"}), 400
     safe_email_key = email.replace('.', '_')
-    user_data = db.reference('users').child(safe_email_key).get()
+    user_data = user_store.get(safe_email_key)
     if not user_data:
         return jsonify({'success': False, 'error': "Account doesn't exist"}), 404
     stored_phone = str(user_data.get('phone', '')).replace(' ', '').replace('-', '')
@@ -804,19 +2818,19 @@ def verify_login_otp():
     safe_email_key_as_uid = email.replace('.', '_')
 
     try:
-        user_ref = db.reference(f'users/{safe_email_key_as_uid}')
-        user_data = user_ref.get()
+        user_data = user_store.get(safe_email_key_as_uid)
         if user_data:
-            order_history = user_ref.child('order_details/order_history').get()
+            order_history = order_store.history(safe_email_key_as_uid)
             actual_order_count = len(order_history) if order_history else 0
             stored_order_count = user_data.get('orders', 0)
             if actual_order_count != stored_order_count:
-                user_ref.child('orders').set(actual_order_count)
+                user_store.set_order_count(safe_email_key_as_uid, actual_order_count)
                 print(f"Order count for {email} synchronized from {stored_order_count} to {actual_order_count}.")
     except Exception as e:
         print(f"Error synchronizing order count for {email}: {e}")
 
     try:
+        init_firebase()
         custom_token = auth.create_custom_token(safe_email_key_as_uid, {'email': email})
     except Exception as e:
         return jsonify({'success': False, 'error': 'Authentication failed on server.'}), 500
@@ -840,18 +2854,16 @@ def user_dashboard_page():
 def get_products():
     if not session.get('logged_in'):
         return jsonify({'success': False, 'error': 'Authentication required.'}), 401
-    try:
-        stock_ref = db.reference('stockitems')
-        products = stock_ref.get()
+    def build_payload(products):
         if not products:
-            return jsonify({'success': True, 'products': []})
-        
+            return {'success': True, 'products': []}
         product_list = []
         for product_id, product_data in products.items():
-            product_data['id'] = product_id 
-            product_list.append(product_data)
-            
-        return jsonify({'success': True, 'products': product_list})
+            product_list.append(dict(product_data, id=product_id))
+        return {'success': True, 'products': product_list}
+
+    try:
+        return cached_json_response(catalog_cache, 'products', build_payload)
     except Exception as e:
         print(f"Error fetching products from DB: {e}")
         return jsonify({'success': False, 'error': 'Could not retrieve product data.'}), 500
@@ -861,17 +2873,46 @@ def get_products():
 def get_current_stocks():
     if not session.get('logged_in'):
         return jsonify({'success': False, 'error': 'Authentication required.'}), 401
+    since = request.args.get('since', type=int)
+
+    def build_payload(products):
+        stocks = {pid: pdata.get('availableStock') for pid, pdata in products.items()} if products else {}
+        return {'success': True, 'stocks': stocks}
+
     try:
-        stock_ref = db.reference('stockitems')
-        products = stock_ref.get()
-        if products:
-            stocks = {pid: pdata.get('availableStock') for pid, pdata in products.items()}
-            return jsonify({'success': True, 'stocks': stocks})
-        return jsonify({'success': True, 'stocks': {}})
+        if since is not None:
+            changes, version, is_full = get_stock_changes_since(since)
+            return jsonify({'success': True, 'stocks': changes, 'version': version, 'full': is_full})
+        return cached_json_response(catalog_cache, 'stocks', build_payload)
     except Exception as e:
         print(f"Error fetching stocks from DB: {e}")
         return jsonify({'success': False, 'error': 'Could not retrieve stock data.'}), 500
 
+@app.route('/stream/stocks')
+def stream_stocks():
+    """Pushes {productId: availableStock} deltas to the dashboard as Server-Sent Events."""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'Authentication required.'}), 401
+    try:
+        subscription, snapshot = stock_broadcaster.subscribe()
+    except Exception as e:
+        print(f"Error starting stock stream: {e}")
+        return jsonify({'success': False, 'error': 'Live stock updates are unavailable.'}), 503
+
+    def generate():
+        try:
+            yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while True:
+                changes = subscription.wait(STOCK_STREAM_KEEPALIVE_SECONDS)
+                if changes:
+                    yield f"data: {json.dumps(changes)}\n\n"
+                else:
+                    yield ": keep-alive\n\n"
+        finally:
+            stock_broadcaster.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/update_cart_db', methods=['POST'])
 def update_cart_db_route():
     data = request.get_json()
@@ -897,11 +2938,9 @@ def place_order():
         return jsonify({'success': False, 'error': 'Shipping address ID is required.'}), 400
 
     safe_email_key = user_email.replace('.', '_')
-    user_ref = db.reference(f'users/{safe_email_key}')
-    stock_ref = db.reference('stockitems')
 
     try:
-        user_data = user_ref.get()
+        user_data = user_store.get(safe_email_key)
         if not user_data:
             return jsonify({'success': False, 'error': 'User not found.'}), 404
 
@@ -913,39 +2952,36 @@ def place_order():
         if not shipping_address:
             return jsonify({'success': False, 'error': 'Invalid shipping address selected.'}), 400
 
-        all_products_from_db = stock_ref.get()
-        if not all_products_from_db:
-            return jsonify({'success': False, 'error': 'Could not verify product catalog.'}), 500
-
-        validated_cart = []
-        adjustments_made = []
-        cart_was_modified = False
-
+        quantities = {}
         for item in cart_items:
-            product_id = str(item['id'])
-            product_in_db = all_products_from_db.get(product_id)
-            
-            if not product_in_db:
-                adjustments_made.append(f"'{item.get('name', 'An item')}' was removed as it is no longer available.")
-                cart_was_modified = True
-                continue
-
-            current_stock = product_in_db.get('availableStock', 0)
-            
-            if current_stock <= 0:
-                adjustments_made.append(f"'{item['name']}' was removed as it is now out of stock.")
-                cart_was_modified = True
-                continue
-
-            if item['quantity'] > current_stock:
-                adjustments_made.append(f"Quantity for '{item['name']}' reduced to {current_stock} due to low stock.")
-                item['quantity'] = current_stock
-                cart_was_modified = True
-            
-            validated_cart.append(item)
-        
-        if cart_was_modified:
-            user_ref.child('cart_items').set(validated_cart)
+            quantities[str(item['id'])] = quantities.get(str(item['id']), 0) + item['quantity']
+        reserved_products, shortages = reserve_stock(quantities)
+
+        if shortages:
+            validated_cart = []
+            adjustments_made = []
+            # A product can sit on several cart lines; the stock left is handed out to them in cart order.
+            remaining_stock = dict(shortages)
+            for item in cart_items:
+                product_id = str(item['id'])
+                if product_id not in shortages:
+                    validated_cart.append(item)
+                    continue
+                current_stock = remaining_stock[product_id]
+                if current_stock is None:
+                    adjustments_made.append(f"'{item.get('name', 'An item')}' was removed as it is no longer available.")
+                elif current_stock <= 0:
+                    adjustments_made.append(f"'{item['name']}' was removed as it is now out of stock.")
+                elif item['quantity'] <= current_stock:
+                    remaining_stock[product_id] = current_stock - item['quantity']
+                    validated_cart.append(item)
+                else:
+                    adjustments_made.append(f"Quantity for '{item['name']}' reduced to {current_stock} due to low stock.")
+                    item['quantity'] = current_stock
+                    remaining_stock[product_id] = 0
+                    validated_cart.append(item)
+
+            cart_store.save(safe_email_key, validated_cart)
             error_message = "Your cart has been updated due to stock changes. Please review and proceed. " + " ".join(adjustments_made)
             return jsonify({
                 'success': False, 
@@ -954,50 +2990,49 @@ def place_order():
                 'updated_cart': validated_cart
             }), 409
 
-        total_price = 0
-        order_items_details = []
-        stock_updates = {}
-
-        for item in validated_cart:
-            product_id, quantity = str(item['id']), item['quantity']
-            product_in_db = all_products_from_db.get(product_id)
-            
-            total_price += product_in_db['price'] * quantity
-            order_items_details.append({
-                'id': product_id, 'name': product_in_db['name'], 'price': product_in_db['price'],
-                'quantity': quantity, 'image': product_in_db['image'], 'description': product_in_db.get('description', 'N/A')
-            })
-            stock_updates[f'{product_id}/availableStock'] = product_in_db['availableStock'] - quantity
+        catalog_cache.invalidate()
 
-        if not order_items_details:
-            return jsonify({'success': False, 'error': 'All items in your cart are out of stock.'}), 400
+        try:
+            total_price = 0
+            order_items_details = []
+
+            for item in cart_items:
+                product_id, quantity = str(item['id']), item['quantity']
+                product_in_db = reserved_products[product_id]
+                
+                total_price += product_in_db['price'] * quantity
+                order_items_details.append({
+                    'id': product_id, 'name': product_in_db['name'], 'price': product_in_db['price'],
+                    'quantity': quantity, 'image': product_in_db['image'], 'description': product_in_db.get('description', 'N/A')
+                })
+
+            order_id = generate_unique_id('ORD', 'orders')
+            invoice_id = generate_unique_id('INV', 'invoices')
+            order_status = random.choice(["Shipped", "Out for Delivery", "Delivered"])
+
+            order_data = {
+                'orderId': order_id, 'invoiceId': invoice_id,
+                'orderDate': {'.sv': 'timestamp'}, 'status': order_status,
+                'items': order_items_details, 'shippingAddress': shipping_address,
+                'totalAmount': total_price
+            }
 
-        order_id = generate_unique_id('ORD', 'orders')
-        invoice_id = generate_unique_id('INV', 'invoices')
-        order_status = random.choice(["Shipped", "Out for Delivery", "Delivered"])
+            if order_status == "Delivered":
+                order_data['deliveryDate'] = datetime.now().strftime('%d-%b-%Y')
 
-        order_data = {
-            'orderId': order_id, 'invoiceId': invoice_id,
-            'orderDate': {'.sv': 'timestamp'}, 'status': order_status,
-            'items': order_items_details, 'shippingAddress': shipping_address,
-            'totalAmount': total_price
-        }
+            build_order_commit(safe_email_key, order_data).commit()
+        except Exception:
+            # The order was never written, so hand the reserved units back.
+            release_stock(reserved_products, quantities)
+            catalog_cache.invalidate()
+            raise
 
-        if order_status == "Delivered":
-            order_data['deliveryDate'] = datetime.now().strftime('%d-%b-%Y')
-
-        updates = {
-            f'users/{safe_email_key}/order_details/order_history/{order_id}': order_data,
-            f'users/{safe_email_key}/cart_items': [],
-            f'users/{safe_email_key}/orders': user_data.get('orders', 0) + 1,
-            f'existing_ids/orders/{order_id}': True,
-            f'existing_ids/invoices/{invoice_id}': True
-        }
-        db.reference().update(updates)
-        stock_ref.update(stock_updates)
+        record_stock_changes(list(reserved_products))
 
         print(f"--- Order {order_id} placed for {user_email}. Stock updated. ---")
 
+        invoice_prerenderer.schedule(safe_email_key, order_id, user_data.get('name', ''))
+
         try:
             user_name = user_data.get('name', 'Valued Customer')
             send_order_confirmation_email(user_email, user_name, order_data)
@@ -1031,7 +3066,7 @@ def request_stock_notification():
             current_data[user_email.replace('.', '_')] = True
             return current_data
 
-        notification_ref = db.reference(f'stock_notifications/{product_id}')
+        notification_ref = datastore.reference(f'stock_notifications/{product_id}')
         notification_ref.transaction(add_user_to_notification_list)
         
         print(f"User {user_email} registered for stock notification for product {product_id}.")
@@ -1043,7 +3078,7 @@ def request_stock_notification():
 
 def handle_stock_notifications(restocked_products):
     print(f"Handling notifications for {len(restocked_products)} restocked items.")
-    notifications_ref = db.reference('stock_notifications')
+    notifications_ref = datastore.reference('stock_notifications')
     all_notifications = notifications_ref.get()
 
     if not all_notifications:
@@ -1064,7 +3099,7 @@ def handle_stock_notifications(restocked_products):
     if not user_notifications:
         return
 
-    all_users_data = db.reference('users').get()
+    all_users_data = user_store.all()
     paths_to_delete = {}
     
     for user_email, products_to_notify in user_notifications.items():
@@ -1078,10 +3113,28 @@ def handle_stock_notifications(restocked_products):
             paths_to_delete[f'stock_notifications/{product["id"]}/{safe_email_key}'] = None
 
     if paths_to_delete:
-        db.reference().update(paths_to_delete)
+        datastore.reference().update(paths_to_delete)
         print(f"Cleared {len(paths_to_delete)} sent stock notifications from the database.")
 
 
+@app.route('/request_return/upload_url', methods=['POST'])
+def return_video_upload_url():
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'User not logged in.'}), 401
+    try:
+        data = request.get_json(silent=True) or {}
+        safe_email_key = session.get('user_email').replace('.', '_')
+        user_name = user_store.get_name(safe_email_key) or 'AnonymousUser'
+        return_invoice_id = generate_unique_id('RET', 'returns')
+        object_key = video_object_key(user_name, return_invoice_id)
+        upload, error = create_direct_upload('return_video', return_invoice_id, object_key, data.get('size'))
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        return jsonify({'success': True, **upload})
+    except Exception as e:
+        print(f"[return_video_upload_url] Error: {e}")
+        return jsonify({'success': False, 'error': 'Could not prepare the video upload.'}), 500
+
 @app.route('/request_return', methods=['POST'])
 def request_return():
     if not session.get('logged_in'):
@@ -1094,22 +3147,21 @@ def request_return():
         address_info = json.loads(request.form.get('addressInfo'))
         contact_info = json.loads(request.form.get('contactInfo'))
         video_file = request.files.get('videoFile')
+        video_upload_id = request.form.get('videoUploadId')
     except (json.JSONDecodeError, TypeError):
         return jsonify({'success': False, 'error': 'Malformed request data.'}), 400
 
-    if not all([order_id, reason, address_info, contact_info, video_file]):
+    if not all([order_id, reason, address_info, contact_info, video_file or video_upload_id]):
         return jsonify({'success': False, 'error': 'Incomplete return request data.'}), 400
 
     safe_email_key = user_email.replace('.', '_')
-    user_ref = db.reference(f'users/{safe_email_key}')
-    order_ref = user_ref.child(f'order_details/order_history/{order_id}')
 
     try:
-        user_data_snapshot = user_ref.get()
+        user_data_snapshot = user_store.get(safe_email_key)
         if not user_data_snapshot: return jsonify({'success': False, 'error': 'User not found.'}), 404
         user_name = user_data_snapshot.get('name', 'AnonymousUser')
         
-        order_data = order_ref.get()
+        order_data = order_store.get(safe_email_key, order_id)
         if not order_data: return jsonify({'success': False, 'error': 'Order not found.'}), 404
         
         current_status = order_data.get('status')
@@ -1137,10 +3189,16 @@ def request_return():
         else:
             return_contact = contact_info.get('customContact', '')
 
-        return_invoice_id = generate_unique_id('RET', 'returns')
-        video_url, upload_error = upload_video_to_r2(video_file, user_name, return_invoice_id)
-        if upload_error:
-            return jsonify({'success': False, 'error': f'Video upload failed: {upload_error}'}), 500
+        if video_upload_id:
+            return_invoice_id = video_upload_id
+            video_url, upload_error = finalize_direct_upload('return_video', return_invoice_id)
+            if upload_error:
+                return jsonify({'success': False, 'error': upload_error}), 400
+        else:
+            return_invoice_id = generate_unique_id('RET', 'returns')
+            video_url, upload_error = upload_video_to_r2(video_file, user_name, return_invoice_id)
+            if upload_error:
+                return jsonify({'success': False, 'error': f'Video upload failed: {upload_error}'}), 500
 
         return_details = {
             'reason': reason, 'videoUrl': video_url,
@@ -1148,13 +3206,13 @@ def request_return():
             'requestedAt': {'.sv': 'timestamp'}
         }
         
-        updates = {
-            f'status': "Return Requested",
-            f'returnInvoiceId': return_invoice_id,
-            f'returnDetails': return_details
-        }
-        order_ref.update(updates)
-        db.reference(f'existing_ids/returns/{return_invoice_id}').set(True)
+        order_path = order_store.path(safe_email_key, order_id)
+        (MultiPathCommit()
+            .set(f'{order_path}/status', "Return Requested")
+            .set(f'{order_path}/returnInvoiceId', return_invoice_id)
+            .set(f'{order_path}/returnDetails', return_details)
+            .register_id('returns', return_invoice_id)
+            .commit())
 
         print(f"--- Return requested for Order {order_id} by {user_email}. Return ID: {return_invoice_id} ---")
         
@@ -1184,14 +3242,19 @@ def download_invoice(order_id):
     user_email = session.get('user_email')
     safe_email_key = user_email.replace('.', '_')
     try:
-        user_ref = db.reference(f'users/{safe_email_key}')
-        user_data = user_ref.get()
-        order_data = user_ref.child(f'order_details/order_history/{order_id}').get()
+        user_data = user_store.get(safe_email_key)
+        order_data = order_store.get(safe_email_key, order_id)
         if not user_data or not order_data: return "Order not found.", 404
-        buffer = io.BytesIO()
-        create_modern_invoice(order_data, user_data, buffer, title="Tax Invoice")
-        buffer.seek(0)
-        return send_file(buffer, as_attachment=True, download_name=f"NILA-Invoice-{order_data.get('invoiceId', order_id)}.pdf", mimetype='application/pdf')
+        download_name = f"NILA-Invoice-{order_data.get('invoiceId', order_id)}.pdf"
+        if order_data.get('invoiceObjectKey'):
+            stored_response = stored_invoice_response(order_data['invoiceObjectKey'], download_name)
+            if stored_response is not None:
+                return stored_response
+        buffer = io.BytesIO(render_invoice_pdf(order_data, user_data, title="Tax Invoice"))
+        return send_file(buffer, as_attachment=True, download_name=download_name, mimetype='application/pdf')
+    except InvoiceRenderTimeout as e:
+        print(f"Invoice for order {order_id} not rendered: {e}")
+        return "Invoice generation is busy; please try again shortly.", 503, {'Retry-After': '30'}
     except Exception as e:
         print(f"Error generating invoice for order {order_id}: {e}")
         return "Failed to generate invoice.", 500
@@ -1202,21 +3265,71 @@ def download_return_invoice(order_id):
     user_email = session.get('user_email')
     safe_email_key = user_email.replace('.', '_')
     try:
-        user_ref = db.reference(f'users/{safe_email_key}')
-        user_data = user_ref.get()
-        order_data = user_ref.child(f'order_details/order_history/{order_id}').get()
+        user_data = user_store.get(safe_email_key)
+        order_data = order_store.get(safe_email_key, order_id)
         if not user_data or not order_data: return "Order not found.", 404
         if 'returnInvoiceId' not in order_data or order_data.get('status') not in ['Return Requested', 'Returned']:
             return "No return invoice exists for this order.", 404
-        buffer = io.BytesIO()
-        create_modern_invoice(order_data, user_data, buffer, title="Return Invoice")
-        buffer.seek(0)
+        buffer = io.BytesIO(render_invoice_pdf(order_data, user_data, title="Return Invoice"))
         return send_file(buffer, as_attachment=True, download_name=f"NILA-Return-Invoice-{order_data.get('returnInvoiceId')}.pdf", mimetype='application/pdf')
+    except InvoiceRenderTimeout as e:
+        print(f"Return invoice for order {order_id} not rendered: {e}")
+        return "Invoice generation is busy; please try again shortly.", 503, {'Retry-After': '30'}
     except Exception as e:
         print(f"Error generating return invoice for order {order_id}: {e}")
         return "Failed to generate return invoice.", 500
 
 
+def admin_token_valid():
+    """Whether the request's X-Admin-Token matches ADMIN_EXPORT_TOKEN; always False while it is unset."""
+    supplied = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_EXPORT_TOKEN) and hmac.compare_digest(supplied.encode(), ADMIN_EXPORT_TOKEN.encode())
+
+@app.route('/export_invoices')
+def export_invoices():
+    """Streams a ZIP of all invoices for orders placed between ?from= and ?to= (YYYY-MM-DD, inclusive)."""
+    if not admin_token_valid():
+        return "Access Denied", 403
+    try:
+        start = datetime.strptime(request.args.get('from', ''), '%Y-%m-%d')
+        end = datetime.strptime(request.args.get('to', ''), '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        return "Query parameters 'from' and 'to' must be dates in YYYY-MM-DD format.", 400
+    if end <= start:
+        return "'to' must not be before 'from'.", 400
+    export_id = uuid.uuid4().hex
+    print(f"--- Invoice export {export_id} started: orders from {start:%d-%b-%Y} to {end - timedelta(days=1):%d-%b-%Y}. ---")
+    download_name = f"NILA-Invoices-{start:%Y%m%d}-{end - timedelta(days=1):%Y%m%d}.zip"
+    return Response(stream_invoice_zip(export_id, start, end), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+        'X-Export-Id': export_id
+    })
+
+@app.route('/export_invoices/<export_id>/progress')
+def export_invoices_progress(export_id):
+    if not admin_token_valid():
+        return jsonify({'success': False, 'error': 'Access denied.'}), 403
+    progress = datastore.reference(f'invoice_exports/{export_id}').get()
+    if not progress:
+        return jsonify({'success': False, 'error': 'Export not found.'}), 404
+    return jsonify({'success': True, 'progress': progress})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    supplied = request.headers.get('Authorization', '')
+    if not METRICS_TOKEN or not hmac.compare_digest(supplied.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+        return 'Access denied.', 403
+    lines = [metrics.render()]
+    upload_stats = r2_upload_stats.snapshot()
+    for name, value, help_text in (
+        ('nila_r2_uploads_total', upload_stats['uploads'], 'Uploads to R2 that completed.'),
+        ('nila_r2_upload_failures_total', upload_stats['failures'], 'Uploads to R2 that failed or were rejected.'),
+        ('nila_r2_upload_bytes_total', upload_stats['bytes'], 'Bytes sent to R2 by uploads.'),
+        ('nila_r2_upload_seconds_total', upload_stats['seconds'], 'Time spent uploading to R2.'),
+    ):
+        lines.append(f'# HELP {name} {help_text}\n# TYPE {name} counter\n{name} {value}\n')
+    return Response(''.join(lines), mimetype='text/plain; version=0.0.4')
+
 @app.route('/logout')
 def logout():
     log_user_out_and_print_message()
@@ -1231,4 +3344,7 @@ if __name__ == '__main__':
     with app.app_context():
         setup_database()
         setup_careers_database() 
+    # The reloader runs the app in a child process; start the workers there, not in the watcher.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,212 @@
+"""Measures how many requests one gunicorn worker keeps in flight, per worker class, as users are added.
+
+Boots a single worker of each class (sync, gthread, gevent) against
+benchmarks/fake_rtdb.py and benchmarks/local_smtp.py, which run as separate processes
+with injected latency, and steps the number of concurrent virtual users through
+--levels. Users run the dashboard polling and checkout scenarios from
+benchmarks/loadtest.py with sessions signed directly, so no OTP mail is needed.
+
+For every level it reports throughput, p50/p95/p99 latency and the average number of
+requests the worker was handling at once (its throughput x its own mean handling time,
+from /metrics). A sync worker stays at 1 however many users wait; gthread stops at its
+thread count; under gevent it follows the users into the hundreds.
+
+The client is gevent-patched itself so hundreds of users cost little; the stand-ins
+are separate processes so they do not compete with it for the GIL.
+
+Usage: python benchmarks/concurrency.py [--classes sync,gthread,gevent] [--levels 1,8,32,128,256]
+                                        [--duration 10] [--threads 8] [--mix dashboard=80,checkout=20]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import socket  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+
+import requests  # noqa: E402
+from flask import Flask  # noqa: E402
+from flask.sessions import SecureCookieSessionInterface  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from benchmarks.loadtest import (  # noqa: E402
+    DATABASE_URL, Recorder, VirtualUser, assign_scenarios, build_seed, free_port, parse_mix,
+    service_account_json, start_gunicorn, stop_gunicorn, summarize, user_email
+)
+
+SECRET_KEY = 'concurrency'
+METRICS_TOKEN = 'concurrency'
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+SUPPORTED_SCENARIOS = ('dashboard', 'checkout')
+# gunicorn.conf.py's default.
+GEVENT_WORKER_CONNECTIONS = 2000
+
+
+def session_cookie(email):
+    """The session cookie /verify_login_otp would have set for email."""
+    signer = Flask(__name__)
+    signer.secret_key = SECRET_KEY
+    serializer = SecureCookieSessionInterface().get_signing_serializer(signer)
+    return serializer.dumps({'logged_in': True, 'user_email': email, '_permanent': True})
+
+
+def start_stand_in(script, port, log_file, *args):
+    """Runs a benchmarks/ stand-in server in its own process and waits for its port to open."""
+    command = [sys.executable, os.path.join('benchmarks', script), '--port', str(port), *args]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{script} exited with status {process.returncode}; see {log_file.name}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f'{script} did not come up within 30s; see {log_file.name}')
+
+
+def app_environment(rtdb_port, smtp_port, credentials_json):
+    env = dict(os.environ)
+    env.update({
+        'FLASK_SECRET_KEY': SECRET_KEY,
+        'METRICS_TOKEN': METRICS_TOKEN,
+        'FIREBASE_DATABASE_URL': DATABASE_URL,
+        'FIREBASE_DATABASE_EMULATOR_HOST': f'127.0.0.1:{rtdb_port}',
+        'FIREBASE_CREDENTIALS_JSON': credentials_json,
+        'DATASTORE_BACKEND': 'firebase',
+        'GMAIL_SENDER_EMAIL': 'orders@example.com',
+        'GMAIL_SENDER_PASSWORD': 'concurrency',
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': str(smtp_port),
+        'SMTP_USE_SSL': '0',
+    })
+    return env
+
+
+def handled_seconds(base_url):
+    """Total time the worker has spent handling requests, from its /metrics."""
+    response = requests.get(f'{base_url}/metrics', headers={'Authorization': f'Bearer {METRICS_TOKEN}'}, timeout=30)
+    response.raise_for_status()
+    text = response.text
+    return sum(float(line.rpartition(' ')[2]) for line in text.splitlines()
+               if line.startswith('nila_http_request_duration_seconds_sum'))
+
+
+def run_level(base_url, scenarios, duration, think_seconds):
+    recorder = Recorder()
+    users = []
+    for index, scenario in enumerate(scenarios):
+        user = VirtualUser(index, scenario, base_url, recorder, None, think_seconds, 0)
+        user.session.cookies.set('session', session_cookie(user_email(index)))
+        users.append(user)
+    handled_before = handled_seconds(base_url)
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [threading.Thread(target=user.run, args=(deadline,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    samples = [sample for route_samples in recorder.samples.values() for sample in route_samples]
+    result = summarize(samples, elapsed)
+    # Little's law on the worker's own timings: the average number of requests it was handling at once.
+    # Client-side latencies would also count requests still queued in the listen backlog.
+    result['in_flight'] = (handled_seconds(base_url) - handled_before) / elapsed
+    result['routes'] = {route: summarize(route_samples, elapsed) for route, route_samples in recorder.samples.items()}
+    return result
+
+
+def parse_levels(text):
+    return [int(level) for level in text.split(',')]
+
+
+def parse_classes(text):
+    classes = text.split(',')
+    for worker_class in classes:
+        if worker_class not in WORKER_CLASSES:
+            raise argparse.ArgumentTypeError(f'unknown worker class {worker_class!r}; choose from {", ".join(WORKER_CLASSES)}')
+    return classes
+
+
+def parse_polling_mix(text):
+    mix = parse_mix(text)
+    for name in mix:
+        if name not in SUPPORTED_SCENARIOS:
+            raise argparse.ArgumentTypeError(f'only {" and ".join(SUPPORTED_SCENARIOS)} are supported here')
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--classes', type=parse_classes, default=list(WORKER_CLASSES))
+    parser.add_argument('--levels', type=parse_levels, default=parse_levels('1,8,32,128,256'),
+                        help='comma-separated numbers of concurrent users')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per level')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the gthread worker')
+    parser.add_argument('--mix', type=parse_polling_mix, default=parse_polling_mix('dashboard=80,checkout=20'))
+    parser.add_argument('--think-ms', type=float, default=500, help='mean pause between a user\'s iterations')
+    parser.add_argument('--rtdb-latency-ms', type=float, default=30)
+    parser.add_argument('--rtdb-jitter-ms', type=float, default=10)
+    parser.add_argument('--smtp-latency-ms', type=float, default=150)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    credentials_json = service_account_json()
+    print(f"One worker per class, {args.duration:g}s per level, {args.think_ms:g} ms think time; "
+          f"RTDB {args.rtdb_latency_ms:g}±{args.rtdb_jitter_ms:g} ms, SMTP {args.smtp_latency_ms:g} ms per call")
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='nila-concurrency-') as work_dir:
+        seed_file = os.path.join(work_dir, 'seed.json')
+        with open(seed_file, 'w', encoding='utf-8') as seed_output:
+            json.dump(build_seed(max(args.levels), {}), seed_output)
+        for worker_class in args.classes:
+            concurrency = {'sync': 1, 'gthread': args.threads}.get(worker_class, GEVENT_WORKER_CONNECTIONS)
+            label = f'{worker_class} ({"up to " if worker_class == "gevent" else ""}{concurrency} '
+            label += f'{"greenlets" if worker_class == "gevent" else "threads"})'
+            results[label] = {}
+            rtdb_port, smtp_port, port = free_port(), free_port(), free_port()
+            processes = []
+            with open(os.path.join(work_dir, f'{worker_class}.log'), 'w') as log_file:
+                try:
+                    # A fresh database per class, so every class starts from the same stock.
+                    processes.append(start_stand_in(
+                        'fake_rtdb.py', rtdb_port, log_file, '--seed', seed_file,
+                        '--latency-ms', str(args.rtdb_latency_ms), '--jitter-ms', str(args.rtdb_jitter_ms)
+                    ))
+                    processes.append(start_stand_in('local_smtp.py', smtp_port, log_file,
+                                                    '--latency-ms', str(args.smtp_latency_ms)))
+                    env = app_environment(rtdb_port, smtp_port, credentials_json)
+                    processes.append(start_gunicorn(1, concurrency, worker_class, port, env, log_file))
+                    print(f"\n== {label}")
+                    print(f"  {'users':>6} {'req/s':>7} {'in flight':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'5xx':>5}")
+                    for level in args.levels:
+                        scenarios = assign_scenarios(level, args.mix)
+                        result = run_level(f'http://127.0.0.1:{port}', scenarios, args.duration, args.think_ms / 1000)
+                        results[label][level] = result
+                        print(f"  {level:>6} {result['rps']:>7.1f} {result['in_flight']:>10.1f} {result['p50']:>8.1f} "
+                              f"{result['p95']:>8.1f} {result['p99']:>8.1f} {result['errors']:>5}")
+                finally:
+                    for process in reversed(processes):
+                        stop_gunicorn(process)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
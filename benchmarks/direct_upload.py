@@ -0,0 +1,141 @@
+"""Checks presigned direct uploads end to end through firebase_admin, against the local stand-ins.
+
+The app runs in process with the Firebase backend, pointed at benchmarks/fake_rtdb.py
+through firebase_admin's emulator support, so upload grants are written and claimed
+with the real Reference.transaction/set_if_unchanged calls rather than the in-memory
+backend's. R2 is benchmarks/local_s3.py. For both kinds of direct upload (return
+videos and resumes) it asks for a presigned URL, PUTs the file and submits the form
+with the upload ID, then checks that a grant cannot be replayed or used by another
+user, that a failed check leaves it usable, that claimed grants are removed and
+that an upload never submitted is deleted from R2 once its grant expires.
+Any failed check fails the run.
+
+Usage: python benchmarks/direct_upload.py
+"""
+import json
+import os
+import sys
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from benchmarks.fake_rtdb import FakeRTDBServer  # noqa: E402
+from benchmarks.loadtest import (  # noqa: E402
+    MP4_HEADER, app_environment, build_seed, seeded_order_ids, service_account_json, user_email
+)
+from benchmarks.local_s3 import LocalS3Server  # noqa: E402
+from benchmarks.local_smtp import LocalSMTPServer  # noqa: E402
+
+PDF_BYTES = b'%PDF-1.4\n' + b'0' * 2048
+
+
+def logged_in_client(app, index):
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session.update(logged_in=True, user_email=user_email(index))
+    return client
+
+
+def presign(client, endpoint, body):
+    """Asks for a presigned URL for body and returns the upload description."""
+    response = client.post(endpoint, json={'size': len(body)})
+    upload = response.get_json()
+    if response.status_code != 200:
+        raise AssertionError(f"{endpoint} answered {response.status_code}: {upload}")
+    return upload
+
+
+def put_upload(upload, body):
+    requests.put(upload['uploadUrl'], data=body, headers=upload['headers'], timeout=30).raise_for_status()
+
+
+def direct_upload(client, endpoint, body):
+    """Asks for a presigned URL, PUTs body to it and returns the upload ID."""
+    upload = presign(client, endpoint, body)
+    put_upload(upload, body)
+    return upload['uploadId']
+
+
+def return_form(order_id, upload_id):
+    return {
+        'orderId': order_id, 'reason': 'Direct upload check', 'videoUploadId': upload_id,
+        'addressInfo': json.dumps({'type': 'same'}), 'contactInfo': json.dumps({'type': 'same'}),
+    }
+
+
+def application_form(upload_id):
+    return {
+        'jobId': '1', 'applicantName': 'Direct Upload Check', 'primaryEmail': user_email(0),
+        'experience': '2', 'workType': 'Full-time', 'qualification': 'B.Tech', 'skills': 'Python',
+        'coverLetter': 'Checking presigned resume uploads.', 'resumeUploadId': upload_id,
+    }
+
+
+def main():
+    rtdb = FakeRTDBServer(seed=build_seed(2, {0: 3, 1: 1})).start()
+    s3 = LocalS3Server().start()
+    smtp = LocalSMTPServer().start()
+    os.environ.update(app_environment(rtdb, s3, smtp, 1, service_account_json()))
+    import app
+
+    failures = []
+
+    def check(label, response, expected_status):
+        ok = response.status_code == expected_status
+        print(f"  {'ok  ' if ok else 'FAIL'} {label}: {response.status_code}")
+        if not ok:
+            failures.append(f"{label}: expected {expected_status}, got {response.status_code} {response.get_data(as_text=True)[:200]}")
+
+    owner, other = logged_in_client(app, 0), logged_in_client(app, 1)
+    orders = seeded_order_ids(0, 3)
+    video = MP4_HEADER + os.urandom(4096)
+
+    upload_id = direct_upload(owner, '/request_return/upload_url', video)
+    check('return with an uploaded video', owner.post('/request_return', data=return_form(orders[0], upload_id)), 200)
+    check('replaying the claimed video upload', owner.post('/request_return', data=return_form(orders[1], upload_id)), 400)
+
+    upload_id = direct_upload(owner, '/request_return/upload_url', video)
+    other_order = seeded_order_ids(1, 1)[0]
+    check("using another user's video upload", other.post('/request_return', data=return_form(other_order, upload_id)), 400)
+    check('the owner using it afterwards', owner.post('/request_return', data=return_form(orders[1], upload_id)), 200)
+
+    upload = presign(owner, '/request_return/upload_url', video)
+    check('submitting before the video is uploaded', owner.post('/request_return', data=return_form(orders[2], upload['uploadId'])), 400)
+    put_upload(upload, video)
+    check('submitting again once it is uploaded', owner.post('/request_return', data=return_form(orders[2], upload['uploadId'])), 200)
+
+    upload_id = direct_upload(owner, '/submit_application/upload_url', PDF_BYTES)
+    check('application with an uploaded resume', owner.post('/submit_application', data=application_form(upload_id)), 200)
+    check('replaying the claimed resume upload', owner.post('/submit_application', data=application_form(upload_id)), 400)
+
+    upload_id = direct_upload(owner, '/request_return/upload_url', video)
+    grant = app.datastore.reference(f'direct_uploads/{upload_id}')
+    object_key = grant.get()['key']
+    grant.child('expires').set(0)
+    check('submitting an expired video upload', owner.post('/request_return', data=return_form(orders[2], upload_id)), 400)
+    app.r2_deletion_queue.discard_expired_uploads()
+    app.r2_deletion_queue.drain()
+    try:
+        app.s3_client.head_object(Bucket=app.R2_BUCKET_NAME, Key=object_key)
+        removed = False
+    except app.botocore_exceptions.ClientError:
+        removed = True
+    print(f"  {'ok  ' if removed else 'FAIL'} expired upload deleted from R2")
+    if not removed:
+        failures.append(f"the object of expired upload {upload_id} is still in R2")
+
+    leftover = app.datastore.reference('direct_uploads').get()
+    print(f"  {'ok  ' if not leftover else 'FAIL'} claimed grants removed")
+    if leftover:
+        failures.append(f"grants left in direct_uploads: {sorted(leftover)}")
+
+    if failures:
+        sys.exit("FAILED:\n  " + "\n  ".join(failures))
+    print("All direct upload checks passed.")
+
+
+if __name__ == '__main__':
+    main()
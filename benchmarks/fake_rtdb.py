@@ -0,0 +1,207 @@
+"""A local Realtime Database stand-in that speaks the RTDB REST protocol.
+
+Serves datastore.InMemoryDatabase over HTTP the way firebase_admin's database
+emulator support expects: JSON reads and writes at /<path>.json, shallow and
+ordered/filtered queries, ETag reads and conditional writes (so transactions work),
+push, multi-path PATCH, and Server-Sent Event listeners. Nodes keyed by array indices
+are returned as JSON arrays, as the real service returns them. Point the app at it with
+FIREBASE_DATABASE_EMULATOR_HOST=127.0.0.1:<port>; every gunicorn worker then shares
+one database, as they do in production. Each database round trip can be delayed by a
+fixed latency plus random jitter to approximate the distance to Firebase.
+
+Usage: python benchmarks/fake_rtdb.py [--port 9100] [--latency-ms 30] [--seed data.json]
+"""
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from datastore import InMemoryDatabase  # noqa: E402
+
+# Idle listener streams get a keep-alive event this often, as the real service sends.
+LISTENER_KEEPALIVE_SECONDS = 30
+
+
+class FakeRTDBServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), seed=None, latency=0.0, jitter=0.0):
+        super().__init__(address, FakeRTDBHandler)
+        self.database = InMemoryDatabase(seed, latency=latency, jitter=jitter)
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def emulator_host(self):
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class FakeRTDBHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _begin(self):
+        with self.server.lock:
+            self.server.request_count += 1
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        if path.endswith('.json'):
+            path = path[:-len('.json')]
+        params = {name: values[0] for name, values in parse_qs(parts.query, keep_blank_values=True).items()}
+        return self.server.database.reference(path), params
+
+    def _json_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def _send(self, status, value=None, etag=None, silent=False):
+        body = b'' if silent else json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, {'error': message})
+
+    def do_GET(self):
+        reference, params = self._begin()
+        if 'text/event-stream' in self.headers.get('Accept', ''):
+            return self._stream(reference)
+        try:
+            if 'orderBy' in params:
+                return self._send(200, self._query(reference, params))
+            value, etag = reference.get(etag=True)
+        except ValueError as e:
+            return self._error(400, str(e))
+        if self.headers.get('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        if params.get('shallow') == 'true':
+            if isinstance(value, list):
+                value = {str(index): child for index, child in enumerate(value) if child is not None}
+            if isinstance(value, dict):
+                value = {key: True if isinstance(child, (dict, list)) else child for key, child in value.items()}
+        self._send(200, value, etag=etag if self.headers.get('X-Firebase-ETag') == 'true' else None)
+
+    @staticmethod
+    def _query(reference, params):
+        order_by = json.loads(params['orderBy'])
+        if order_by == '$key':
+            query = reference.order_by_key()
+        elif order_by == '$value':
+            query = reference.order_by_value()
+        else:
+            query = reference.order_by_child(order_by)
+        if 'equalTo' in params:
+            query = query.equal_to(json.loads(params['equalTo']))
+        if 'startAt' in params:
+            query = query.start_at(json.loads(params['startAt']))
+        if 'endAt' in params:
+            query = query.end_at(json.loads(params['endAt']))
+        if 'limitToFirst' in params:
+            query = query.limit_to_first(int(params['limitToFirst']))
+        if 'limitToLast' in params:
+            query = query.limit_to_last(int(params['limitToLast']))
+        return query.get()
+
+    def do_PUT(self):
+        reference, params = self._begin()
+        value = self._json_body()
+        expected_etag = self.headers.get('if-match')
+        if expected_etag:
+            try:
+                success, snapshot, etag = reference.set_if_unchanged(expected_etag, value)
+            except ValueError as e:
+                return self._error(400, str(e))
+            return self._send(200 if success else 412, snapshot, etag=etag)
+        if value is None:
+            reference.delete()
+        else:
+            reference.set(value)
+        self._send(200, value, silent=params.get('print') == 'silent')
+
+    def do_PATCH(self):
+        reference, params = self._begin()
+        value = self._json_body()
+        try:
+            reference.update(value)
+        except ValueError as e:
+            return self._error(400, str(e))
+        self._send(200, value, silent=params.get('print') == 'silent')
+
+    def do_POST(self):
+        reference, _ = self._begin()
+        child = reference.push(self._json_body())
+        self._send(200, {'name': child.key})
+
+    def do_DELETE(self):
+        reference, params = self._begin()
+        reference.delete()
+        self._send(200, None, silent=params.get('print') == 'silent')
+
+    def _stream(self, reference):
+        events = queue.Queue()
+        registration = reference.listen(events.put)
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=LISTENER_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    self.wfile.write(b'event: keep-alive\ndata: null\n\n')
+                else:
+                    data = json.dumps({'path': event.path, 'data': event.data})
+                    self.wfile.write(f'event: {event.event_type}\ndata: {data}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            registration.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--seed', help='JSON export to load at startup')
+    args = parser.parse_args()
+    seed = None
+    if args.seed:
+        with open(args.seed, encoding='utf-8') as seed_file:
+            seed = json.load(seed_file)
+    server = FakeRTDBServer(('127.0.0.1', args.port), seed=seed,
+                            latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000)
+    print(f"Fake RTDB listening; run the app with FIREBASE_DATABASE_EMULATOR_HOST={server.emulator_host}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
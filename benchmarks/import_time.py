@@ -0,0 +1,101 @@
+"""Profiles how long `import app` takes in a fresh interpreter, lazily and with EAGER_WARMUP=1.
+
+Each run is a new Python process with production-like settings (a throwaway service
+account and R2 credentials pointing nowhere; nothing is contacted). For the lazy
+mode it also times app.warm_up() after the import, which is what the first requests
+that touch Firebase, R2 and invoices pay between them. The heaviest modules imported
+directly by app are listed from `python -X importtime`.
+
+Usage: python benchmarks/import_time.py [--repeat 5] [--top 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from benchmarks.loadtest import service_account_json  # noqa: E402
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.warm_up()
+print(json.dumps({'import': imported - started, 'warm_up': time.perf_counter() - imported}))
+"""
+
+
+def run(env):
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def profile_imports(env):
+    command = [sys.executable, '-X', 'importtime', '-c', 'import app']
+    return subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=True).stderr
+
+
+def direct_imports(importtime_output):
+    """(cumulative seconds, module) for each module `import app` itself pulled in."""
+    children = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((int(cumulative) / 1e6, name.strip()))
+        elif depth == 0:
+            # -X importtime lists a module after everything it imported.
+            if name.strip() == 'app':
+                return sorted(children, reverse=True)
+            children = []
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        'FLASK_SECRET_KEY': 'import-time',
+        'FIREBASE_DATABASE_URL': 'https://nila-import-time.firebaseio.com',
+        'FIREBASE_CREDENTIALS_JSON': service_account_json(),
+        'R2_ENDPOINT_URL': 'http://127.0.0.1:9',
+        'R2_ACCESS_KEY_ID': 'import-time',
+        'R2_SECRET_ACCESS_KEY': 'import-time',
+        'R2_BUCKET_NAME': 'import-time',
+    })
+    env.pop('EAGER_WARMUP', None)
+    eager_env = dict(env, EAGER_WARMUP='1')
+
+    lazy = [run(env) for _ in range(args.repeat)]
+    eager = [run(eager_env) for _ in range(args.repeat)]
+    lazy_import = statistics.median(timing['import'] for timing in lazy)
+    lazy_warm_up = statistics.median(timing['warm_up'] for timing in lazy)
+    eager_import = statistics.median(timing['import'] for timing in eager)
+
+    print(f"Median of {args.repeat} fresh interpreters:")
+    print(f"  import app (lazy, default)       {lazy_import * 1000:8.1f} ms")
+    print(f"  first use of every subsystem     {lazy_warm_up * 1000:8.1f} ms  (app.warm_up() after a lazy import)")
+    print(f"  import app with EAGER_WARMUP=1   {eager_import * 1000:8.1f} ms")
+    print(f"  boot time saved per worker       {(eager_import - lazy_import) * 1000:8.1f} ms "
+          f"({1 - lazy_import / eager_import:.0%})")
+
+    for label, profile_env in (('lazy', env), ('EAGER_WARMUP=1', eager_env)):
+        print(f"\nHeaviest direct imports of app ({label}):")
+        for seconds, module in direct_imports(profile_imports(profile_env))[:args.top]:
+            print(f"  {seconds * 1000:8.1f} ms  {module}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Measures per-invoice CPU time and allocations of create_modern_invoice.
+
+Usage: python benchmarks/invoice_render.py [--lines 50] [--runs 20]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import app  # noqa: E402
+
+
+def sample_order(lines):
+    return {
+        'orderId': 'ORD0000001', 'invoiceId': 'INV0000001', 'orderDate': 1700000000000,
+        'shippingAddress': {'address': '14 Sample Street', 'city': 'Coimbatore', 'state': 'Tamil Nadu', 'pincode': '641111', 'country': 'India'},
+        'items': [
+            {'name': f'Sample Product {i}', 'description': 'Handloom cotton, 2 pieces', 'price': 999 + i, 'quantity': 1 + i % 3}
+            for i in range(lines)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    order, user = sample_order(args.lines), {'name': 'Benchmark Customer'}
+    render = lambda: app.invoice_pdf.create_modern_invoice(order, user, io.BytesIO())
+
+    render()  # warm up imports, fonts and any per-process rendering state
+    cpu_start = time.process_time()
+    for _ in range(args.runs):
+        render()
+    cpu_per_invoice = (time.process_time() - cpu_start) / args.runs
+
+    tracemalloc.start()
+    render()
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size for stat in snapshot.statistics('filename'))
+
+    print(f"{args.lines}-line invoice, {args.runs} runs")
+    print(f"  CPU time per invoice: {cpu_per_invoice * 1000:.1f} ms")
+    print(f"  Peak traced memory:   {peak / 1024:.0f} KiB")
+    print(f"  Retained after build: {allocated / 1024:.0f} KiB")
+
+
+if __name__ == '__main__':
+    main()
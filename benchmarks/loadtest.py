@@ -0,0 +1,434 @@
+"""Load-tests the app end to end under gunicorn, against local stand-ins for Firebase, R2 and SMTP.
+
+Boots the app under gunicorn once per worker/thread configuration, pointed at
+benchmarks/fake_rtdb.py (through firebase_admin's emulator support, so all workers
+share one database), benchmarks/local_s3.py and benchmarks/local_smtp.py, each with
+injected latency. Virtual users log in through the real OTP flow and then run one of
+four scenarios until the time is up:
+
+  dashboard  open the dashboard, load products, poll /get_current_stocks?since=<version>
+  checkout   update the cart and place an order (one low-stock item makes some hit 409)
+  returns    return a delivered order, alternating presigned direct uploads and form uploads
+  careers    browse the careers page, jobs and office locations without logging in
+
+Reports p50/p95/p99 latency and throughput per route for every configuration, so
+the Procfile's worker and thread counts can be sized from measurements.
+
+Usage: python benchmarks/loadtest.py [--configs 1x8,2x4,4x2] [--duration 30] [--users 40] [--preload]
+                                     [--mix dashboard=50,checkout=20,returns=10,careers=20]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from benchmarks.fake_rtdb import FakeRTDBServer  # noqa: E402
+from benchmarks.local_s3 import LocalS3Server  # noqa: E402
+from benchmarks.local_smtp import LocalSMTPServer  # noqa: E402
+
+BUCKET = 'nila-loadtest'
+DATABASE_URL = 'https://nila-loadtest.firebaseio.com'
+SCENARIOS = ('dashboard', 'checkout', 'returns', 'careers')
+DEFAULT_MIX = 'dashboard=50,checkout=20,returns=10,careers=20'
+SCARCE_PRODUCT = 'item012'
+OTP_PATTERN = re.compile(r'>(\d{6})</span>')
+# The smallest valid-looking MP4 header; the rest of the video is random bytes.
+MP4_HEADER = b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom'
+
+
+# --- Fixtures ---
+def service_account_json():
+    """A throwaway service account: the emulator ignores auth, and custom tokens are signed locally."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode('ascii')
+    return json.dumps({
+        'type': 'service_account', 'project_id': 'nila-loadtest', 'private_key_id': 'loadtest',
+        'private_key': private_key, 'client_email': 'loadtest@nila-loadtest.iam.gserviceaccount.com',
+        'client_id': '0', 'token_uri': 'https://oauth2.googleapis.com/token',
+    })
+
+
+def user_email(index):
+    return f'loadtest{index}@example.com'
+
+
+def seeded_order_ids(index, count):
+    return [f'ORD-LT{index}-{n}' for n in range(count)]
+
+
+def build_seed(user_count, orders_per_user):
+    products = {
+        f'item{n:03d}': {
+            'name': f'Load Test Product {n}', 'price': 500 + 250 * n, 'availableStock': 1000000,
+            'image': f'https://example.com/item{n:03d}.jpg', 'description': 'Seeded by benchmarks/loadtest.py.',
+        }
+        for n in range(1, 12)
+    }
+    products[SCARCE_PRODUCT] = dict(products['item011'], name='Load Test Limited Edition', availableStock=25)
+    careers = {
+        'jobs': {
+            f'job{n:02d}': {'id': n, 'title': f'Role {n}', 'location': 'Chennai, TN', 'category': 'Engineering',
+                            'type': 'Full-time', 'description': 'Seeded by benchmarks/loadtest.py. ' * 8}
+            for n in range(1, 21)
+        },
+        'offices': {
+            f'loc{n:02d}': {'city': f'City {n}', 'type': 'Office', 'address': f'{n} Load Test Road'}
+            for n in range(1, 7)
+        },
+    }
+    address = {'name': 'Load Test', 'phone': '9876500000', 'address': '1 Load Test Road',
+               'city': 'Chennai', 'state': 'TN', 'pincode': '600002'}
+    delivered = datetime.now().strftime('%d-%b-%Y')
+    users = {}
+    for index in range(user_count):
+        history = {
+            order_id: {
+                'orderId': order_id, 'invoiceId': order_id.replace('ORD', 'INV'), 'orderDate': {'.sv': 'timestamp'},
+                'status': 'Delivered', 'deliveryDate': delivered, 'shippingAddress': address, 'totalAmount': 750,
+                'items': [{'id': 'item001', 'name': products['item001']['name'], 'price': 750, 'quantity': 1,
+                           'image': products['item001']['image'], 'description': 'Seeded'}],
+            }
+            for order_id in seeded_order_ids(index, orders_per_user.get(index, 0))
+        }
+        users[user_email(index).replace('.', '_')] = {
+            'email': user_email(index), 'phone': f'98765{index:05d}', 'name': f'Load Tester {index}',
+            'organization': 'NILA', 'country': 'India', 'state': 'TN', 'district': 'Chennai',
+            'address': address['address'], 'pincode': address['pincode'], 'orders': len(history),
+            'cart_items': [], 'created_at': {'.sv': 'timestamp'},
+            'order_details': {'shipping_address': {'addr1': address}, 'order_history': history},
+        }
+    return {'stockitems': products, 'careers': careers, 'users': users}
+
+
+def assign_scenarios(user_count, mix):
+    """Splits user_count virtual users between scenarios in proportion to mix (largest remainder)."""
+    total = sum(mix.values())
+    exact = {name: user_count * weight / total for name, weight in mix.items()}
+    counts = {name: int(share) for name, share in exact.items()}
+    for name in sorted(exact, key=lambda name: exact[name] - counts[name], reverse=True)[:user_count - sum(counts.values())]:
+        counts[name] += 1
+    return [name for name in SCENARIOS for _ in range(counts.get(name, 0))]
+
+
+# --- Measurements ---
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)  # route -> [(seconds, status)]
+
+    def record(self, route, seconds, status):
+        with self.lock:
+            self.samples[route].append((seconds, status))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(seconds for seconds, _ in samples)
+    return {
+        'count': len(samples),
+        'client_errors': sum(1 for _, status in samples if 400 <= status < 500),
+        'errors': sum(1 for _, status in samples if status >= 500 or status == 0),
+        'rps': len(samples) / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+    }
+
+
+# --- Virtual Users ---
+class VirtualUser:
+    def __init__(self, index, scenario, base_url, recorder, smtp, think_seconds, video_bytes, returnable=()):
+        self.index = index
+        self.scenario = scenario
+        self.email = user_email(index)
+        self.base_url = base_url
+        self.recorder = recorder
+        self.smtp = smtp
+        self.think_seconds = think_seconds
+        self.video_bytes = video_bytes
+        self.session = requests.Session()
+        self.random = random.Random(index)
+        self.returnable = list(returnable)
+        self.iterations = 0
+        self.version = 0
+
+    def request(self, method, path, route=None, **kwargs):
+        url = path if path.startswith('http') else self.base_url + path
+        route = route or f"{method} {path.split('?')[0]}"
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=60, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        self.recorder.record(route, time.perf_counter() - started, status)
+        return response
+
+    def think(self):
+        time.sleep(self.think_seconds * self.random.uniform(0.5, 1.5))
+
+    def log_in(self):
+        """Goes through /login_check and /verify_login_otp, reading the OTP from the SMTP sink."""
+        requested_at = time.time()
+        response = self.session.post(self.base_url + '/login_check', json={'email': self.email, 'phone': f'98765{self.index:05d}'}, timeout=60)
+        response.raise_for_status()
+        message = self.smtp.wait_for(self.email, since=requested_at, timeout=60)
+        otp = OTP_PATTERN.search(message.get_content()).group(1)
+        response = self.session.post(self.base_url + '/verify_login_otp', json={'otp': otp}, timeout=60)
+        response.raise_for_status()
+
+    def run(self, deadline):
+        while time.monotonic() < deadline:
+            getattr(self, f'run_{self.scenario}')()
+            self.iterations += 1
+            self.think()
+
+    def run_dashboard(self):
+        if self.iterations % 20 == 0:
+            self.request('GET', '/user_dashboard.html')
+            self.request('GET', '/get_products')
+            response = self.request('GET', '/get_current_stocks?since=0')
+            self.version = response.json().get('version', 0) if response is not None and response.ok else 0
+            return
+        response = self.request('GET', f'/get_current_stocks?since={self.version}')
+        if response is not None and response.ok:
+            self.version = response.json().get('version', self.version)
+
+    def run_checkout(self):
+        product_ids = self.random.sample([f'item{n:03d}' for n in range(1, 13)], self.random.randint(1, 3))
+        cart = [{'id': product_id, 'name': product_id, 'price': 0, 'quantity': 1, 'image': ''} for product_id in product_ids]
+        self.request('POST', '/update_cart_db', json={'user_email': self.email, 'cart_items': cart})
+        self.request('POST', '/place_order', json={'address_id': 'addr1'})
+
+    def run_returns(self):
+        if not self.returnable:
+            return self.run_dashboard()
+        order_id = self.returnable.pop()
+        video = MP4_HEADER + os.urandom(max(0, self.video_bytes - len(MP4_HEADER)))
+        form = {
+            'orderId': order_id, 'reason': 'Load test return',
+            'addressInfo': json.dumps({'type': 'same'}), 'contactInfo': json.dumps({'type': 'same'}),
+        }
+        if self.iterations % 2 == 0:
+            response = self.request('POST', '/request_return/upload_url', json={'size': len(video)})
+            if response is None or not response.ok:
+                return
+            upload = response.json()
+            self.request('PUT', upload['uploadUrl'], route='PUT <presigned R2 URL>', data=video, headers=upload['headers'])
+            form['videoUploadId'] = upload['uploadId']
+            self.request('POST', '/request_return', data=form)
+        else:
+            self.request('POST', '/request_return', data=form,
+                         files={'videoFile': (f'{order_id}.mp4', video, 'video/mp4')})
+
+    def run_careers(self):
+        self.request('GET', '/nila_careers.html')
+        self.request('GET', '/get_jobs')
+        self.request('GET', '/get_locations')
+
+
+# --- Gunicorn ---
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(workers, threads, worker_class, port, env, log_file, preload=False):
+    command = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--worker-class', worker_class, '--timeout', '120', '--log-level', 'warning']
+    if worker_class == 'gevent':
+        command += ['--worker-connections', str(threads)]
+    else:
+        command += ['--threads', str(threads)]
+    if preload:
+        command.append('--preload')
+    # gunicorn.conf.py and the app's pool sizing read the worker settings from the environment.
+    env = dict(env, GUNICORN_WORKER_CLASS=worker_class, GUNICORN_WORKER_CONNECTIONS=str(threads))
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with status {process.returncode}; see {log_file.name}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/login.html', timeout=2).ok:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'gunicorn did not come up within 60s; see {log_file.name}')
+
+
+def stop_gunicorn(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def app_environment(rtdb, s3, smtp, threads, credentials_json):
+    env = dict(os.environ)
+    env.update({
+        'FLASK_SECRET_KEY': 'loadtest',
+        'FIREBASE_DATABASE_URL': DATABASE_URL,
+        'FIREBASE_DATABASE_EMULATOR_HOST': rtdb.emulator_host,
+        'FIREBASE_CREDENTIALS_JSON': credentials_json,
+        'DATASTORE_BACKEND': 'firebase',
+        'R2_ENDPOINT_URL': s3.endpoint_url,
+        'R2_ACCESS_KEY_ID': 'loadtest',
+        'R2_SECRET_ACCESS_KEY': 'loadtest',
+        'R2_BUCKET_NAME': BUCKET,
+        'R2_PUBLIC_URL_BASE': f'{s3.endpoint_url}/{BUCKET}',
+        'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required',
+        'GMAIL_SENDER_EMAIL': 'orders@example.com',
+        'GMAIL_SENDER_PASSWORD': 'loadtest',
+        'SMTP_HOST': smtp.host,
+        'SMTP_PORT': str(smtp.port),
+        'SMTP_USE_SSL': '0',
+        'GUNICORN_THREADS': str(threads),
+    })
+    return env
+
+
+# --- Reporting ---
+def print_report(label, recorder, elapsed):
+    routes = sorted(recorder.samples)
+    every_sample = [sample for route in routes if not route.startswith('PUT <') for sample in recorder.samples[route]]
+    overall = summarize(every_sample, elapsed)
+    print(f"\n== {label}: {overall['count']} app requests in {elapsed:.1f}s, {overall['rps']:.1f} req/s")
+    print(f"  {'route':<34} {'count':>6} {'4xx':>5} {'5xx':>5} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route in routes:
+        stats = summarize(recorder.samples[route], elapsed)
+        print(f"  {route:<34} {stats['count']:>6} {stats['client_errors']:>5} {stats['errors']:>5} {stats['rps']:>7.1f} "
+              f"{stats['p50']:>8.1f} {stats['p95']:>8.1f} {stats['p99']:>8.1f}")
+    return overall
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name!r}; choose from {", ".join(SCENARIOS)}')
+        mix[name] = float(weight)
+    return mix
+
+
+def parse_configs(text):
+    configs = []
+    for part in text.split(','):
+        workers, _, threads = part.partition('x')
+        configs.append((int(workers), int(threads or 1)))
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--configs', type=parse_configs, default=parse_configs('1x8,2x4,4x2'),
+                        help='comma-separated WORKERSxTHREADS (greenlets per worker with --worker-class gevent)')
+    parser.add_argument('--worker-class', default='gthread', choices=['gthread', 'sync', 'gevent'])
+    parser.add_argument('--preload', action='store_true', help='load the app once in the gunicorn master')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load per configuration')
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument('--think-ms', type=float, default=250, help='mean pause between a user\'s iterations')
+    parser.add_argument('--video-kb', type=int, default=512)
+    parser.add_argument('--rtdb-latency-ms', type=float, default=30)
+    parser.add_argument('--rtdb-jitter-ms', type=float, default=10)
+    parser.add_argument('--r2-latency-ms', type=float, default=40)
+    parser.add_argument('--smtp-latency-ms', type=float, default=150)
+    parser.add_argument('--json', help='also write the per-route results to this file')
+    args = parser.parse_args()
+
+    scenarios = assign_scenarios(args.users, args.mix)
+    returns_orders = {index: 200 for index, scenario in enumerate(scenarios) if scenario == 'returns'}
+    seed = build_seed(args.users, returns_orders)
+    rtdb = FakeRTDBServer(latency=args.rtdb_latency_ms / 1000, jitter=args.rtdb_jitter_ms / 1000).start()
+    s3 = LocalS3Server(latency=args.r2_latency_ms / 1000).start()
+    smtp = LocalSMTPServer(latency=args.smtp_latency_ms / 1000).start()
+    credentials_json = service_account_json()
+    counts = ', '.join(f'{scenarios.count(name)} {name}' for name in SCENARIOS if scenarios.count(name))
+    print(f"{args.users} users ({counts}), {args.duration:g}s per configuration; RTDB {args.rtdb_latency_ms:g}"
+          f"±{args.rtdb_jitter_ms:g} ms, R2 {args.r2_latency_ms:g} ms, SMTP {args.smtp_latency_ms:g} ms per call")
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='nila-loadtest-') as log_dir:
+        for workers, threads in args.configs:
+            label = f'{workers} workers x {threads} {"greenlets" if args.worker_class == "gevent" else "threads"} ({args.worker_class})'
+            if args.preload:
+                label += ', preloaded'
+            rtdb.database.load(seed)
+            with s3.lock:
+                s3.objects.clear()
+            port = free_port()
+            env = app_environment(rtdb, s3, smtp, threads, credentials_json)
+            with open(os.path.join(log_dir, f'gunicorn-{workers}x{threads}.log'), 'w') as log_file:
+                process = start_gunicorn(workers, threads, args.worker_class, port, env, log_file, preload=args.preload)
+                try:
+                    recorder = Recorder()
+                    users = [
+                        VirtualUser(index, scenario, f'http://127.0.0.1:{port}', recorder, smtp,
+                                    args.think_ms / 1000, args.video_kb * 1024,
+                                    seeded_order_ids(index, returns_orders.get(index, 0)))
+                        for index, scenario in enumerate(scenarios)
+                    ]
+                    with ThreadPoolExecutor(max_workers=16) as executor:
+                        list(executor.map(VirtualUser.log_in, [user for user in users if user.scenario != 'careers']))
+                    started = time.monotonic()
+                    deadline = started + args.duration
+                    threads_running = [threading.Thread(target=user.run, args=(deadline,)) for user in users]
+                    for thread in threads_running:
+                        thread.start()
+                    for thread in threads_running:
+                        thread.join()
+                    elapsed = time.monotonic() - started
+                finally:
+                    stop_gunicorn(process)
+            overall = print_report(label, recorder, elapsed)
+            results[label] = {
+                'overall': overall,
+                'routes': {route: summarize(samples, elapsed) for route, samples in recorder.samples.items()},
+            }
+
+    print(f"\n  {'configuration':<40} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'5xx':>5}")
+    for label, result in results.items():
+        overall = result['overall']
+        print(f"  {label:<40} {overall['rps']:>7.1f} {overall['p50']:>8.1f} {overall['p95']:>8.1f} "
+              f"{overall['p99']:>8.1f} {overall['errors']:>5}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+    for server in (rtdb, s3, smtp):
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
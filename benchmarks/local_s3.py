@@ -0,0 +1,220 @@
+"""A minimal in-memory S3 stand-in for benchmarking the R2 code paths locally.
+
+Supports the calls the app makes: object PUT/GET/HEAD/DELETE/copy, multipart uploads,
+batch DeleteObjects and ListObjectsV2. Every request can be delayed by a fixed
+latency, and request bodies throttled to a per-connection bandwidth, to
+approximate the round trip and link to R2.
+
+Usage: python benchmarks/local_s3.py [--port 9000] [--latency-ms 20] [--bandwidth-mbps 40]
+"""
+import argparse
+import hashlib
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, bandwidth=None):
+        super().__init__(address, LocalS3Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes per second per connection, None for unlimited
+        self.lock = threading.Lock()
+        self.objects = {}   # (bucket, key) -> (body, content_type)
+        self.uploads = {}   # upload id -> {'bucket', 'key', 'content_type', 'parts': {n: body}}
+        self.request_count = 0
+
+    @property
+    def endpoint_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self):
+        parts = urlsplit(self.path)
+        bucket, _, key = parts.path.lstrip('/').partition('/')
+        query = {name: values[0] for name, values in parse_qs(parts.query, keep_blank_values=True).items()}
+        return unquote(bucket), unquote(key), query
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length and self.server.bandwidth:
+            time.sleep(length / self.server.bandwidth)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_xml(self, status, xml):
+        self._send(status, f'<?xml version="1.0" encoding="UTF-8"?>{xml}'.encode(), {'Content-Type': 'application/xml'})
+
+    def _not_found(self, code='NoSuchKey'):
+        self._send_xml(404, f'<Error><Code>{code}</Code><Message>Not found</Message></Error>')
+
+    def _begin(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        if server.latency:
+            time.sleep(server.latency)
+        return self._route()
+
+    def do_PUT(self):
+        bucket, key, query = self._begin()
+        body = self._body()
+        copy_source = self.headers.get('x-amz-copy-source')
+        if copy_source:
+            return self._copy_object(bucket, key, unquote(copy_source))
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self.server.lock:
+            if 'uploadId' in query:
+                upload = self.server.uploads.get(query['uploadId'])
+                if upload is None:
+                    return self._not_found('NoSuchUpload')
+                upload['parts'][int(query['partNumber'])] = body
+            else:
+                content_type = self.headers.get('Content-Type', 'binary/octet-stream')
+                self.server.objects[(bucket, key)] = (body, content_type)
+        self._send(200, headers={'ETag': etag})
+
+    def _copy_object(self, bucket, key, copy_source):
+        source_bucket, _, source_key = copy_source.lstrip('/').partition('/')
+        with self.server.lock:
+            stored = self.server.objects.get((source_bucket, source_key))
+            if stored is None:
+                return self._not_found()
+            body, content_type = stored
+            if self.headers.get('x-amz-metadata-directive') == 'REPLACE':
+                content_type = self.headers.get('Content-Type', content_type)
+            self.server.objects[(bucket, key)] = (body, content_type)
+        self._send_xml(200, f'<CopyObjectResult><ETag>"{hashlib.md5(body).hexdigest()}"</ETag></CopyObjectResult>')
+
+    def do_GET(self):
+        bucket, key, query = self._begin()
+        if not key:
+            return self._list_objects(bucket, query)
+        with self.server.lock:
+            stored = self.server.objects.get((bucket, key))
+        if stored is None:
+            return self._not_found()
+        body, content_type = stored
+        self._send(200, body, {'Content-Type': content_type, 'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+
+    def do_HEAD(self):
+        bucket, key, _ = self._begin()
+        with self.server.lock:
+            stored = self.server.objects.get((bucket, key))
+        if stored is None:
+            return self._send(404)
+        body, content_type = stored
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', f'"{hashlib.md5(body).hexdigest()}"')
+        self.end_headers()
+
+    def do_DELETE(self):
+        bucket, key, query = self._begin()
+        with self.server.lock:
+            if 'uploadId' in query:
+                self.server.uploads.pop(query['uploadId'], None)
+            else:
+                self.server.objects.pop((bucket, key), None)
+        self._send(204)
+
+    def do_POST(self):
+        bucket, key, query = self._begin()
+        body = self._body()
+        if 'delete' in query:
+            return self._delete_objects(bucket, body)
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads[upload_id] = {
+                    'bucket': bucket, 'key': key, 'parts': {},
+                    'content_type': self.headers.get('Content-Type', 'binary/octet-stream'),
+                }
+            return self._send_xml(200, (
+                f'<InitiateMultipartUploadResult xmlns="{S3_NAMESPACE}"><Bucket>{escape(bucket)}</Bucket>'
+                f'<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'
+            ))
+        if 'uploadId' in query:
+            with self.server.lock:
+                upload = self.server.uploads.pop(query['uploadId'], None)
+                if upload is None:
+                    return self._not_found('NoSuchUpload')
+                data = b''.join(upload['parts'][number] for number in sorted(upload['parts']))
+                self.server.objects[(bucket, key)] = (data, upload['content_type'])
+            return self._send_xml(200, (
+                f'<CompleteMultipartUploadResult xmlns="{S3_NAMESPACE}"><Bucket>{escape(bucket)}</Bucket>'
+                f'<Key>{escape(key)}</Key><ETag>"{hashlib.md5(data).hexdigest()}-{len(upload["parts"])}"</ETag>'
+                f'</CompleteMultipartUploadResult>'
+            ))
+        self._send(400)
+
+    def _delete_objects(self, bucket, body):
+        keys = [element.text for element in ElementTree.fromstring(body).iter() if element.tag.endswith('Key')]
+        with self.server.lock:
+            for key in keys:
+                self.server.objects.pop((bucket, key), None)
+        deleted = ''.join(f'<Deleted><Key>{escape(key)}</Key></Deleted>' for key in keys)
+        self._send_xml(200, f'<DeleteResult xmlns="{S3_NAMESPACE}">{deleted}</DeleteResult>')
+
+    def _list_objects(self, bucket, query):
+        prefix = query.get('prefix', '')
+        max_keys = int(query.get('max-keys') or 1000)
+        start_after = query.get('continuation-token') or query.get('start-after') or ''
+        with self.server.lock:
+            keys = sorted(
+                (key, len(body)) for (stored_bucket, key), (body, _) in self.server.objects.items()
+                if stored_bucket == bucket and key.startswith(prefix) and key > start_after
+            )
+        page, truncated = keys[:max_keys], len(keys) > max_keys
+        contents = ''.join(f'<Contents><Key>{escape(key)}</Key><Size>{size}</Size></Contents>' for key, size in page)
+        token = f'<NextContinuationToken>{escape(page[-1][0])}</NextContinuationToken>' if truncated else ''
+        self._send_xml(200, (
+            f'<ListBucketResult xmlns="{S3_NAMESPACE}"><Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>'
+            f'<KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+            f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>{token}{contents}</ListBucketResult>'
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help='per-connection upload bandwidth, 0 for unlimited')
+    args = parser.parse_args()
+    bandwidth = args.bandwidth_mbps * 1000 * 1000 / 8 if args.bandwidth_mbps else None
+    server = LocalS3Server(('127.0.0.1', args.port), latency=args.latency_ms / 1000, bandwidth=bandwidth)
+    print(f"Local S3 listening on {server.endpoint_url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
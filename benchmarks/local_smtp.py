@@ -0,0 +1,152 @@
+"""A minimal SMTP sink that accepts and keeps every message, for exercising the email paths locally.
+
+Speaks plain SMTP (no TLS) with AUTH PLAIN/LOGIN that accepts any credentials, so the
+app's connection pool can log in as it would against Gmail. Run the app with
+SMTP_HOST/SMTP_PORT pointed here and SMTP_USE_SSL=0. Accepting a message can be
+delayed by a fixed latency to approximate the relay's response time.
+
+Usage: python benchmarks/local_smtp.py [--port 2525] [--latency-ms 150]
+"""
+import argparse
+import socketserver
+import threading
+import time
+from email import message_from_bytes, policy
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0):
+        super().__init__(address, LocalSMTPHandler)
+        self.latency = latency
+        self.messages = []  # {'sender', 'recipients', 'data', 'received_at'}
+        self.session_count = 0
+        self.condition = threading.Condition()
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def deliver(self, sender, recipients, data):
+        with self.condition:
+            self.messages.append({'sender': sender, 'recipients': recipients, 'data': data, 'received_at': time.time()})
+            self.condition.notify_all()
+
+    def wait_for(self, recipient, since=0.0, timeout=10.0):
+        """Returns the first message to recipient received at or after `since`, parsed as an email.message."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for message in self.messages:
+                    if recipient in message['recipients'] and message['received_at'] >= since:
+                        return message_from_bytes(message['data'], policy=policy.default)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'No message for {recipient} within {timeout:g}s')
+                self.condition.wait(remaining)
+
+
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def _read_line(self):
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError('client went away')
+        return line.decode('utf-8', 'replace').rstrip('\r\n')
+
+    def _read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                raise ConnectionError('client went away')
+            if line in (b'.\r\n', b'.\n'):
+                return b''.join(lines)
+            lines.append(line[1:] if line.startswith(b'..') else line)
+
+    def handle(self):
+        server = self.server
+        with server.condition:
+            server.session_count += 1
+        sender, recipients = None, []
+        self._reply('220 localhost NILA SMTP sink')
+        try:
+            while True:
+                line = self._read_line()
+                verb, _, argument = line.partition(' ')
+                verb = verb.upper()
+                if verb == 'EHLO':
+                    self._reply('250-localhost')
+                    self._reply('250-AUTH PLAIN LOGIN')
+                    self._reply('250 8BITMIME')
+                elif verb == 'HELO':
+                    self._reply('250 localhost')
+                elif verb == 'AUTH':
+                    mechanism, _, initial = argument.partition(' ')
+                    if mechanism.upper() == 'LOGIN':
+                        for prompt in ('VXNlcm5hbWU6', 'UGFzc3dvcmQ6'):
+                            if initial:
+                                initial = ''
+                                continue
+                            self._reply(f'334 {prompt}')
+                            self._read_line()
+                    elif not initial:
+                        self._reply('334 ')
+                        self._read_line()
+                    self._reply('235 2.7.0 Authentication successful')
+                elif verb == 'MAIL':
+                    sender, recipients = argument.partition(':')[2].strip().strip('<>'), []
+                    self._reply('250 OK')
+                elif verb == 'RCPT':
+                    recipients.append(argument.partition(':')[2].strip().strip('<>'))
+                    self._reply('250 OK')
+                elif verb == 'DATA':
+                    self._reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = self._read_data()
+                    if server.latency:
+                        time.sleep(server.latency)
+                    server.deliver(sender, recipients, data)
+                    sender, recipients = None, []
+                    self._reply('250 OK queued')
+                elif verb == 'RSET':
+                    sender, recipients = None, []
+                    self._reply('250 OK')
+                elif verb == 'NOOP':
+                    self._reply('250 OK')
+                elif verb == 'QUIT':
+                    self._reply('221 Bye')
+                    return
+                else:
+                    self._reply('502 Command not implemented')
+        except (ConnectionError, OSError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+    server = LocalSMTPServer(('127.0.0.1', args.port), latency=args.latency_ms / 1000)
+    print(f"Local SMTP sink listening on {server.host}:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"{len(server.messages)} messages received")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,669 @@
+"""Data access for the NILA app.
+
+Routes reach the Realtime Database through the repositories at the bottom of this
+module. Repositories sit on a database backend with the firebase_admin.db Reference
+API: FirebaseDatabase hands out real references, while InMemoryDatabase keeps the
+tree in process, with optional injected latency, so hot paths can be measured
+locally and reproducibly without a Firebase project.
+"""
+import copy
+import hashlib
+import json
+import queue
+import random
+import threading
+import time
+
+TRANSACTION_MAX_RETRIES = 25
+PUSH_ID_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+class FirebaseDatabase:
+    """The live Realtime Database of the default firebase_admin app.
+
+    firebase_admin is imported, and `connect` called to initialize the app, when the
+    first reference is requested rather than when the backend is created.
+    """
+
+    name = 'firebase'
+
+    def __init__(self, connect=None):
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._db = None
+
+    def reference(self, path='/'):
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    if self._connect:
+                        self._connect()
+                    from firebase_admin import db
+                    self._db = db
+        return self._db.reference(path)
+
+
+# --- In-Memory Backend ---
+def _split(path):
+    return [segment for segment in (path or '').split('/') if segment]
+
+
+def _key_order(key):
+    # RTDB sorts keys that look like 32-bit integers numerically, before all other keys.
+    try:
+        number = int(key)
+        if -2 ** 31 <= number < 2 ** 31 and str(number) == key:
+            return (0, number, '')
+    except (TypeError, ValueError):
+        pass
+    return (1, 0, str(key))
+
+
+def _value_order(value):
+    if value is None:
+        return (0, 0, '')
+    if isinstance(value, bool):
+        return (1, int(value), '')
+    if isinstance(value, (int, float)):
+        return (2, value, '')
+    if isinstance(value, str):
+        return (3, 0, value)
+    return (4, 0, '')
+
+
+def _normalize(value, current, now_ms):
+    """Resolves server values against the current data and drops nulls and empty nodes, as RTDB does.
+
+    Lists are stored as nodes keyed by index, so holes and later child writes behave as in RTDB.
+    """
+    if isinstance(value, (list, tuple)):
+        value = {str(index): item for index, item in enumerate(value)}
+    if isinstance(value, dict):
+        if set(value) == {'.sv'}:
+            server_value = value['.sv']
+            if server_value == 'timestamp':
+                return now_ms
+            if isinstance(server_value, dict) and 'increment' in server_value:
+                base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+                return base + server_value['increment']
+        children = {}
+        for key, child in value.items():
+            child_current = current.get(str(key)) if isinstance(current, dict) else None
+            child = _normalize(child, child_current, now_ms)
+            if child is not None:
+                children[str(key)] = child
+        return children or None
+    return copy.deepcopy(value)
+
+
+def _with_arrays(value):
+    """Returns a copy of a stored value as RTDB sends it back.
+
+    A node whose keys are all array indices comes back as a list, with None in the holes, as
+    long as fewer than half of the slots up to its largest index are empty.
+    """
+    if not isinstance(value, dict):
+        return value
+    children = {key: _with_arrays(child) for key, child in value.items()}
+    indices = [int(key) for key in children if key.isascii() and key.isdigit() and key == str(int(key))]
+    if indices and len(indices) == len(children) and max(indices) < 2 * len(indices):
+        items = [None] * (max(indices) + 1)
+        for key, child in children.items():
+            items[int(key)] = child
+        return items
+    return children
+
+
+def _etag(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class MemoryEvent:
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class MemoryListenerRegistration:
+    """Delivers change events to one listener from its own thread, like the Firebase SSE listener."""
+
+    def __init__(self, database, segments, callback):
+        self._database = database
+        self.segments = segments
+        self._callback = callback
+        self._events = queue.Queue()
+        self._closed = False
+        threading.Thread(target=self._dispatch, name='memory-db-listener', daemon=True).start()
+
+    def deliver(self, event):
+        self._events.put(event)
+
+    def _dispatch(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            try:
+                self._callback(event)
+            except Exception as e:
+                print(f"In-memory database listener error: {e}")
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._database._remove_listener(self)
+            self._events.put(None)
+
+
+class InMemoryDatabase:
+    """A process-local stand-in for the Realtime Database.
+
+    Supports the subset of the Reference API the app uses: get (including shallow and
+    etag reads), set, update (multi-path), push, delete, transaction, listen and
+    key/child/value ordered queries, with server timestamps and increments. Like RTDB it
+    refuses to write None and returns nodes keyed by array indices as lists. Each
+    round trip sleeps for `latency` seconds plus up to `jitter` seconds, so contention
+    and fan-out costs show up the way they do against Firebase.
+    """
+
+    name = 'memory'
+
+    def __init__(self, data=None, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self._lock = threading.RLock()
+        self._root = _normalize(data, None, self._now_ms())
+        self._listeners = []
+
+    def reference(self, path='/'):
+        return MemoryReference(self, _split(path))
+
+    def dump(self):
+        with self._lock:
+            return _with_arrays(self._root)
+
+    def load(self, data):
+        with self._lock:
+            self._root = _normalize(data, None, self._now_ms())
+        self._notify([])
+
+    @staticmethod
+    def _now_ms():
+        return int(time.time() * 1000)
+
+    def _round_trip(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _read(self, segments):
+        node = self._root
+        for segment in segments:
+            if not isinstance(node, dict):
+                return None
+            node = node.get(segment)
+        return node
+
+    def _write(self, segments, value):
+        """Stores an already normalized value at segments; None deletes the node and any emptied parents."""
+        if not segments:
+            self._root = value
+            return
+        if value is None:
+            parents = [self._root]
+            for segment in segments[:-1]:
+                child = parents[-1].get(segment) if isinstance(parents[-1], dict) else None
+                if child is None:
+                    return
+                parents.append(child)
+            if not isinstance(parents[-1], dict):
+                return
+            parents[-1].pop(segments[-1], None)
+            for depth in range(len(segments) - 1, 0, -1):
+                if parents[depth]:
+                    break
+                parents[depth - 1].pop(segments[depth - 1], None)
+            if not self._root:
+                self._root = None
+            return
+        if not isinstance(self._root, dict):
+            self._root = {}
+        node = self._root
+        for segment in segments[:-1]:
+            child = node.get(segment)
+            if not isinstance(child, dict):
+                child = node[segment] = {}
+            node = child
+        node[segments[-1]] = value
+
+    @staticmethod
+    def _as_dict(node):
+        if isinstance(node, list):
+            return {str(i): item for i, item in enumerate(node) if item is not None}
+        return {}
+
+    def _set(self, segments, value):
+        """Writes value at segments under the lock and returns the stored (normalized) value."""
+        stored = _normalize(value, self._read(segments), self._now_ms())
+        self._write(segments, stored)
+        return stored
+
+    def _add_listener(self, segments, callback):
+        registration = MemoryListenerRegistration(self, segments, callback)
+        with self._lock:
+            self._listeners.append(registration)
+            registration.deliver(MemoryEvent('put', '/', _with_arrays(self._read(segments))))
+        return registration
+
+    def _remove_listener(self, registration):
+        with self._lock:
+            if registration in self._listeners:
+                self._listeners.remove(registration)
+
+    def _notify(self, *written):
+        """Sends a put event to every listener at, above or below each written path."""
+        with self._lock:
+            for registration in self._listeners:
+                listened = registration.segments
+                for segments in written:
+                    if segments[:len(listened)] == listened:
+                        relative = '/' + '/'.join(segments[len(listened):])
+                        registration.deliver(MemoryEvent('put', relative, _with_arrays(self._read(segments))))
+                    elif listened[:len(segments)] == segments:
+                        registration.deliver(MemoryEvent('put', '/', _with_arrays(self._read(listened))))
+
+
+class MemoryReference:
+    def __init__(self, database, segments):
+        self._database = database
+        self._segments = segments
+        self._pathurl = '/' + '/'.join(segments)
+
+    @property
+    def key(self):
+        return self._segments[-1] if self._segments else None
+
+    @property
+    def path(self):
+        return self._pathurl
+
+    @property
+    def parent(self):
+        return MemoryReference(self._database, self._segments[:-1]) if self._segments else None
+
+    def child(self, path):
+        return MemoryReference(self._database, self._segments + _split(path))
+
+    def get(self, etag=False, shallow=False):
+        if etag and shallow:
+            raise ValueError('etag and shallow cannot both be set to True.')
+        self._database._round_trip()
+        with self._database._lock:
+            value = self._database._read(self._segments)
+            if shallow and isinstance(value, dict):
+                result = {key: True if isinstance(child, dict) else child for key, child in value.items()}
+            else:
+                result = _with_arrays(value)
+        if etag:
+            return result, _etag(value)
+        return result
+
+    def set(self, value):
+        if value is None:
+            raise ValueError('Value must not be None.')
+        self._database._round_trip()
+        with self._database._lock:
+            self._database._set(self._segments, value)
+            self._database._notify(self._segments)
+
+    def set_if_unchanged(self, expected_etag, value):
+        if value is None:
+            raise ValueError('Value must not be none.')
+        self._database._round_trip()
+        with self._database._lock:
+            current = self._database._read(self._segments)
+            if _etag(current) != expected_etag:
+                return False, _with_arrays(current), _etag(current)
+            stored = self._database._set(self._segments, value)
+            self._database._notify(self._segments)
+            return True, _with_arrays(stored), _etag(stored)
+
+    def push(self, value=''):
+        now_ms = self._database._now_ms()
+        time_chars = ''
+        for _ in range(8):
+            time_chars = PUSH_ID_CHARS[now_ms % 64] + time_chars
+            now_ms //= 64
+        push_id = time_chars + ''.join(random.choice(PUSH_ID_CHARS) for _ in range(12))
+        reference = self.child(push_id)
+        reference.set(value)
+        return reference
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        self._database._round_trip()
+        with self._database._lock:
+            # All locations are written under one lock hold, so the update is atomic.
+            written = []
+            for path, child in value.items():
+                segments = self._segments + _split(path)
+                self._database._set(segments, child)
+                written.append(segments)
+            self._database._notify(*written)
+
+    def delete(self):
+        self._database._round_trip()
+        with self._database._lock:
+            self._database._write(self._segments, None)
+            self._database._notify(self._segments)
+
+    def transaction(self, transaction_update):
+        if not callable(transaction_update):
+            raise ValueError('transaction_update must be a function.')
+        data, etag = self.get(etag=True)
+        for _ in range(TRANSACTION_MAX_RETRIES):
+            new_data = transaction_update(data)
+            success, data, etag = self.set_if_unchanged(etag, new_data)
+            if success:
+                return new_data
+        from firebase_admin import db
+        raise db.TransactionAbortedError('Transaction aborted after failed retries.')
+
+    def listen(self, callback):
+        return self._database._add_listener(self._segments, callback)
+
+    def order_by_key(self):
+        return MemoryQuery(self, 'key')
+
+    def order_by_child(self, path):
+        return MemoryQuery(self, 'child', _split(path))
+
+    def order_by_value(self):
+        return MemoryQuery(self, 'value')
+
+
+class MemoryQuery:
+    def __init__(self, reference, order_by, child_segments=()):
+        self._reference = reference
+        self._pathurl = reference._pathurl
+        self._order_by = order_by
+        self._child_segments = child_segments
+        self._start = self._end = None
+        self._limit = None
+
+    def _ordered_value(self, key, value):
+        if self._order_by == 'key':
+            return _key_order(key)
+        if self._order_by == 'child':
+            for segment in self._child_segments:
+                value = value.get(segment) if isinstance(value, dict) else None
+        return _value_order(value)
+
+    def start_at(self, start):
+        self._start = start
+        return self
+
+    def end_at(self, end):
+        self._end = end
+        return self
+
+    def equal_to(self, value):
+        self._start = self._end = value
+        return self
+
+    def limit_to_first(self, limit):
+        self._limit = ('first', limit)
+        return self
+
+    def limit_to_last(self, limit):
+        self._limit = ('last', limit)
+        return self
+
+    def get(self):
+        value = self._reference.get()
+        if isinstance(value, list):
+            value = InMemoryDatabase._as_dict(value)
+        if not isinstance(value, dict):
+            return {}
+        items = sorted(value.items(), key=lambda item: (self._ordered_value(*item), _key_order(item[0])))
+        bound_order = _key_order if self._order_by == 'key' else _value_order
+        if self._start is not None:
+            items = [item for item in items if self._ordered_value(*item) >= bound_order(self._start)]
+        if self._end is not None:
+            items = [item for item in items if self._ordered_value(*item) <= bound_order(self._end)]
+        if self._limit:
+            kind, limit = self._limit
+            items = items[:limit] if kind == 'first' else items[-limit:]
+        return dict(items)
+
+
+# --- Repositories ---
+class UserRepository:
+    """User profiles under 'users/<safe_email_key>'."""
+
+    def __init__(self, database):
+        self.database = database
+
+    @staticmethod
+    def path(user_key):
+        return f'users/{user_key}'
+
+    def get(self, user_key):
+        return self.database.reference(self.path(user_key)).get()
+
+    def create(self, user_key, user_data):
+        self.database.reference(self.path(user_key)).set(user_data)
+
+    def get_name(self, user_key):
+        return self.database.reference(f'{self.path(user_key)}/name').get()
+
+    def set_order_count(self, user_key, count):
+        self.database.reference(f'{self.path(user_key)}/orders').set(count)
+
+    def keys(self):
+        return list((self.database.reference('users').get(shallow=True) or {}).keys())
+
+    def all(self):
+        return self.database.reference('users').get() or {}
+
+
+class CartRepository:
+    """Each user's cart, stored as a list at 'users/<safe_email_key>/cart_items'."""
+
+    def __init__(self, database):
+        self.database = database
+
+    @staticmethod
+    def path(user_key):
+        return f'users/{user_key}/cart_items'
+
+    def save(self, user_key, cart_items):
+        self.database.reference(self.path(user_key)).set(cart_items)
+
+
+class OrderRepository:
+    """Order history under 'users/<safe_email_key>/order_details/order_history'."""
+
+    def __init__(self, database):
+        self.database = database
+
+    @staticmethod
+    def path(user_key, order_id=None):
+        history_path = f'users/{user_key}/order_details/order_history'
+        return f'{history_path}/{order_id}' if order_id else history_path
+
+    def history(self, user_key):
+        return self.database.reference(self.path(user_key)).get()
+
+    def get(self, user_key, order_id):
+        return self.database.reference(self.path(user_key, order_id)).get()
+
+    def set_field(self, user_key, order_id, field, value):
+        self.database.reference(f'{self.path(user_key, order_id)}/{field}').set(value)
+
+
+class VersionTakenError(Exception):
+    """Raised when a catalog version was already claimed by another writer."""
+
+
+class StockRepository:
+    """Products under 'stockitems', plus the catalog version and its stock changelog."""
+
+    def __init__(self, database, path='stockitems'):
+        self.database = database
+        self.path = path
+
+    def all(self):
+        return self.database.reference(self.path).get()
+
+    def replace_all(self, products):
+        self.database.reference(self.path).set(products)
+
+    def transaction(self, product_id, update):
+        return self.database.reference(f'{self.path}/{product_id}').transaction(update)
+
+    def listen(self, callback):
+        return self.database.reference(self.path).listen(callback)
+
+    def stock_levels(self, product_ids):
+        """Reads the current availableStock of each product; products that no longer exist are left out."""
+        levels = {}
+        for product_id in product_ids:
+            available_stock = self.database.reference(f'{self.path}/{product_id}/availableStock').get()
+            if available_stock is not None:
+                levels[product_id] = available_stock
+        return levels
+
+    @staticmethod
+    def changelog_key(version):
+        """The changelog key of a version. RTDB returns sequential integer keys as a JSON array,
+        so versions are stored as zero-padded 'v' keys, which also sort in version order."""
+        return f'v{version:012d}'
+
+    @staticmethod
+    def version_of(changelog_key):
+        return int(changelog_key[1:])
+
+    def latest_version(self):
+        """The newest catalog version, i.e. the highest key in the changelog (0 if it is empty)."""
+        latest = self.database.reference('stock_changelog').order_by_key().limit_to_last(1).get()
+        return max((self.version_of(key) for key in latest), default=0) if latest else 0
+
+    def claim_version(self, version, stock_levels):
+        """Logs stock_levels as catalog version `version` in one transaction.
+
+        A version exists exactly when its changelog entry does, so a writer that fails
+        part-way leaves no gap. Raises VersionTakenError if another writer got there first.
+        """
+        def claim(current):
+            if current is not None:
+                raise VersionTakenError(version)
+            return stock_levels
+        self.database.reference(f'stock_changelog/{self.changelog_key(version)}').transaction(claim)
+
+    def changes_after(self, version):
+        """Returns {version: stock_levels} for every logged version after `version`."""
+        entries = self.database.reference('stock_changelog').order_by_key().start_at(self.changelog_key(version + 1)).get() or {}
+        return {self.version_of(key): stock_levels for key, stock_levels in entries.items()}
+
+    def prune_changes(self, up_to_version):
+        """Deletes changelog entries up to and including up_to_version. Returns how many were removed."""
+        expired = self.database.reference('stock_changelog').order_by_key().end_at(self.changelog_key(up_to_version)).get()
+        if expired:
+            self.database.reference('stock_changelog').update({key: None for key in expired})
+        return len(expired or {})
+
+
+class CareersRepository:
+    """Job listings and offices under 'careers', and each user's job applications."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def all(self):
+        return self.database.reference('careers').get()
+
+    def replace_all(self, careers_data):
+        self.database.reference('careers').set(careers_data)
+
+    @staticmethod
+    def application_path(user_key, application_id=None):
+        applications_path = f'users/{user_key}/job_applications'
+        return f'{applications_path}/{application_id}' if application_id else applications_path
+
+    def applications(self, user_key):
+        return self.database.reference(self.application_path(user_key)).get()
+
+    def application_ids(self, user_key):
+        return set((self.database.reference(self.application_path(user_key)).get(shallow=True) or {}).keys())
+
+    def get_application(self, user_key, application_id):
+        return self.database.reference(self.application_path(user_key, application_id)).get()
+
+
+class DirectUploadRepository:
+    """Presigned uploads awaiting their form submission, under 'direct_uploads/<upload_id>'."""
+
+    def __init__(self, database):
+        self.database = database
+
+    @staticmethod
+    def path(upload_id):
+        return f'direct_uploads/{upload_id}'
+
+    def grant(self, upload_id, grant):
+        self.database.reference(self.path(upload_id)).set(grant)
+
+    @staticmethod
+    def _usable(grant, owner, kind):
+        return bool(grant) and not grant.get('claimed') and grant.get('owner') == owner and grant.get('kind') == kind
+
+    def get(self, upload_id, owner, kind):
+        """Returns the unclaimed grant for upload_id, or None if there is none or it was issued to
+        another owner or for another kind of upload. Reading does not consume it; see claim.
+        """
+        current = self.database.reference(self.path(upload_id)).get()
+        return current if self._usable(current, owner, kind) else None
+
+    def claim(self, upload_id, owner, kind, now):
+        """Marks the grant for upload_id claimed in one transaction, so it can be used once, then
+        removes it. Returns the grant.
+
+        Returns None, leaving the grant in place, if there is none, it was already claimed or had
+        expired by `now`, or it was issued to another owner or for another kind of upload.
+        """
+        def take(current):
+            # Expired grants are left to the R2 deletion queue, which deletes their objects.
+            if not self._usable(current, owner, kind) or current.get('expires', 0) <= now:
+                raise LookupError(upload_id)
+            # A transaction cannot write None, so the grant is marked claimed and deleted afterwards.
+            return dict(current, claimed=True)
+        reference = self.database.reference(self.path(upload_id))
+        try:
+            claimed = reference.transaction(take)
+        except LookupError:
+            return None
+        try:
+            reference.delete()
+        except Exception as e:
+            # The claimed marker already blocks reuse; the R2 deletion queue removes the node once it expires.
+            print(f"Could not delete claimed upload grant {upload_id}: {e}")
+        return claimed
+
+    def expired(self, now):
+        """Returns {upload_id: grant} for grants that expired before `now`."""
+        grants = self.database.reference('direct_uploads').get() or {}
+        return {upload_id: grant for upload_id, grant in grants.items() if grant.get('expires', 0) <= now}
+
+
+class IdRegistry:
+    """Issued IDs under 'existing_ids/<type>' and the per-type block counters under 'id_blocks'."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def reserve_block(self, id_type, block_size):
+        """Atomically advances the counter for id_type by block_size and returns the new end."""
+        return self.database.reference(f'id_blocks/{id_type}').transaction(lambda current: (current or 0) + block_size)
@@ -0,0 +1,40 @@
+"""Gunicorn settings for the NILA app; gunicorn reads this file from the working directory.
+
+Workers are gevent workers by default: each request runs in a greenlet, so a worker
+keeps serving others while a request waits on Firebase, R2 or SMTP, and idle
+/stream/stocks connections cost a greenlet rather than a thread. The standard library
+is monkey-patched here, before the app (and with it ssl, requests, boto3 and smtplib)
+is imported, which --preload would otherwise do in the master ahead of the worker's
+own patching. Choose the worker class with GUNICORN_WORKER_CLASS rather than -k so
+the patching follows it; 'gthread' with GUNICORN_THREADS and 'sync' are supported too.
+
+With GUNICORN_PRELOAD=1 (or --preload) the master imports the app once and loads its
+read-only state there (templates, invoice styles, catalog and careers snapshots), so
+workers share it copy-on-write instead of each rebuilding it. post_fork then gives every
+worker its own Firebase and R2 connections and, preloaded or not, starts its background
+threads (the email outbox and R2 deletion queue) at boot.
+"""
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+# The app sizes its Firebase and R2 connection pools from the same variables
+# (GUNICORN_WORKER_CONNECTIONS under gevent, GUNICORN_THREADS otherwise).
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '2000'))
+threads = int(os.environ.get('GUNICORN_THREADS', '1'))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        import app
+        app.load_shared_state()
+
+
+def post_fork(server, worker):
+    # Without --preload this is the worker's first import of the app.
+    import app
+    app.init_worker()
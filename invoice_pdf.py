@@ -0,0 +1,187 @@
+"""Invoice PDF rendering with ReportLab.
+
+Kept free of Flask and Firebase imports so invoice rendering can run in worker
+processes that only need to load this module.
+"""
+import io
+import os
+import threading
+from datetime import datetime
+
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Flowable
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.enums import TA_RIGHT, TA_CENTER, TA_LEFT
+from reportlab.lib.units import inch
+from reportlab.lib import colors
+from reportlab.lib.utils import ImageReader
+from PIL import Image as PILImage
+
+SIGNATURE_IMAGE_PATH = "seal.png"
+RUPEE_IMAGE_PATH = "rupee.png"
+
+# Pre-scaled resolution for the rupee glyph: sharp at print size while cheap to embed per price cell.
+RUPEE_IMAGE_PIXELS = 96
+
+class SharedImage(Flowable):
+    """Draws a pre-decoded ImageReader, so repeated images are not re-read and re-decoded per use."""
+
+    def __init__(self, image_reader, width, height, hAlign='CENTER'):
+        Flowable.__init__(self)
+        self.image_reader = image_reader
+        self.width = width
+        self.height = height
+        self.hAlign = hAlign
+
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+
+    def draw(self):
+        self.canv.drawImage(self.image_reader, 0, 0, self.width, self.height, mask='auto')
+
+def _load_image_reader(path, max_pixels=None):
+    if not os.path.exists(path):
+        return None
+    with PILImage.open(path) as img:
+        img = img.convert('RGBA')
+        if max_pixels:
+            img.thumbnail((max_pixels, max_pixels), PILImage.LANCZOS)
+    reader = ImageReader(img)
+    # Decode once now; the cached RGB data is then shared read-only by every invoice.
+    reader.getRGBData()
+    return reader
+
+class InvoiceRenderContext:
+    """Styles, images and table styles shared by every invoice rendered in this process.
+
+    Only immutable inputs belong here. Flowables (Paragraph, Table, Image) record layout
+    state while a document is built, so sharing one between concurrent builds corrupts
+    both; create_modern_invoice makes fresh ones from these for every invoice.
+    """
+
+    def __init__(self):
+        styles = getSampleStyleSheet()
+        styles.add(ParagraphStyle(name='MainTitle', fontName='Helvetica-Bold', fontSize=22, alignment=TA_LEFT, textColor=colors.HexColor('#005A9C')))
+        styles.add(ParagraphStyle(name='RightAlignText', fontName='Helvetica', fontSize=10, alignment=TA_RIGHT, leading=14))
+        styles.add(ParagraphStyle(name='AddressHeader', fontName='Helvetica-Bold', fontSize=10, alignment=TA_LEFT))
+        styles.add(ParagraphStyle(name='AddressBody', fontName='Helvetica', fontSize=10, alignment=TA_LEFT, leading=14))
+        styles.add(ParagraphStyle(name='TableHeader', fontName='Helvetica-Bold', fontSize=9, alignment=TA_CENTER, textColor=colors.white))
+        styles.add(ParagraphStyle(name='FooterText', fontName='Helvetica', fontSize=8, alignment=TA_CENTER, textColor=colors.grey))
+        styles.add(ParagraphStyle(name='CompanyBrand', fontName='Helvetica-Bold', fontSize=11, alignment=TA_CENTER))
+        styles.add(ParagraphStyle(name='SignatureText', fontName='Helvetica', fontSize=10, alignment=TA_CENTER))
+        self.styles = styles
+        self.price_text_styles = {
+            is_bold: ParagraphStyle(name='priceText', fontName='Helvetica-Bold' if is_bold else 'Helvetica', fontSize=11 if is_bold else 9, alignment=TA_RIGHT)
+            for is_bold in (False, True)
+        }
+        self.rupee_image = _load_image_reader(RUPEE_IMAGE_PATH, RUPEE_IMAGE_PIXELS)
+        self.signature_image = _load_image_reader(SIGNATURE_IMAGE_PATH)
+        self.price_cell_style = TableStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('LEFTPADDING', (0, 0), (-1, -1), 0), ('RIGHTPADDING', (0, 0), (-1, -1), 0)])
+        self.items_table_style = TableStyle([('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#005A9C')), ('GRID', (0, 0), (-1, -1), 1, colors.lightgrey), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.whitesmoke, colors.white]), ('ALIGN', (2, 1), (2, -1), 'CENTER'), ('ALIGN', (3, 1), (-1, -1), 'RIGHT')])
+        self.totals_table_style = TableStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('ALIGN', (0, 0), (-1, -1), 'RIGHT'), ('FONTSIZE', (0,0), (-1,-1), 10)])
+        self.table_header_labels = ('Product', 'Description', 'Qty', 'Amount', 'CGST (2.5%)', 'SGST (2.5%)', 'Total')
+
+_invoice_context = None
+_invoice_context_lock = threading.Lock()
+
+def get_invoice_context():
+    """Builds the shared InvoiceRenderContext on first use."""
+    global _invoice_context
+    if _invoice_context is None:
+        with _invoice_context_lock:
+            if _invoice_context is None:
+                _invoice_context = InvoiceRenderContext()
+    return _invoice_context
+
+def create_price_cell(amount_float, context, is_bold=False):
+    font_size = 11 if is_bold else 9
+    formatted_amount = f"{amount_float:,.2f}"
+    text_style = context.price_text_styles[is_bold]
+    if context.rupee_image is None:
+        return Paragraph(f"₹ {formatted_amount}", text_style)
+    rupee_img = SharedImage(context.rupee_image, font_size, font_size, hAlign='LEFT')
+    amount_para = Paragraph(formatted_amount, text_style)
+    inner_table = Table(
+        [[rupee_img, amount_para]],
+        colWidths=[font_size + 2, None],
+        style=context.price_cell_style
+    )
+    return inner_table
+
+def invoice_date(order_data, title):
+    """The date printed on an invoice: when the order (or return) was placed."""
+    timestamp = order_data.get('orderDate')
+    if title == "Return Invoice":
+        timestamp = order_data.get('returnDetails', {}).get('requestedAt', timestamp)
+    if isinstance(timestamp, (int, float)):
+        return datetime.fromtimestamp(timestamp / 1000)
+    return datetime.now()
+
+def create_modern_invoice(order_data, user_data, path_or_buffer, title="Tax Invoice"):
+    doc = SimpleDocTemplate(path_or_buffer, pagesize=A4, rightMargin=0.5*inch, leftMargin=0.5*inch, topMargin=0.5*inch, bottomMargin=0.5*inch)
+    story = []
+    context = get_invoice_context()
+    styles = context.styles
+    id_text = f"Order ID: {order_data['orderId']}<br/>Invoice ID: {order_data['invoiceId']}"
+    if title == "Return Invoice" and 'returnInvoiceId' in order_data:
+        id_text += f"<br/>Return ID: {order_data['returnInvoiceId']}"
+    header_data = [
+        [Paragraph(title, styles['MainTitle']), Paragraph(id_text, styles['RightAlignText'])],
+        ['', Paragraph(f"Date: {invoice_date(order_data, title).strftime('%d-%b-%Y')}", styles['RightAlignText'])]
+    ]
+    story.append(Table(header_data, colWidths=[4*inch, 3.5*inch], style=TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP')])))
+    story.append(Spacer(1, 0.25 * inch))
+    if title == "Return Invoice" and 'returnDetails' in order_data:
+        addr = order_data['returnDetails'].get('pickupAddress', order_data['shippingAddress'])
+    else:
+        addr = order_data['shippingAddress']
+    address_content = f"{user_data.get('name', '')}<br/>{addr.get('address', '')},<br/>{addr.get('city', '')}, {addr.get('state', '')} - {addr.get('pincode', '')}<br/>{addr.get('country', '')}"
+    address_data = [[Paragraph('Sold By', styles['AddressHeader']), Paragraph('Shipping Address', styles['AddressHeader'])], [Paragraph("<b>NILA PRODUCTS</b><br/>14/1-1 Andal Avenue, Vellalore<br/>Coimbatore, Tamil Nadu, 641111<br/><b>GSTIN:</b> 33AQGPM1414L2ZZ", styles['AddressBody']), Paragraph(address_content, styles['AddressBody'])]]
+    story.append(Table(address_data, colWidths=[3.75*inch, 3.75*inch], style=TableStyle([('VALIGN', (0,0), (-1,-1), 'TOP'), ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey), ('PADDING', (0,0), (-1,-1), 10)])))
+    story.append(Spacer(1, 0.3 * inch))
+    # A new header row per document: Paragraphs carry this build's layout state.
+    table_header = [Paragraph(h, styles['TableHeader']) for h in context.table_header_labels]
+    col_widths = [1.5*inch, 2.0*inch, 0.4*inch, 0.9*inch, 0.9*inch, 0.9*inch, 0.9*inch]
+    table_data = [table_header]
+    grand_total_amount, total_tax_amount, total_base_amount = 0.0, 0.0, 0.0
+    for item in order_data['items']:
+        base_price = item['price'] * item['quantity']
+        cgst, sgst = base_price * 0.025, base_price * 0.025
+        total_item_price = base_price + cgst + sgst
+        row = [ Paragraph(item['name'], styles['Normal']), Paragraph(item.get('description', 'N/A'), styles['Normal']), item['quantity'], create_price_cell(base_price, context), create_price_cell(cgst, context), create_price_cell(sgst, context), create_price_cell(total_item_price, context) ]
+        total_base_amount += base_price
+        total_tax_amount += (cgst + sgst)
+        grand_total_amount += total_item_price
+        table_data.append(row)
+    items_table = Table(table_data, colWidths=col_widths, style=context.items_table_style)
+    story.append(items_table)
+    story.append(Spacer(1, 0.3 * inch))
+    totals_data = [
+        [Paragraph('Subtotal:', styles['RightAlignText']), create_price_cell(total_base_amount, context)],
+        [Paragraph('Tax (CGST+SGST):', styles['RightAlignText']), create_price_cell(total_tax_amount, context)],
+        [Paragraph('<b>Grand Total:</b>', styles['RightAlignText']), create_price_cell(grand_total_amount, context, is_bold=True)],
+    ]
+    totals_table = Table(totals_data, colWidths=[1.5*inch, 1.5*inch], style=context.totals_table_style)
+    signature_section = ''
+    if context.signature_image is not None:
+        signature_img = SharedImage(context.signature_image, 1.2*inch, 0.8*inch)
+        signature_section = Table([[signature_img], [Paragraph("For NILA PRODUCTS", styles['SignatureText'])], [Paragraph("<i>Authorized Seal</i>", styles['SignatureText'])]], style=TableStyle([('ALIGN', (0,0), (-1,-1), 'CENTER')]))
+    summary_table = Table([[signature_section, totals_table]], colWidths=[4.5*inch, 3*inch], style=TableStyle([('VALIGN', (0,0), (-1,-1), 'BOTTOM')]))
+    story.append(summary_table)
+    story.append(Spacer(1, 0.5 * inch))
+    story.append(Table([[Paragraph("Generated via", styles['FooterText'])], [Paragraph("NILA PRODUCTS", styles['CompanyBrand'])]], colWidths=[7.5*inch]))
+    story.append(Spacer(1, 0.1 * inch))
+    story.append(Paragraph("This is a computer-generated document.", styles['FooterText']))
+    doc.build(story)
+    print(f"Document '{title}' successfully generated in-memory.")
+    return path_or_buffer
+
+def warm_up():
+    """Loads ReportLab and builds the shared styles and images ahead of the first invoice."""
+    get_invoice_context()
+
+def render_invoice_bytes(order_data, user_data, title="Tax Invoice"):
+    """Renders an invoice and returns the PDF as bytes."""
+    buffer = io.BytesIO()
+    create_modern_invoice(order_data, user_data, buffer, title=title)
+    return buffer.getvalue()
@@ -0,0 +1,20 @@
+// Uploads the file straight to R2 with a presigned URL. Returns the upload ID, or null to fall back to sending the file with the form.
+async function uploadDirectToR2(uploadUrlEndpoint, file) {
+    try {
+        const response = await fetch(uploadUrlEndpoint, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ size: file.size })
+        });
+        const upload = await response.json();
+        if (!upload.success) {
+            if (response.status === 400) throw new Error(upload.error);
+            return null;
+        }
+        const putResponse = await fetch(upload.uploadUrl, { method: upload.method, headers: upload.headers, body: file });
+        return putResponse.ok ? upload.uploadId : null;
+    } catch (error) {
+        if (error instanceof TypeError) return null; // network or CORS failure
+        throw error;
+    }
+}